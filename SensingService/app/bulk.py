@@ -0,0 +1,474 @@
+from app import app, db
+from flask import jsonify, json
+from sqlalchemy import exc
+from werkzeug.exceptions import ClientDisconnected
+import pandas as pd
+import psycopg2
+import queue
+import threading
+import time
+from .models import ObservedContextType
+from .utils import dimension_cache, check_dimension_generation, resolve_observation_maps, store_sensing_log, \
+    add_row_errors, get_dict_value
+
+
+# Content types of bulk requests with one observation object per line
+NDJSON_MIMETYPES = ['application/x-ndjson', 'application/ndjson', 'application/jsonlines']
+
+# Keys of a reading that identify its observation in a push stream
+STREAM_OBSERVATION_KEYS = ['type', 'context', 'parameter', 'unit', 'conditions']
+
+
+def store_bulk_observations(entries, default_coordinate, field_dict,
+                            equipment_id, accessibility, loader=None):
+    """
+    Stores observations that are already structured, without a file or datamap.
+    entries yields (observation object, message); every object has the type, context, parameter,
+    unit and conditions of an observation and date_time and value arrays, with optional longitude
+    and latitude arrays or numbers. Observations are loaded in batches of about INGEST_CHUNK_SIZE
+    rows (all at once if it is 0) and every batch is committed on its own
+    """
+    summary = init_bulk_summary()
+    chunk_size = app.config.get('INGEST_CHUNK_SIZE', 50000)
+
+    batch = []
+    batch_rows = 0
+
+    for index, (entry, msg) in enumerate(entries):
+        if msg[-1] is False:
+            return jsonify({'message': msg[0], 'summary': summary}), 400
+
+        obs_map, df, msg = parse_bulk_entry(entry, str(index), default_coordinate, summary)
+        if msg[-1] is False:
+            return jsonify({'message': msg[0], 'summary': summary}), 400
+
+        batch.append((obs_map, df))
+        batch_rows += len(df.index)
+
+        if chunk_size and batch_rows >= chunk_size:
+            response, is_ok = load_bulk_batch(batch, field_dict, equipment_id, accessibility, loader, summary)
+            if not is_ok:
+                return response
+
+            batch = []
+            batch_rows = 0
+
+    if batch:
+        response, is_ok = load_bulk_batch(batch, field_dict, equipment_id, accessibility, loader, summary)
+        if not is_ok:
+            return response
+
+    if not summary["observations"]:
+        return jsonify({'message': 'No observations in request', 'summary': summary}), 400
+
+    if summary["failed"]:
+        message = 'Failed to load {} row(s)'.format(summary["failed"])
+    else:
+        message = 'OK'
+
+    return jsonify({'message': message, 'summary': summary}), 200
+
+
+def read_ndjson(stream):
+    """
+    Yields (object, message) for every line of a stream of JSON objects; blank lines are skipped
+    """
+    for number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+
+        try:
+            yield json.loads(line.decode('utf-8')), ["OK", True]
+        except ValueError as e:
+            yield None, ["Line {} is not valid JSON: {}".format(number, e), False]
+            return
+
+
+def read_json_observations(payload):
+    for entry in payload.get('observations') or []:
+        yield entry, ["OK", True]
+
+
+def parse_bulk_entry(entry, column, default_coordinate, summary, rows=None):
+    """
+    Returns (observation map, dataframe with date_time, value, longitude and latitude, message)
+    for an observation object. Rows with an invalid datetime or value are rejected;
+    rows are the row numbers of the values in error reports
+    """
+    if not isinstance(entry, dict):
+        return None, None, ['Observation {} should be a JSON object'.format(column), False]
+
+    try:
+        context_type = ObservedContextType(entry.get('type'))
+    except ValueError:
+        return None, None, ['Data type {} of observation {} is not supported. '
+                            'Available data types: {}'.format(entry.get('type'), column,
+                                                              ObservedContextType.list()), False]
+
+    obs_map = {
+        "column": column,
+        "context_type": context_type,
+        "context": get_dict_value(entry, 'context'),
+        "parameter": get_dict_value(entry, 'parameter'),
+        "unit": get_dict_value(entry, 'unit'),
+        "conditions": get_dict_value(entry, 'conditions')
+    }
+
+    date_time = entry.get('date_time')
+    values = entry.get('value')
+
+    if not isinstance(date_time, list) or not isinstance(values, list) or len(date_time) != len(values):
+        return None, None, ['Observation {} should have date_time and value arrays '
+                            'of the same length'.format(column), False]
+
+    # Row numbers continue over the observations of a request
+    index = pd.RangeIndex(summary["rows"], summary["rows"] + len(values))
+    rows = index if rows is None else pd.Index(rows)
+
+    df = pd.DataFrame({
+        "date_time": to_bulk_datetime(pd.Series(date_time, index=index, dtype=object)),
+        "value": pd.to_numeric(pd.Series(values, index=index, dtype=object), errors='coerce')
+    }, index=index)
+
+    for axis in ["longitude", "latitude"]:
+        coordinates = entry.get(axis, default_coordinate.get(axis))
+
+        if isinstance(coordinates, list):
+            if len(coordinates) != len(values):
+                return None, None, ['Observation {} should have as many {} as value items'
+                                    .format(column, axis), False]
+
+            # Values that are not numbers are stored without a location
+            df[axis] = pd.to_numeric(pd.Series(coordinates, index=index, dtype=object), errors='coerce')
+        else:
+            try:
+                df[axis] = float(coordinates)
+            except (TypeError, ValueError):
+                return None, None, ['Observation {} should have longitude and latitude values '
+                                    'or default coordinates'.format(column), False]
+
+    obs_summary = summary["observations"].setdefault(column, init_bulk_observation_summary())
+    obs_summary["rows"] += len(df.index)
+    summary["rows"] += len(df.index)
+
+    invalid_time = df["date_time"].isna()
+    invalid_value = df["value"].isna() & ~invalid_time
+
+    if invalid_time.any():
+        summary["rejected_rows"] += int(invalid_time.sum())
+        add_row_errors(summary, rows[invalid_time.values], "Invalid datetime")
+
+    if invalid_value.any():
+        obs_summary["rejected"] += int(invalid_value.sum())
+        add_row_errors(summary, rows[invalid_value.values], "Invalid value in observation {}".format(column))
+
+    return obs_map, df.loc[~(invalid_time | invalid_value)], ["OK", True]
+
+
+def to_bulk_datetime(series):
+    """
+    Parses timestamps: numbers are Unix times in seconds, strings are parsed like
+    datetime columns (ISO 8601 recommended); times with an offset are converted to UTC
+    """
+    numbers = pd.to_numeric(series, errors='coerce')
+
+    if len(series.index) and numbers.notna().all():
+        return pd.to_datetime(numbers, unit='s', errors='coerce')
+
+    dtime = pd.to_datetime(series, errors='coerce', utc=True)
+
+    return dtime.dt.tz_convert(None)
+
+
+def load_bulk_batch(batch, field_dict, equipment_id, accessibility, loader, summary, observation_ids=None):
+    """
+    Resolves the observations of a batch and stores all of its rows with one load.
+    Observations in observation_ids ({column: observation_id}) are not resolved again.
+    Returns (None, True), or (error response, False) if the observations cannot be resolved;
+    a failing load is reported in the summary
+    """
+    if observation_ids is None:
+        observation_ids = {}
+
+    pending = {}
+    obs_maps = [obs_map for obs_map, df in batch if obs_map["column"] not in observation_ids]
+    nr_rows = sum(len(df.index) for obs_map, df in batch)
+
+    try:
+        if obs_maps:
+            generation = check_dimension_generation()
+            obs_response, is_ok = resolve_observation_maps(obs_maps, field_dict, equipment_id,
+                                                           accessibility, pending)
+            if not is_ok:
+                db.session.rollback()
+                return (jsonify({'message': obs_response[0].get_json()['message'], 'summary': summary}),
+                        obs_response[-1]), False
+
+            db.session.commit()
+            dimension_cache.update(pending, generation)
+
+            for obs_map in obs_maps:
+                summary["observations"][obs_map["column"]]["observation_id"] = obs_response[obs_map["column"]]
+
+            observation_ids.update(obs_response)
+
+        df_data = pd.concat([df.assign(observation_id=observation_ids[obs_map["column"]])
+                             for obs_map, df in batch], ignore_index=True)
+
+        inserted = store_sensing_log(db.session.connection(), df_data, loader) if nr_rows else 0
+        db.session.commit()
+
+        # Rows that are already stored (uix_sensing) are skipped and counted as duplicates
+        summary["inserted"] += inserted
+        summary["duplicate"] += nr_rows - inserted
+    except (exc.SQLAlchemyError, psycopg2.Error) as e:
+        db.session.rollback()
+        summary["failed"] += nr_rows
+        summary["error"] = str(e)
+
+    summary["chunks"] += 1
+
+    return None, True
+
+
+def store_observation_stream(stream, default_coordinate, field_dict,
+                             equipment_id, accessibility, loader=None):
+    """
+    Stores the readings of a long-lived NDJSON push stream until the client ends it.
+    Every line is one reading (date_time and value) or several (date_time and value arrays)
+    of an observation. Lines are read in a separate thread, so buffered readings are also
+    stored when the client is idle. Invalid lines are reported and skipped
+    """
+    observations = ObservationStream(default_coordinate, field_dict, equipment_id, accessibility, loader)
+    summary = observations.summary
+
+    lines = queue.Queue(maxsize=observations.batch_size)
+    stopped = threading.Event()
+
+    reader = threading.Thread(target=read_stream_lines, args=(stream, lines, stopped))
+    reader.daemon = True
+    reader.start()
+
+    number = 0
+
+    try:
+        while True:
+            try:
+                line = lines.get(timeout=observations.get_wait_time())
+            except queue.Empty:
+                line = b''
+
+            if line is None:
+                break
+
+            if line.strip():
+                number += 1
+
+                try:
+                    msg = observations.add(json.loads(line.decode('utf-8')), number)
+                except ValueError as e:
+                    msg = ["Line {} is not valid JSON: {}".format(number, e), False]
+
+                if msg[-1] is False:
+                    summary["rejected_rows"] += 1
+                    add_row_errors(summary, [number - 1], msg[0])
+
+            if observations.is_due():
+                response, is_ok = observations.flush()
+                if not is_ok:
+                    return response
+
+        response, is_ok = observations.flush()
+        if not is_ok:
+            return response
+    finally:
+        stopped.set()
+
+    if summary["failed"]:
+        message = 'Failed to load {} row(s)'.format(summary["failed"])
+    else:
+        message = 'OK'
+
+    return jsonify({'message': message, 'lines': number, 'summary': summary}), 200
+
+
+def read_stream_lines(stream, lines, stopped):
+    """
+    Puts the lines of a request stream in a queue, followed by None when the stream ends
+    """
+    def put(item):
+        # The queue is bounded, so a client that sends faster than readings are stored waits
+        while not stopped.is_set():
+            try:
+                lines.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    try:
+        for line in stream:
+            if not put(line):
+                return
+    except ClientDisconnected:
+        pass
+    finally:
+        put(None)
+
+
+class ObservationStream(object):
+    """
+    Buffers the readings of a push stream per observation and stores them in micro-batches:
+    when INGEST_STREAM_BATCH_SIZE readings are buffered, or INGEST_STREAM_FLUSH_INTERVAL
+    seconds after the first buffered reading was received
+    """
+
+    def __init__(self, default_coordinate, field_dict, equipment_id, accessibility, loader=None):
+        self.default_coordinate = default_coordinate
+        self.field_dict = field_dict
+        self.equipment_id = equipment_id
+        self.accessibility = accessibility
+        self.loader = loader
+
+        self.batch_size = app.config.get('INGEST_STREAM_BATCH_SIZE', 1000)
+        self.flush_interval = app.config.get('INGEST_STREAM_FLUSH_INTERVAL', 1)
+
+        self.summary = init_bulk_summary()
+
+        # Column of every observation in the stream, and the observation IDs of the stored ones
+        # in the dimension generation they were resolved in
+        self.columns = {}
+        self.observation_ids = {}
+        self.generation = None
+
+        self.buffers = {}
+        self.buffered = 0
+        self.first_buffered_at = None
+
+    def add(self, entry, number):
+        """
+        Buffers the readings of line number; returns a message
+        """
+        if not isinstance(entry, dict):
+            return ['Line {} should be a JSON object'.format(number), False]
+
+        try:
+            ObservedContextType(entry.get('type'))
+        except ValueError:
+            return ['Data type {} on line {} is not supported'.format(entry.get('type'), number), False]
+
+        date_time = entry.get('date_time')
+        values = entry.get('value')
+
+        if not isinstance(values, list):
+            date_time, values = [date_time], [values]
+
+        if not isinstance(date_time, list) or len(date_time) != len(values):
+            return ['Line {} should have a date_time for every value'.format(number), False]
+
+        coordinates = {}
+        for axis in ["longitude", "latitude"]:
+            coordinate = entry.get(axis, self.default_coordinate.get(axis))
+
+            if isinstance(coordinate, list):
+                if len(coordinate) != len(values):
+                    return ['Line {} should have as many {} as value items'.format(number, axis), False]
+            else:
+                try:
+                    coordinate = [float(coordinate)] * len(values)
+                except (TypeError, ValueError):
+                    return ['Line {} should have longitude and latitude values '
+                            'or default coordinates'.format(number), False]
+
+            coordinates[axis] = coordinate
+
+        observation = dict((key, entry.get(key)) for key in STREAM_OBSERVATION_KEYS)
+        column = self.columns.setdefault(json.dumps(observation, sort_keys=True), str(len(self.columns)))
+
+        buffer = self.buffers.get(column)
+        if buffer is None:
+            buffer = self.buffers[column] = dict(observation, date_time=[], value=[],
+                                                 longitude=[], latitude=[], rows=[])
+
+        buffer["date_time"] += date_time
+        buffer["value"] += values
+        buffer["longitude"] += coordinates["longitude"]
+        buffer["latitude"] += coordinates["latitude"]
+        buffer["rows"] += [number - 1] * len(values)
+
+        self.buffered += len(values)
+
+        if self.first_buffered_at is None:
+            self.first_buffered_at = time.time()
+
+        return ["OK", True]
+
+    def get_wait_time(self):
+        """
+        Seconds until the buffered readings are due, or None if there are none
+        """
+        if self.first_buffered_at is None:
+            return None
+
+        return max(self.first_buffered_at + self.flush_interval - time.time(), 0)
+
+    def is_due(self):
+        return self.buffered >= self.batch_size or self.get_wait_time() == 0
+
+    def flush(self):
+        """
+        Stores the buffered readings as one batch; returns the result of load_bulk_batch
+        """
+        if not self.buffers:
+            return None, True
+
+        batch = []
+        for column, buffer in self.buffers.items():
+            obs_map, df, msg = parse_bulk_entry(buffer, column, self.default_coordinate,
+                                                self.summary, buffer["rows"])
+            if msg[-1] is False:
+                self.summary["rejected_rows"] += len(buffer["rows"])
+                add_row_errors(self.summary, buffer["rows"], msg[0])
+                continue
+
+            batch.append((obs_map, df))
+
+        self.buffers = {}
+        self.buffered = 0
+        self.first_buffered_at = None
+
+        if not batch:
+            return None, True
+
+        # Observations are resolved again after dimension rows were deleted or changed
+        generation = check_dimension_generation()
+        if generation != self.generation:
+            self.observation_ids = {}
+            self.generation = generation
+
+        return load_bulk_batch(batch, self.field_dict, self.equipment_id, self.accessibility,
+                               self.loader, self.summary, self.observation_ids)
+
+
+def init_bulk_summary():
+    return {
+        "chunks": 0,
+        "rows": 0,
+        "rejected_rows": 0,
+        "inserted": 0,
+        "duplicate": 0,
+        "failed": 0,
+        "error": None,
+        "observations": {},
+        "errors": [],
+    }
+
+
+def init_bulk_observation_summary():
+    return {
+        "observation_id": None,
+        "rows": 0,
+        "rejected": 0,
+    }
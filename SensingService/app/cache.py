@@ -0,0 +1,78 @@
+from collections import OrderedDict
+import threading
+
+
+class LRUCache(object):
+    """
+    Thread-safe dictionary that keeps at most max_size of the most recently used items
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def set(self, key, value):
+        with self.lock:
+            self.store(key, value)
+
+    def update(self, items):
+        with self.lock:
+            for key, value in items.items():
+                self.store(key, value)
+
+    def store(self, key, value):
+        # The lock is held by the caller
+        self.items[key] = value
+        self.items.move_to_end(key)
+
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def invalidate(self, predicate=None):
+        """
+        Removes all items, or only the items whose key matches the predicate
+        """
+        with self.lock:
+            if predicate is None:
+                self.items.clear()
+            else:
+                for key in [key for key in self.items if predicate(key)]:
+                    del self.items[key]
+
+    def __len__(self):
+        return len(self.items)
+
+
+class GenerationCache(LRUCache):
+    """
+    LRUCache of values that belong to a generation of a counter shared by all processes.
+    Items are removed when a newer generation is seen, and items that were read in
+    another generation than the current one are not stored
+    """
+
+    def __init__(self, max_size):
+        super(GenerationCache, self).__init__(max_size)
+        self.generation = None
+
+    def set_generation(self, generation):
+        with self.lock:
+            if generation != self.generation:
+                self.items.clear()
+                self.generation = generation
+
+    def update(self, items, generation=None):
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+
+            for key, value in items.items():
+                self.store(key, value)
@@ -0,0 +1,391 @@
+from app import app, db
+from flask import jsonify
+from sqlalchemy import exc
+from werkzeug.utils import secure_filename
+from datetime import datetime, timedelta
+import io
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import uuid
+from .models import IngestJob, IngestJobStatus, UploadSession, UploadSessionStatus
+from .utils import check_observation_file, get_file_ext, ingest_observations, save_file, hash_file, \
+    get_upload_fingerprint, get_fingerprint_result
+
+
+class IngestJobQueue(object):
+    """
+    Runs observation ingest jobs in a pool of local worker processes.
+    At most max_pending jobs are accepted (running and waiting) at the same time, and at most
+    max_eager of them ingest uploads while they are received (they hold a worker for the whole upload).
+    A worker process is replaced after max_tasks jobs (0 keeps it). A job whose worker
+    was killed never completes in the pool, so a reaper thread fails jobs that were not
+    updated in time (see fail_orphaned_jobs) and frees their place in the queue
+    """
+
+    def __init__(self, workers, max_pending, max_eager, max_tasks=0):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_eager = max_eager
+        self.max_tasks = max_tasks
+        self.pending = {}
+        self.eager = set()
+        self.pool = None
+        self.reaper = None
+        self.lock = threading.Lock()
+
+    def is_full(self):
+        return len(self.pending) >= self.max_pending
+
+    def submit(self, job_id, func, args, path=None, eager=False):
+        """
+        Queues func(*args) as job job_id and returns False if the queue is full.
+        path is the spooled file of the job, removed if the job is failed by the reaper
+        """
+        with self.lock:
+            if self.is_full() or (eager and len(self.eager) >= self.max_eager):
+                return False
+
+            if eager:
+                self.eager.add(job_id)
+
+            if self.pool is None:
+                # Spawned workers do not share the database connections of this process
+                self.pool = multiprocessing.get_context('spawn').Pool(processes=self.workers,
+                                                                      maxtasksperchild=self.max_tasks or None)
+
+                self.reaper = threading.Thread(target=self.reap)
+                self.reaper.daemon = True
+                self.reaper.start()
+
+            self.pending[job_id] = path
+
+        def done(result):
+            self.done(job_id)
+
+        self.pool.apply_async(func, args, callback=done, error_callback=done)
+        return True
+
+    def done(self, job_id):
+        with self.lock:
+            self.eager.discard(job_id)
+            return self.pending.pop(job_id, None)
+
+    def reap(self):
+        while True:
+            time.sleep(app.config.get('INGEST_JOB_HEARTBEAT', 30))
+
+            with app.app_context():
+                try:
+                    self.reap_jobs()
+                except Exception as e:
+                    app.logger.error('Failed to check ingest jobs: {}'.format(e))
+
+    def reap_jobs(self):
+        with self.lock:
+            job_ids = list(self.pending)
+
+        # Jobs that wait for a worker are kept alive by this process, running jobs by their worker
+        if job_ids:
+            table = IngestJob.__table__
+            db.engine.execute(table.update()
+                              .where(table.c.id.in_(job_ids))
+                              .where(table.c.status == IngestJobStatus.QUEUED)
+                              .values(updated_at=datetime.utcnow()))
+
+        for job_id in fail_orphaned_jobs():
+            path = self.done(job_id)
+
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+
+
+job_queue = IngestJobQueue(app.config.get('INGEST_WORKERS', 2),
+                           app.config.get('INGEST_WORKERS', 2) + app.config.get('INGEST_JOB_QUEUE_SIZE', 8),
+                           app.config.get('INGEST_MAX_EAGER_UPLOADS', 1),
+                           app.config.get('INGEST_WORKER_MAX_TASKS', 0))
+
+
+def fail_orphaned_jobs(job_id=None):
+    """
+    Fails the queued and running jobs (or job job_id) that were not updated within
+    INGEST_JOB_TIMEOUT seconds: their worker was killed or the process that queued them
+    stopped. Returns the IDs of the failed jobs
+    """
+    table = IngestJob.__table__
+    now = datetime.utcnow()
+    deadline = now - timedelta(seconds=app.config.get('INGEST_JOB_TIMEOUT', 300))
+
+    query = table.update() \
+        .where(table.c.status.in_([IngestJobStatus.QUEUED, IngestJobStatus.RUNNING])) \
+        .where(table.c.updated_at < deadline) \
+        .values(status=IngestJobStatus.FAILED, updated_at=now,
+                message='The ingest was interrupted, upload the file again') \
+        .returning(table.c.id)
+
+    if job_id is not None:
+        query = query.where(table.c.id == job_id)
+
+    job_ids = [row[0] for row in db.engine.execute(query)]
+
+    if job_ids:
+        reopen_uploads(job_ids=job_ids)
+
+    return job_ids
+
+
+def reopen_uploads(upload_id=None, job_ids=None):
+    """
+    Opens the upload session upload_id (or the sessions of jobs job_ids) again after its
+    ingest failed, so its kept file can be finalized again without uploading it again.
+    Aborted sessions are not opened. Returns the number of opened sessions
+    """
+    table = UploadSession.__table__
+    query = table.update() \
+        .where(table.c.status != UploadSessionStatus.ABORTED) \
+        .values(status=UploadSessionStatus.OPEN, job_id=None, updated_at=datetime.utcnow())
+
+    if upload_id is not None:
+        query = query.where(table.c.id == upload_id)
+    else:
+        query = query.where(table.c.job_id.in_(job_ids))
+
+    return db.engine.execute(query).rowcount
+
+
+def queue_observation(file, plan,
+                      default_coordinate, field_dict,
+                      equipment_id, default_time,
+                      accessibility, loader=None, force=False):
+    """
+    Saves an uploaded observation file and queues it as an ingest job (202 with the job ID).
+    An identical earlier upload is answered with its result, unless force is set
+    """
+    response, is_ok = check_observation_file(file.filename, loader)
+    if not is_ok:
+        return response
+
+    if job_queue.is_full():
+        return jsonify({'message': 'Too many uploads in progress, try again later'}), 503, \
+               {'Retry-After': str(app.config.get('INGEST_RETRY_AFTER', 30))}
+
+    filetype = get_file_ext(secure_filename(file.filename))
+
+    # Workers read the file from the spool directory and remove it when they are done
+    spooled = tempfile.NamedTemporaryFile(dir=app.config.get('INGEST_SPOOL_DIR'),
+                                          suffix='.' + filetype, delete=False)
+    digest = save_file(file, spooled)
+    spooled.close()
+
+    fingerprint = get_upload_fingerprint(digest, plan, default_coordinate,
+                                         equipment_id, default_time, accessibility)
+    result = None if force else get_fingerprint_result(fingerprint, plan, field_dict)
+
+    if result is not None:
+        os.remove(spooled.name)
+        return jsonify(result), 200
+
+    job = queue_ingest_job(spooled.name, filetype, plan,
+                           default_coordinate, field_dict,
+                           equipment_id, default_time,
+                           accessibility, loader, fingerprint=fingerprint)
+
+    if job is None:
+        os.remove(spooled.name)
+        return jsonify({'message': 'Too many uploads in progress, try again later'}), 503, \
+               {'Retry-After': str(app.config.get('INGEST_RETRY_AFTER', 30))}
+
+    return jsonify({'message': 'Accepted', 'job_id': job.id}), 202
+
+
+def queue_ingest_job(path, filetype, plan,
+                     default_coordinate, field_dict,
+                     equipment_id, default_time,
+                     accessibility, loader=None, upload_id=None, fingerprint=None, eager=False):
+    """
+    Creates an ingest job for a spooled observation file and queues it.
+    With an upload_id the file is the one of an upload session, kept if the ingest fails;
+    with eager the file is read while the session is still receiving it.
+    Returns the job or None if the queue (or the number of eager jobs) is full
+    """
+    job = IngestJob(str(uuid.uuid4()), field_dict['farm_id'])
+    db.session.add(job)
+    db.session.commit()
+
+    args = (job.id, path, filetype, plan,
+            default_coordinate, field_dict,
+            equipment_id, default_time,
+            accessibility, loader, upload_id, fingerprint)
+
+    # Files of upload sessions are kept for the session when the job fails
+    if not job_queue.submit(job.id, run_ingest_job, args, path if upload_id is None else None, eager):
+        db.session.delete(job)
+        db.session.commit()
+        return None
+
+    return job
+
+
+def run_ingest_job(job_id, path, filetype, plan,
+                   default_coordinate, field_dict,
+                   equipment_id, default_time,
+                   accessibility, loader=None, upload_id=None, fingerprint=None):
+    """
+    Ingests a spooled observation file in a worker process and records the progress in the job.
+    The file is removed afterwards, unless it belongs to an upload session that can be finalized
+    again because the ingest failed
+    """
+    with app.app_context():
+        update_job(job_id, status=IngestJobStatus.RUNNING)
+
+        # The job is failed as orphaned if this process stops updating it
+        stopped = threading.Event()
+        heartbeat = threading.Thread(target=beat_job, args=(job_id, stopped))
+        heartbeat.daemon = True
+        heartbeat.start()
+
+        def progress(summary):
+            update_job(job_id, rows=summary["rows"], summary=summary)
+
+        succeeded = False
+
+        if upload_id is not None and fingerprint is None:
+            # The file of an upload session is complete once it has been read
+            def fingerprint():
+                return get_upload_fingerprint(hash_file(path), plan, default_coordinate,
+                                              equipment_id, default_time, accessibility)
+
+        try:
+            with open_job_file(path, upload_id) as file:
+                result, code = ingest_observations(file, filetype, plan,
+                                                   default_coordinate, field_dict,
+                                                   equipment_id, default_time,
+                                                   accessibility, loader, progress, fingerprint)
+
+            succeeded = code == 200
+
+            summary = result.get('summary')
+            status = IngestJobStatus.FINISHED if succeeded else IngestJobStatus.FAILED
+            update_job(job_id, status=status, message=result['message'],
+                       rows=summary['rows'] if summary else 0, summary=summary)
+        except Exception as e:
+            db.session.rollback()
+            update_job(job_id, status=IngestJobStatus.FAILED,
+                       message='Failed to store observations with error:\n{}'.format(e))
+        finally:
+            stopped.set()
+            heartbeat.join()
+            db.session.remove()
+
+            if succeeded or upload_id is None or not reopen_uploads(upload_id=upload_id):
+                os.remove(path)
+
+
+def beat_job(job_id, stopped):
+    with app.app_context():
+        while not stopped.wait(app.config.get('INGEST_JOB_HEARTBEAT', 30)):
+            try:
+                update_job(job_id)
+            except exc.SQLAlchemyError:
+                pass
+
+
+def update_job(job_id, **values):
+    # Own connection and transaction, so progress is visible while the ingest transaction is open
+    values['updated_at'] = datetime.utcnow()
+    db.engine.execute(IngestJob.__table__.update()
+                      .where(IngestJob.__table__.c.id == job_id)
+                      .values(**values))
+
+
+def open_job_file(path, upload_id=None):
+    if upload_id is None:
+        return open(path, 'rb')
+
+    return GrowingFileReader(path, upload_id)
+
+
+class GrowingFileReader(io.RawIOBase):
+    """
+    Reads the file of an upload session while it is being uploaded.
+    A read waits until the requested bytes have been received or the session is finalized,
+    or until the reader is stopped
+    """
+
+    def __init__(self, path, upload_id):
+        super(GrowingFileReader, self).__init__()
+        self.file = open(path, 'rb')
+        self.upload_id = upload_id
+        self.received = 0
+        self.status = UploadSessionStatus.OPEN
+        self.last_change = time.time()
+        self.stopped = threading.Event()
+
+    def stop(self):
+        """
+        Stops waiting for the upload, e.g. when the ingest failed: a waiting read raises IOError
+        """
+        self.stopped.set()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self.file.seek(offset, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+    def read(self, size=-1):
+        while self.status == UploadSessionStatus.OPEN:
+            if size is not None and 0 <= size <= self.received - self.file.tell():
+                break
+
+            if not self.refresh():
+                if time.time() - self.last_change > app.config.get('INGEST_UPLOAD_TIMEOUT', 3600):
+                    raise IOError('Upload {} received no data in time'.format(self.upload_id))
+
+                if self.stopped.wait(app.config.get('INGEST_UPLOAD_POLL_INTERVAL', 1)):
+                    raise IOError('Reading upload {} was stopped'.format(self.upload_id))
+
+        if self.status == UploadSessionStatus.ABORTED:
+            raise IOError('Upload {} was aborted'.format(self.upload_id))
+
+        return self.file.read(size)
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def refresh(self):
+        """
+        Reads the received size and status of the upload session, returns True if they changed
+        """
+        table = UploadSession.__table__
+        row = db.engine.execute(table.select()
+                                .with_only_columns([table.c.received, table.c.status])
+                                .where(table.c.id == self.upload_id)).first()
+
+        if row is None:
+            received, status = self.received, UploadSessionStatus.ABORTED
+        else:
+            received, status = row
+
+        if received == self.received and status == self.status:
+            return False
+
+        self.received = received
+        self.status = status
+        self.last_change = time.time()
+
+        return True
+
+    def close(self):
+        self.file.close()
+        super(GrowingFileReader, self).close()
@@ -2,6 +2,7 @@ from app import db
 from sqlalchemy_utils import EmailType, URLType
 from sqlalchemy.dialects.postgresql import JSONB
 from geoalchemy2 import Geometry
+from datetime import datetime
 import enum
 
 
@@ -18,6 +19,19 @@ class ObservedContextType(ExtendedEnum):
     TREATMENT = "treatment"
 
 
+class IngestJobStatus(ExtendedEnum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    FINISHED = "finished"
+    FAILED = "failed"
+
+
+class UploadSessionStatus(ExtendedEnum):
+    OPEN = "open"
+    FINALIZED = "finalized"
+    ABORTED = "aborted"
+
+
 class OwnerType(ExtendedEnum):
     FARM = "farm"
     USER = "user"
@@ -273,7 +287,8 @@ class SensingLog(db.Model):
     value = db.Column(db.Float, nullable=False)
     geo = db.Column(Geometry(geometry_type="POINT"))
     __table_args__ = (db.UniqueConstraint('observation_id', 'date_time', 'value', 'geo',
-                                          name='uix_sensing'),)
+                                          name='uix_sensing'),
+                      db.Index('ix_sensing_log_date_time', 'date_time', 'observation_id'))
 
     def __init__(self, obs_id, dtime, value, geo):
         self.observation_id = obs_id
@@ -282,6 +297,143 @@ class SensingLog(db.Model):
         self.geo = geo
 
 
+class SensingLogLoad(db.Model):
+    """
+    Sensing log rows that the load workers of an upload stored on their own connections
+    (INGEST_LOAD_WORKERS > 1); they are moved to sensing_log when the upload is committed
+    """
+    id = db.Column(db.BigInteger, autoincrement=True, primary_key=True)
+    load_id = db.Column(db.String(32), nullable=False)
+    observation_id = db.Column(db.Integer, nullable=False)
+    date_time = db.Column(db.DateTime, nullable=False)
+    value = db.Column(db.Float, nullable=False)
+    longitude = db.Column(db.Float)
+    latitude = db.Column(db.Float)
+    created_at = db.Column(db.DateTime, server_default=db.func.now(), nullable=False)
+    __table_args__ = (db.Index('ix_sensing_log_load_load_id', 'load_id'),
+                      {'prefixes': ['UNLOGGED']})
+
+
+class IngestJob(db.Model):
+    id = db.Column(db.String(36), primary_key=True)
+    farm_id = db.Column(db.Integer, db.ForeignKey('farm.id', ondelete='CASCADE'), nullable=False)
+    status = db.Column(db.Enum(IngestJobStatus), default=IngestJobStatus.QUEUED, nullable=False)
+    rows = db.Column(db.Integer, default=0, nullable=False)
+    message = db.Column(db.Text)
+    summary = db.Column(JSONB)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def __init__(self, id, farm_id):
+        self.id = id
+        self.farm_id = farm_id
+        self.status = IngestJobStatus.QUEUED
+        self.rows = 0
+
+    def to_json(self):
+        return {
+            'job_id': self.id,
+            'farm_id': self.farm_id,
+            'status': self.status.value,
+            'rows': self.rows,
+            'message': self.message,
+            'summary': self.summary,
+            'created_at': self.created_at.strftime("%Y-%m-%d %H:%M:%S"),
+            'updated_at': self.updated_at.strftime("%Y-%m-%d %H:%M:%S")
+        }
+
+
+class UploadSession(db.Model):
+    id = db.Column(db.String(36), primary_key=True)
+    farm_id = db.Column(db.Integer, db.ForeignKey('farm.id', ondelete='CASCADE'), nullable=False)
+    field_id = db.Column(db.Integer, nullable=False)
+    crop_field_id = db.Column(db.Integer)
+    map_id = db.Column(db.Integer, nullable=False)
+    equipment_id = db.Column(db.Integer)
+    accessibility = db.Column(db.String(50), nullable=False)
+    default_time = db.Column(db.String(50))
+    longitude = db.Column(db.String(50))
+    latitude = db.Column(db.String(50))
+    loader = db.Column(db.String(10))
+    filetype = db.Column(db.String(10), nullable=False)
+    path = db.Column(db.Text, nullable=False)
+    size = db.Column(db.BigInteger)
+    received = db.Column(db.BigInteger, default=0, nullable=False)
+    status = db.Column(db.Enum(UploadSessionStatus), default=UploadSessionStatus.OPEN, nullable=False)
+    job_id = db.Column(db.String(36), db.ForeignKey('ingest_job.id', ondelete='SET NULL'))
+    # PUT request that is writing a byte range, and when it last reported it is still writing
+    write_id = db.Column(db.String(36))
+    write_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def __init__(self, id, farm_id, field_id, crop_field_id, map_id, equipment_id, accessibility,
+                 default_time, longitude, latitude, loader, filetype, path, size):
+        self.id = id
+        self.farm_id = farm_id
+        self.field_id = field_id
+        self.crop_field_id = crop_field_id
+        self.map_id = map_id
+        self.equipment_id = equipment_id
+        self.accessibility = accessibility
+        self.default_time = default_time
+        self.longitude = longitude
+        self.latitude = latitude
+        self.loader = loader
+        self.filetype = filetype
+        self.path = path
+        self.size = size
+        self.received = 0
+        self.status = UploadSessionStatus.OPEN
+
+    def to_json(self):
+        return {
+            'upload_id': self.id,
+            'farm_id': self.farm_id,
+            'status': self.status.value,
+            'offset': self.received,
+            'size': self.size,
+            'job_id': self.job_id,
+            'created_at': self.created_at.strftime("%Y-%m-%d %H:%M:%S"),
+            'updated_at': self.updated_at.strftime("%Y-%m-%d %H:%M:%S")
+        }
+
+
+class DimensionGeneration(db.Model):
+    """
+    Counter (a single row) that is increased when dimension rows are deleted or changed,
+    so every process that caches dimension IDs knows its cache is stale
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    generation = db.Column(db.BigInteger, nullable=False)
+
+    def __init__(self, id, generation):
+        self.id = id
+        self.generation = generation
+
+
+class UploadFingerprint(db.Model):
+    id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    farm_id = db.Column(db.Integer, db.ForeignKey('farm.id', ondelete='CASCADE'), nullable=False)
+    field_id = db.Column(db.Integer, nullable=False)
+    crop_field_id = db.Column(db.Integer)
+    map_id = db.Column(db.Integer, nullable=False)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    message = db.Column(db.Text)
+    summary = db.Column(JSONB)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    __table_args__ = (db.Index('ix_upload_fingerprint', 'farm_id', 'field_id', 'map_id', 'fingerprint'),)
+
+    def __init__(self, farm_id, field_id, crop_field_id, map_id, fingerprint, message, summary):
+        self.farm_id = farm_id
+        self.field_id = field_id
+        self.crop_field_id = crop_field_id
+        self.map_id = map_id
+        self.fingerprint = fingerprint
+        self.message = message
+        self.summary = summary
+
+
 class Equipment(db.Model):
     id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     name = db.Column(db.String(50), index=True, nullable=False)
@@ -0,0 +1,166 @@
+from app import app
+from flask import jsonify, json
+import hashlib
+import time
+from .api.MappingApi import MappingApi
+from .cache import LRUCache
+from .models import ObservedContextType
+from .utils import get_dict_value, get_datetime_format, is_dayfirst
+
+
+# Compiled ingest plans by (map ID, datamap version)
+ingest_plans = LRUCache(app.config.get('INGEST_PLAN_CACHE_SIZE', 256))
+
+# Latest datamap version of a map ID and when it was fetched from the mapping service
+plan_versions = LRUCache(app.config.get('INGEST_PLAN_CACHE_SIZE', 256))
+
+
+class IngestPlan(object):
+    """
+    Everything an upload needs from a datamap, worked out once:
+    the columns to read and their dtypes, how to build the date_time and
+    coordinate columns, and the observation of every data column
+    """
+
+    def __init__(self, map_id, version, datamap):
+        self.map_id = map_id
+        self.version = version
+
+        self.has_header = datamap.get("has_header", False)
+        self.has_date = datamap.get("has_date", False)
+        self.has_time = datamap.get("has_time", False)
+        self.has_coordinate = datamap.get("has_coordinate", False)
+
+        self.columns = []
+        self.dtypes = {}
+        self.datetime = {}
+        self.coordinate = {}
+        self.observations = []
+
+        # Who may read the datamap (see the datamap GET in the mapping service)
+        self.accessibility = datamap.get("accessibility")
+        self.owner = datamap.get("owner") or {}
+
+
+def get_ingest_plan(map_id, headers, is_admin=False, user_id=None, farm_list=None):
+    """
+    Returns (plan, None) or (None, error response) for a datamap ID.
+    Within INGEST_PLAN_TTL seconds of the last fetch the datamap is not fetched again, unless
+    the user may not read the cached plan; then the mapping service decides if the user may read it.
+    Afterwards a datamap with unchanged content reuses its compiled plan
+    """
+    map_id = str(map_id)
+    latest = plan_versions.get(map_id)
+
+    if latest and time.time() - latest[1] < app.config.get('INGEST_PLAN_TTL', 60):
+        plan = ingest_plans.get((map_id, latest[0]))
+
+        if plan is not None and is_plan_allowed(plan, is_admin, user_id, farm_list):
+            return plan, None
+
+    datamap = MappingApi.get_datamap_by_id(map_id, headers)
+    if not datamap:
+        return None, (jsonify({'message': 'Datamap ID {} not found'.format(map_id)}), 400)
+
+    version = get_datamap_version(datamap)
+    plan = ingest_plans.get((map_id, version))
+
+    if plan is None:
+        plan, msg = compile_ingest_plan(map_id, version, datamap)
+        if msg[-1] is False:
+            return None, (jsonify({'message': msg[0]}), 400)
+
+        ingest_plans.set((map_id, version), plan)
+
+    plan_versions.set(map_id, (version, time.time()))
+
+    return plan, None
+
+
+def get_datamap_version(datamap):
+    # Datamaps have no revision number, so the version is a hash of their content
+    content = json.dumps(datamap, sort_keys=True)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def compile_ingest_plan(map_id, version, datamap):
+    """
+    Returns (plan, message) for a datamap, or (None, message) if the datamap is invalid
+    """
+    plan = IngestPlan(map_id, version, datamap)
+    msg = ["OK", True]
+
+    for dmap in datamap.get("maps") or []:
+        col_name = dmap.get('column')
+
+        if not plan.has_header:
+            try:
+                if int(col_name) < 1:
+                    msg = ['Datamap column should start from 1', False]
+                    return None, msg
+            except (TypeError, ValueError):
+                msg = ['Column {} in datamap should be an integer'.format(col_name), False]
+                return None, msg
+
+        col_name = str(col_name)
+        plan.columns.append(col_name)
+
+        observation_map = dmap.get('observation') or {}
+        data_type = observation_map.get('type')
+        context = observation_map.get('context')
+
+        if data_type == 'datetime':
+            if plan.has_date or plan.has_time or plan.has_coordinate:
+                param = observation_map.get('parameter')
+
+                plan.datetime[context] = {"column": col_name,
+                                          "parameter": param,
+                                          "format": get_datetime_format(param),
+                                          "dayfirst": is_dayfirst(param)}
+
+            # Date parts are parsed from text, e.g. '03' or 'Mar'
+            plan.dtypes[col_name] = 'str'
+
+        elif data_type == 'coordinate':
+            if plan.has_date or plan.has_time or plan.has_coordinate:
+                plan.coordinate[context] = col_name
+
+            plan.dtypes[col_name] = 'float64'
+
+        else:
+            try:
+                context_type = ObservedContextType(data_type)
+            except ValueError:
+                msg = ['Data type {} in datamap is not supported. '
+                       'Available data types: {}'.format(data_type, ObservedContextType.list()), False]
+                return None, msg
+
+            plan.observations.append({
+                "column": col_name,
+                "context_type": context_type,
+                "context": context,
+                "parameter": get_dict_value(observation_map, 'parameter'),
+                "unit": get_dict_value(observation_map, 'unit'),
+                "conditions": get_dict_value(observation_map, 'conditions')
+            })
+
+            plan.dtypes[col_name] = app.config.get('INGEST_VALUE_DTYPE', 'float64')
+
+    return plan, msg
+
+
+def is_plan_allowed(plan, is_admin=False, user_id=None, farm_list=None):
+    """
+    Whether a user may read the cached datamap of a plan, with the rules the mapping service
+    applies when the datamap is fetched. If not, the datamap is fetched to let the mapping service decide
+    """
+    if plan.accessibility == "public" or is_admin:
+        return True
+
+    if plan.owner.get("owned_by") == "user":
+        return user_id is not None and plan.owner.get("owner_id") == user_id
+
+    if plan.owner.get("owned_by") == "farm":
+        return bool(farm_list) and plan.owner.get("owner_id") in farm_list
+
+    return False
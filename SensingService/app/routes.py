@@ -5,6 +5,11 @@ from .models import *
 from .utils import *
 from .api.MappingApi import MappingApi
 from .api.AuthApi import AuthApi
+from .jobs import queue_observation, fail_orphaned_jobs
+from .bulk import NDJSON_MIMETYPES, store_bulk_observations, read_ndjson, read_json_observations, \
+    store_observation_stream
+from .plans import get_ingest_plan
+from .uploads import create_upload_session, append_upload, finalize_upload, abort_upload
 
 
 api_route_str = '/api'
@@ -280,6 +285,7 @@ def farm_by_id(farm_id):
             return jsonify({'message': 'Farm not found'}), 404
         else:
             db.session.query(Farm).filter(Farm.id == farm_id).delete()
+            invalidate_dimensions()
             db.session.commit()
             response = jsonify({'message': 'The farm was deleted successfully'}), 204
 
@@ -471,6 +477,8 @@ def get_farm_field_by_id(farm_id, field_id):
             return jsonify({'message': 'No farm field found'}), 404
         else:
             db.session.query(Field).filter(Field.id == field_id).delete()
+            delete_upload_fingerprints(farm_id, field_id)
+            invalidate_dimensions()
             db.session.commit()
             response = jsonify({'message': 'The field was deleted successfully'}), 204
 
@@ -659,6 +667,8 @@ def get_crop_field_by_id(farm_id, field_id, crop_field_id):
             return jsonify({'message': 'No crop field found'}), 404
 
         db.session.query(CropField).filter(CropField.id == crop_field_id).delete()
+        delete_upload_fingerprints(farm_id, field_id, crop_field_id)
+        invalidate_dimensions()
         db.session.commit()
         response = jsonify({'message': 'The crop field was deleted successfully'}), 204
 
@@ -1002,10 +1012,38 @@ def get_observations():
     field_id = request.args.get('field_id')
     crop_field_id = request.args.get('crop_field_id')
     equipment_id = request.args.get('equipment_id')
+    start = request.args.get('start')
+    end = request.args.get('end')
+    limit = request.args.get('limit')
+    cursor = request.args.get('cursor')
+    log_format = request.args.get('format')
 
     if not farm_id or not field_id:
         return jsonify({'message': 'Missing required data'}), 400
 
+    if log_format and log_format not in LOG_STREAM_FORMATS:
+        return jsonify({'message': 'Format should be one of {}'.format(', '.join(LOG_STREAM_FORMATS))}), 400
+
+    try:
+        start = dtparse.parse(start) if start else None
+        end = dtparse.parse(end) if end else None
+    except (ValueError, OverflowError):
+        return jsonify({'message': 'Start and end should be date times'}), 400
+
+    try:
+        limit = to_int(limit)
+    except ValueError:
+        limit = 0
+
+    if limit is not None and limit <= 0:
+        return jsonify({'message': 'Limit should be a positive integer'}), 400
+
+    after = None
+    if cursor:
+        after, cursor_msg = decode_log_cursor(cursor)
+        if not cursor_msg[1]:
+            return jsonify({'message': cursor_msg[0]}), 400
+
     ret_code, msg = verify_request("observation", farm_id=farm_id)
     is_valid = msg.get("valid", False)
 
@@ -1020,7 +1058,11 @@ def get_observations():
         "farm_id": farm_id,
         "field_id": field_id,
         "crop_field_id": crop_field_id,
-        "equipment_id": equipment_id
+        "equipment_id": equipment_id,
+        "start": start,
+        "end": end,
+        "after": after,
+        "limit": limit
     }
 
     if request.method == 'GET':
@@ -1043,7 +1085,7 @@ def get_observations():
         if not len(status_list):
             return jsonify({'message': 'User does not have permission'}), 403
 
-        response = get_sensing_log(params, status_list)
+        response = get_sensing_log(params, status_list, log_format)
 
     elif request.method == 'DELETE':
         try:
@@ -1056,6 +1098,8 @@ def get_observations():
                 query = query.filter(ObservationLocation.crop_field_id == crop_field_id)
 
             query.delete()
+            delete_upload_fingerprints(farm_id, field_id, crop_field_id)
+            invalidate_dimensions()
             db.session.commit()
             response = jsonify({'message': 'The observation data was deleted successfully'}), 204
         except exc.SQLAlchemyError as e:
@@ -1099,6 +1143,7 @@ def update_observation_access():
         return jsonify({'message': 'No observation found'}), 404
 
     oloc.access_id = access_id
+    invalidate_dimensions()
     db.session.commit()
     response = jsonify({'message': 'Updated'}), 201
 
@@ -1126,16 +1171,25 @@ def upload_observations():
         crop_field_id = get_dict_value(request.form, 'crop_field_id')
         accessibility = get_dict_value(request.form, 'accessibility')
         equipment_id = get_dict_value(request.form, 'equipment_id')
+        loader = get_dict_value(request.form, 'loader')
+
+        # Upload the file again even if the same file was uploaded before
+        force = is_true(get_dict_value(request.form, 'force'))
+
+        # Store every row in the field and crop field at its coordinate instead of in field_id
+        assign_fields = is_true(get_dict_value(request.form, 'assign_fields'))
 
         if (not map_id or
                 not farm_id or
-                not field_id or
+                not (field_id or assign_fields) or
                 not accessibility):
             return jsonify({'message': 'Missing required data'}), 400
 
-        datamap = MappingApi.get_datamap_by_id(map_id, g.auth_header)
-        if not datamap:
-            return jsonify({'message': 'Datamap ID {} not found'.format(map_id)}), 400
+        # Compiled datamap, fetched from the mapping service only if it is not cached
+        plan, plan_response = get_ingest_plan(map_id, g.auth_header, msg.get("is_admin"), msg.get("user_id"),
+                                              get_accessible_farm_list(msg))
+        if plan is None:
+            return plan_response
 
         if equipment_id:
             eq = Equipment.query.get(equipment_id)
@@ -1144,13 +1198,6 @@ def upload_observations():
         else:
             equipment_id = None
 
-        ow, is_created = get_or_create(db.session, Owner,
-                                       owned_by_farm_id=farm_id,
-                                       owned_by_user_id=None)
-
-        if is_created:
-            db.session.commit()
-
         # Get location
         latitude_str = request.args.get('latitude')
         longitude_str = request.args.get('longitude')
@@ -1161,17 +1208,306 @@ def upload_observations():
             "longitude": longitude_str
         }
 
-        field_dict = {
-            "farm_id": farm_id,
-            "field_id": field_id,
-            "crop_field_id": crop_field_id
-        }
-
-        response = store_observation(file, datamap,
-                                     default_coordinate, field_dict,
-                                     equipment_id, default_time,
-                                     accessibility)
+        if assign_fields:
+            field_dict = {
+                "farm_id": farm_id,
+                "field_id": None,
+                "crop_field_id": None,
+                "assign_fields": True
+            }
+        else:
+            field_dict = {
+                "farm_id": farm_id,
+                "field_id": field_id,
+                "crop_field_id": crop_field_id
+            }
+
+        if is_true(get_dict_value(request.form, 'async')):
+            # Ingest in a worker process, progress is at /observations/jobs/<job_id>
+            response = queue_observation(file, plan,
+                                         default_coordinate, field_dict,
+                                         equipment_id, default_time,
+                                         accessibility, loader, force)
+        else:
+            response = store_observation(file, plan,
+                                         default_coordinate, field_dict,
+                                         equipment_id, default_time,
+                                         accessibility, loader, force)
     else:
         return jsonify({'message': 'No file selected for uploading'}), 404
 
     return response
+
+
+@app.route(api_route_str + '/observations/bulk', methods=['POST'])
+def bulk_observations():
+    is_ndjson = request.mimetype in NDJSON_MIMETYPES
+
+    if is_ndjson:
+        # Options are query parameters, every line of the body is an observation
+        options = request.args
+    else:
+        options = request.get_json(silent=True)
+
+        if not isinstance(options, dict):
+            return jsonify({'message': 'Request body should be a JSON object'}), 400
+
+    farm_id = get_dict_value(options, 'farm_id')
+    field_id = get_dict_value(options, 'field_id')
+    crop_field_id = get_dict_value(options, 'crop_field_id')
+    accessibility = get_dict_value(options, 'accessibility')
+    equipment_id = get_dict_value(options, 'equipment_id')
+    loader = get_dict_value(options, 'loader')
+
+    if (not farm_id or
+            not field_id or
+            not accessibility):
+        return jsonify({'message': 'Missing required data'}), 400
+
+    ret_code, msg = verify_request("observation",
+                                   farm_id=farm_id)
+    is_valid = msg.get("valid", False)
+
+    if ret_code != 200:
+        return msg, ret_code
+
+    if not is_valid:
+        return jsonify({'message': 'User does not have permission'}), 403
+
+    if loader and loader not in SENSING_LOADERS:
+        return jsonify({'message': 'Loader {} is not supported. Available loaders: {}'
+                       .format(loader, SENSING_LOADERS)}), 400
+
+    if equipment_id:
+        eq = Equipment.query.get(equipment_id)
+        if not eq:
+            return jsonify({'message': 'Equipment ID {} not found'.format(equipment_id)}), 400
+    else:
+        equipment_id = None
+
+    # Location of observations without longitude and latitude values
+    default_coordinate = {
+        "latitude": get_dict_value(options, 'latitude'),
+        "longitude": get_dict_value(options, 'longitude')
+    }
+
+    field_dict = {
+        "farm_id": farm_id,
+        "field_id": field_id,
+        "crop_field_id": crop_field_id
+    }
+
+    if is_ndjson:
+        entries = read_ndjson(request.stream)
+    else:
+        entries = read_json_observations(options)
+
+    return store_bulk_observations(entries, default_coordinate, field_dict,
+                                   equipment_id, accessibility, loader)
+
+
+@app.route(api_route_str + '/observations/stream', methods=['POST'])
+def stream_observations():
+    farm_id = request.args.get('farm_id')
+
+    # The request is verified once, readings are pushed as long as the connection is open
+    ret_code, msg = verify_request("observation",
+                                   farm_id=farm_id)
+    is_valid = msg.get("valid", False)
+
+    if ret_code != 200:
+        return msg, ret_code
+
+    if not is_valid:
+        return jsonify({'message': 'User does not have permission'}), 403
+
+    field_id = request.args.get('field_id')
+    crop_field_id = request.args.get('crop_field_id')
+    accessibility = request.args.get('accessibility')
+    equipment_id = request.args.get('equipment_id')
+    loader = request.args.get('loader')
+
+    if (not farm_id or
+            not field_id or
+            not accessibility):
+        return jsonify({'message': 'Missing required data'}), 400
+
+    if loader and loader not in SENSING_LOADERS:
+        return jsonify({'message': 'Loader {} is not supported. Available loaders: {}'
+                       .format(loader, SENSING_LOADERS)}), 400
+
+    if equipment_id:
+        eq = Equipment.query.get(equipment_id)
+        if not eq:
+            return jsonify({'message': 'Equipment ID {} not found'.format(equipment_id)}), 400
+    else:
+        equipment_id = None
+
+    if not Field.query.filter_by(farm_id=farm_id, id=field_id).first():
+        return jsonify({'message': 'Field ID {} not found in farm {}'.format(field_id, farm_id)}), 400
+
+    if crop_field_id and not CropField.query.filter_by(farm_id=farm_id, field_id=field_id,
+                                                       id=crop_field_id).first():
+        return jsonify({'message': 'Crop field ID {} not found in field {}'.format(crop_field_id, field_id)}), 400
+
+    access_id, is_ok = get_access_id(accessibility)
+    if not is_ok:
+        return access_id, 400
+
+    default_coordinate = {
+        "latitude": request.args.get('latitude'),
+        "longitude": request.args.get('longitude')
+    }
+
+    field_dict = {
+        "farm_id": farm_id,
+        "field_id": field_id,
+        "crop_field_id": crop_field_id
+    }
+
+    # The body is sent with Transfer-Encoding: chunked, one NDJSON reading per line
+    return store_observation_stream(request.stream, default_coordinate, field_dict,
+                                    equipment_id, accessibility, loader)
+
+
+@app.route(api_route_str + '/observations/uploads', methods=['POST'])
+def create_observation_upload():
+    farm_id = get_dict_value(request.form, 'farm_id')
+    ret_code, msg = verify_request("observation",
+                                   farm_id=farm_id)
+    is_valid = msg.get("valid", False)
+
+    if ret_code != 200:
+        return msg, ret_code
+
+    if not is_valid:
+        return jsonify({'message': 'User does not have permission'}), 403
+
+    filename = get_dict_value(request.form, 'filename')
+    map_id = get_dict_value(request.form, 'map_id')
+    field_id = get_dict_value(request.form, 'field_id')
+    crop_field_id = get_dict_value(request.form, 'crop_field_id')
+    accessibility = get_dict_value(request.form, 'accessibility')
+    equipment_id = get_dict_value(request.form, 'equipment_id')
+    loader = get_dict_value(request.form, 'loader')
+    size = get_dict_value(request.form, 'size')
+
+    if (not map_id or
+            not farm_id or
+            not field_id or
+            not accessibility):
+        return jsonify({'message': 'Missing required data'}), 400
+
+    try:
+        size = to_int(size)
+    except ValueError:
+        return jsonify({'message': 'Upload size should be an integer'}), 400
+
+    plan, plan_response = get_ingest_plan(map_id, g.auth_header, msg.get("is_admin"), msg.get("user_id"),
+                                          get_accessible_farm_list(msg))
+    if plan is None:
+        return plan_response
+
+    if equipment_id:
+        eq = Equipment.query.get(equipment_id)
+        if not eq:
+            return jsonify({'message': 'Equipment ID {} not found'.format(equipment_id)}), 400
+    else:
+        equipment_id = None
+
+    default_coordinate = {
+        "latitude": request.args.get('latitude'),
+        "longitude": request.args.get('longitude')
+    }
+
+    field_dict = {
+        "farm_id": farm_id,
+        "field_id": field_id,
+        "crop_field_id": crop_field_id
+    }
+
+    # With eager=true the file is parsed while it is being uploaded
+    return create_upload_session(plan, filename, size,
+                                 default_coordinate, field_dict,
+                                 equipment_id, request.args.get('datetime'),
+                                 accessibility, loader,
+                                 is_true(get_dict_value(request.form, 'eager')))
+
+
+@app.route(api_route_str + '/observations/uploads/<upload_id>', methods=['GET', 'PUT', 'DELETE'])
+def observation_upload_by_id(upload_id):
+    upload = UploadSession.query.get(upload_id)
+
+    if upload is None:
+        return jsonify({'message': 'Upload {} not found'.format(upload_id)}), 404
+
+    ret_code, msg = verify_request("observation", farm_id=upload.farm_id)
+    is_valid = msg.get("valid", False)
+
+    if ret_code != 200:
+        return msg, ret_code
+
+    if not is_valid:
+        return jsonify({'message': 'User does not have permission'}), 403
+
+    if request.method == 'GET':
+        # Offset to continue an interrupted upload from
+        response = jsonify(upload.to_json()), 200
+
+    elif request.method == 'PUT':
+        response = append_upload(upload_id, request.headers.get('Content-Range'), request.stream)
+
+    else:
+        response = abort_upload(upload_id)
+
+    return response
+
+
+@app.route(api_route_str + '/observations/uploads/<upload_id>/finalize', methods=['POST'])
+def finalize_observation_upload(upload_id):
+    upload = UploadSession.query.get(upload_id)
+
+    if upload is None:
+        return jsonify({'message': 'Upload {} not found'.format(upload_id)}), 404
+
+    ret_code, msg = verify_request("observation", farm_id=upload.farm_id)
+    is_valid = msg.get("valid", False)
+
+    if ret_code != 200:
+        return msg, ret_code
+
+    if not is_valid:
+        return jsonify({'message': 'User does not have permission'}), 403
+
+    # Also for an upload that is already being ingested, to check it for an earlier identical upload
+    plan, plan_response = get_ingest_plan(upload.map_id, g.auth_header, msg.get("is_admin"), msg.get("user_id"),
+                                          get_accessible_farm_list(msg))
+    if plan is None:
+        return plan_response
+
+    return finalize_upload(upload_id, plan,
+                           is_true(get_dict_value(request.form, 'async')),
+                           is_true(get_dict_value(request.form, 'force')))
+
+
+@app.route(api_route_str + '/observations/jobs/<job_id>', methods=['GET'])
+def get_observation_job(job_id):
+    job = IngestJob.query.get(job_id)
+
+    if job is None:
+        return jsonify({'message': 'Job {} not found'.format(job_id)}), 404
+
+    ret_code, msg = verify_request("observation", farm_id=job.farm_id)
+    is_valid = msg.get("valid", False)
+
+    if ret_code != 200:
+        return msg, ret_code
+
+    if not is_valid:
+        return jsonify({'message': 'User does not have permission'}), 403
+
+    # Jobs of a process that was restarted or a worker that was killed are never updated again
+    if fail_orphaned_jobs(job_id):
+        db.session.refresh(job)
+
+    return jsonify(job.to_json()), 200
@@ -0,0 +1,377 @@
+from app import app, db
+from flask import jsonify
+from sqlalchemy import or_
+from werkzeug.exceptions import ClientDisconnected
+from werkzeug.utils import secure_filename
+from datetime import datetime, timedelta
+import os
+import re
+import tempfile
+import time
+import uuid
+from .models import UploadSession, UploadSessionStatus, IngestJob, IngestJobStatus
+from .jobs import job_queue, queue_ingest_job, reopen_uploads
+from .utils import check_observation_file, get_file_ext, ingest_observations, hash_file, \
+    get_upload_fingerprint, get_fingerprint_result
+
+
+CONTENT_RANGE_PATTERN = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
+
+# File types that can be parsed before the whole file has been received
+STREAMABLE_FILE_TYPES = ['csv', 'gz', 'zst']
+
+
+def create_upload_session(plan, filename, size,
+                          default_coordinate, field_dict,
+                          equipment_id, default_time,
+                          accessibility, loader=None, eager=False):
+    """
+    Opens a resumable upload of an observation file (201 with the upload ID).
+    With eager the file is ingested by a job while it is being uploaded
+    """
+    response, is_ok = check_observation_file(filename, loader)
+    if not is_ok:
+        return response
+
+    expire_upload_sessions()
+
+    filetype = get_file_ext(secure_filename(filename))
+
+    # Received byte ranges are written to a file in the spool directory until the upload is finalized
+    fd, path = tempfile.mkstemp(dir=app.config.get('INGEST_SPOOL_DIR'), prefix='upload-', suffix='.' + filetype)
+    os.close(fd)
+
+    session = UploadSession(str(uuid.uuid4()), field_dict['farm_id'],
+                            field_dict['field_id'], field_dict['crop_field_id'] or None,
+                            int(plan.map_id), equipment_id, accessibility, default_time,
+                            default_coordinate['longitude'], default_coordinate['latitude'],
+                            loader, filetype, path, size)
+    db.session.add(session)
+    db.session.commit()
+
+    if eager and filetype in STREAMABLE_FILE_TYPES:
+        # With a full job queue or too many eager jobs, the file is ingested when the upload is finalized
+        job = queue_ingest_job(path, filetype, plan,
+                               default_coordinate, field_dict,
+                               equipment_id, default_time,
+                               accessibility, loader, session.id, eager=True)
+
+        if job is not None:
+            session.job_id = job.id
+            db.session.commit()
+
+    return jsonify({'message': 'Created', 'upload_id': session.id,
+                    'offset': 0, 'job_id': session.job_id}), 201
+
+
+def expire_upload_sessions():
+    """
+    Deletes the upload sessions that were not used for INGEST_UPLOAD_EXPIRY seconds with their
+    spooled files, unless a job is still ingesting them
+    """
+    deadline = datetime.utcnow() - timedelta(seconds=app.config.get('INGEST_UPLOAD_EXPIRY', 24 * 3600))
+    active_jobs = db.session.query(IngestJob.id) \
+        .filter(IngestJob.status.in_([IngestJobStatus.QUEUED, IngestJobStatus.RUNNING]))
+
+    # Sessions that a concurrent request is using are skipped
+    sessions = UploadSession.query.filter(UploadSession.updated_at < deadline) \
+        .filter(or_(UploadSession.job_id.is_(None), ~UploadSession.job_id.in_(active_jobs))) \
+        .with_for_update(skip_locked=True).all()
+
+    for session in sessions:
+        if os.path.exists(session.path):
+            os.remove(session.path)
+
+        db.session.delete(session)
+
+    db.session.commit()
+
+
+def lock_upload_session(upload_id):
+    """
+    Returns the upload session locked until the transaction ends, or None if it does not exist
+    (any more, e.g. removed by expire_upload_sessions after the request was checked)
+    """
+    return UploadSession.query.filter_by(id=upload_id).with_for_update().populate_existing().first()
+
+
+def is_upload_writing(session):
+    """
+    Returns True if a PUT request is writing a byte range to the upload, and reported
+    it is still writing within INGEST_JOB_TIMEOUT seconds
+    """
+    if session.write_id is None:
+        return False
+
+    return session.write_at > datetime.utcnow() - timedelta(seconds=app.config.get('INGEST_JOB_TIMEOUT', 300))
+
+
+def renew_upload_write(upload_id, write_id):
+    # Outside of the request transaction, like a job heartbeat
+    table = UploadSession.__table__
+    now = datetime.utcnow()
+
+    db.engine.execute(table.update()
+                      .where(table.c.id == upload_id)
+                      .where(table.c.write_id == write_id)
+                      .values(write_at=now, updated_at=now))
+
+
+def append_upload(upload_id, content_range, stream):
+    """
+    Writes the byte range of a PUT request to an upload. The range should start at
+    the received offset; bytes that arrive before the client disconnects are kept.
+    The range is reserved while the bytes are written, so the session is not locked
+    (and other requests do not wait) while a slow client is sending them
+    """
+    session = lock_upload_session(upload_id)
+
+    if session is None:
+        db.session.rollback()
+        return jsonify({'message': 'Upload {} not found'.format(upload_id)}), 404
+
+    if session.status != UploadSessionStatus.OPEN:
+        db.session.rollback()
+        return jsonify({'message': 'Upload {} is {}'.format(upload_id, session.status.value)}), 409
+
+    if is_upload_writing(session):
+        offset = session.received
+        db.session.rollback()
+        return jsonify({'message': 'Upload is receiving another byte range', 'offset': offset}), 409
+
+    byte_range = parse_content_range(content_range)
+    if byte_range is None:
+        db.session.rollback()
+        return jsonify({'message': 'Content-Range header should be "bytes <start>-<end>/<size or *>"'}), 400
+
+    start, end, size = byte_range
+
+    if start != session.received:
+        offset = session.received
+        db.session.rollback()
+        return jsonify({'message': 'Upload continues at byte {}'.format(offset), 'offset': offset}), 409
+
+    if size is not None:
+        if session.size is not None and size != session.size:
+            db.session.rollback()
+            return jsonify({'message': 'Upload size is {} bytes'.format(session.size)}), 400
+
+        session.size = size
+
+    if session.size is not None and end >= session.size:
+        db.session.rollback()
+        return jsonify({'message': 'Byte range exceeds the upload size of {} bytes'.format(session.size)}), 416
+
+    write_id = str(uuid.uuid4())
+    path = session.path
+
+    session.write_id = write_id
+    session.write_at = session.updated_at = datetime.utcnow()
+    db.session.commit()
+
+    try:
+        written = write_upload_range(path, start, end - start + 1, stream,
+                                     lambda: renew_upload_write(upload_id, write_id))
+    except (IOError, OSError):
+        written = None
+
+    session = lock_upload_session(upload_id)
+
+    # Removed, or the reservation expired and another request has written the range
+    if session is None or session.write_id != write_id:
+        db.session.rollback()
+        return jsonify({'message': 'Upload {} is no longer available'.format(upload_id)}), 410
+
+    session.write_id = None
+    session.write_at = None
+
+    if session.status != UploadSessionStatus.OPEN:
+        status = session.status.value
+        db.session.commit()
+        return jsonify({'message': 'Upload {} is {}'.format(upload_id, status)}), 409
+
+    if written is None:
+        db.session.commit()
+        return jsonify({'message': 'Upload {} is no longer available'.format(upload_id)}), 410
+
+    session.received = start + written
+    session.updated_at = datetime.utcnow()
+    db.session.commit()
+
+    return jsonify({'message': 'OK', 'offset': session.received, 'size': session.size}), 200
+
+
+def write_upload_range(path, start, length, stream, renew=None):
+    """
+    Copies up to length bytes of a request stream to a file from start and returns the written bytes.
+    renew is called every INGEST_JOB_HEARTBEAT seconds while the bytes are written
+    """
+    written = 0
+    renewed_at = time.time()
+
+    with open(path, 'r+b') as file:
+        # Bytes after the received offset are from a request that was not committed
+        file.seek(start)
+        file.truncate()
+
+        try:
+            while written < length:
+                block = stream.read(min(length - written, 64 * 1024))
+                if not block:
+                    break
+
+                file.write(block)
+                written += len(block)
+
+                if renew and time.time() - renewed_at >= app.config.get('INGEST_JOB_HEARTBEAT', 30):
+                    renew()
+                    renewed_at = time.time()
+        except ClientDisconnected:
+            pass
+
+    return written
+
+
+def parse_content_range(content_range):
+    """
+    Returns (start, end, size) of a Content-Range header; size is None if it is not known yet
+    """
+    match = CONTENT_RANGE_PATTERN.match((content_range or '').strip())
+    if not match:
+        return None
+
+    start, end = int(match.group(1)), int(match.group(2))
+    if end < start:
+        return None
+
+    size = None if match.group(3) == '*' else int(match.group(3))
+
+    return start, end, size
+
+
+def finalize_upload(upload_id, plan, is_async=False, force=False):
+    """
+    Completes an upload and ingests the file like a single upload: in this request,
+    or in a job if is_async is set or the file is already being ingested.
+    An identical earlier upload is answered with its result, unless force is set;
+    a job that is already ingesting the file is then stopped
+    """
+    session = lock_upload_session(upload_id)
+
+    if session is None:
+        db.session.rollback()
+        return jsonify({'message': 'Upload {} not found'.format(upload_id)}), 404
+
+    if session.status != UploadSessionStatus.OPEN:
+        db.session.rollback()
+        return jsonify({'message': 'Upload {} is {}'.format(upload_id, session.status.value)}), 409
+
+    if is_upload_writing(session):
+        offset = session.received
+        db.session.rollback()
+        return jsonify({'message': 'Upload is receiving a byte range', 'offset': offset}), 409
+
+    if session.size is not None and session.received != session.size:
+        offset = session.received
+        db.session.rollback()
+        return jsonify({'message': 'Upload is incomplete, it continues at byte {}'.format(offset),
+                        'offset': offset}), 409
+
+    if session.job_id is None and is_async and job_queue.is_full():
+        db.session.rollback()
+        return jsonify({'message': 'Too many uploads in progress, try again later'}), 503, \
+               {'Retry-After': str(app.config.get('INGEST_RETRY_AFTER', 30))}
+
+    default_coordinate = {
+        "latitude": session.latitude,
+        "longitude": session.longitude
+    }
+
+    field_dict = {
+        "farm_id": session.farm_id,
+        "field_id": session.field_id,
+        "crop_field_id": session.crop_field_id
+    }
+
+    # The file is complete, so a file that is already being ingested is checked as well
+    fingerprint = get_upload_fingerprint(hash_file(session.path), plan, default_coordinate,
+                                         session.equipment_id, session.default_time, session.accessibility)
+    result = None if force else get_fingerprint_result(fingerprint, plan, field_dict)
+
+    session.size = session.received
+    session.updated_at = datetime.utcnow()
+
+    if result is not None:
+        if session.job_id is None:
+            session.status = UploadSessionStatus.FINALIZED
+            os.remove(session.path)
+        else:
+            # The job fails on the aborted session, rolls back its rows and removes the file
+            session.status = UploadSessionStatus.ABORTED
+
+        db.session.commit()
+        return jsonify(result), 200
+
+    session.status = UploadSessionStatus.FINALIZED
+    db.session.commit()
+
+    if session.job_id is not None:
+        # The job reads the rest of the file now that the upload is finalized
+        return jsonify({'message': 'Accepted', 'job_id': session.job_id}), 202
+
+    if is_async:
+        job = queue_ingest_job(session.path, session.filetype, plan,
+                               default_coordinate, field_dict,
+                               session.equipment_id, session.default_time,
+                               session.accessibility, session.loader, session.id, fingerprint)
+
+        if job is None:
+            session.status = UploadSessionStatus.OPEN
+            db.session.commit()
+            return jsonify({'message': 'Too many uploads in progress, try again later'}), 503, \
+                   {'Retry-After': str(app.config.get('INGEST_RETRY_AFTER', 30))}
+
+        session.job_id = job.id
+        db.session.commit()
+
+        return jsonify({'message': 'Accepted', 'job_id': job.id}), 202
+
+    code = None
+
+    try:
+        with open(session.path, 'rb') as file:
+            result, code = ingest_observations(file, session.filetype, plan,
+                                               default_coordinate, field_dict,
+                                               session.equipment_id, session.default_time,
+                                               session.accessibility, session.loader,
+                                               fingerprint=fingerprint)
+    finally:
+        # The file is kept until it is ingested, so a failed upload can be finalized again
+        if code == 200:
+            os.remove(session.path)
+        else:
+            reopen_uploads(upload_id=upload_id)
+
+    return jsonify(result), code
+
+
+def abort_upload(upload_id):
+    session = lock_upload_session(upload_id)
+
+    if session is None:
+        db.session.rollback()
+        return jsonify({'message': 'Upload {} not found'.format(upload_id)}), 404
+
+    if session.status != UploadSessionStatus.OPEN:
+        db.session.rollback()
+        return jsonify({'message': 'Upload {} is {}'.format(upload_id, session.status.value)}), 409
+
+    session.status = UploadSessionStatus.ABORTED
+    session.updated_at = datetime.utcnow()
+    db.session.commit()
+
+    # A job that is reading the file fails and removes it
+    if session.job_id is None:
+        os.remove(session.path)
+
+    return jsonify({'message': 'Aborted'}), 200
@@ -1,16 +1,151 @@
-from app import db
-from flask import jsonify, json
-from sqlalchemy import exc, and_, or_
+from app import app, db
+from flask import Response, jsonify, json, stream_with_context
+from sqlalchemy import exc, and_, or_, func, bindparam, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from werkzeug.utils import secure_filename
 import dateutil.parser as dtparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from collections import deque
+from functools import partial
+import base64
+import calendar
 import csv
+import enum
+import gzip
+import hashlib
+import io
+import multiprocessing
+import os
+import queue
+import re
+import tempfile
+import threading
+import uuid
+import zipfile
+import zlib
 from shapely import wkb
-from io import StringIO
 import pandas as pd
 import numpy as np
+import psycopg2
+import zstandard as zstd
 from .models import *
+from .cache import GenerationCache
 # from timeit import default_timer as timer
 
+# Parquet and Arrow IPC uploads are only accepted if pyarrow is installed
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# Errors of upload files that cannot be read or decompressed
+FILE_READ_ERRORS = (EOFError, OSError, zlib.error, zipfile.BadZipFile, zstd.ZstdError) + \
+                   ((pa.ArrowException,) if pa else ())
+
+
+# Datamap datetime parameter tokens and their strptime directives
+DATETIME_FORMAT_TOKENS = {
+    'year': '%Y', 'month': '%m', 'day': '%d',
+    'YYYY': '%Y', 'YY': '%y', 'MM': '%m', 'DD': '%d',
+    'hh': '%H', 'HH': '%H', 'mm': '%M', 'ss': '%S',
+}
+DATETIME_FORMAT_PATTERN = re.compile('|'.join(sorted(DATETIME_FORMAT_TOKENS, key=len, reverse=True)))
+
+# Loaders for sensing log rows: PostgreSQL COPY or (executemany) INSERT statements
+SENSING_LOADERS = ['copy', 'insert']
+
+SENSING_STAGE_COLUMNS = ['observation_id', 'date_time', 'value', 'longitude', 'latitude']
+SENSING_STAGE_CREATE = """
+    CREATE TEMPORARY TABLE IF NOT EXISTS sensing_log_stage (
+        observation_id integer,
+        date_time timestamp,
+        value double precision,
+        longitude double precision,
+        latitude double precision
+    ) ON COMMIT DELETE ROWS
+"""
+
+# Rows that load workers stored for a column of an upload (see stage_sensing_log) are moved to
+# sensing_log in the transaction of the upload, skipping rows that are already stored
+SENSING_LOAD_COLUMNS = ['load_id', 'observation_id', 'date_time', 'value', 'longitude', 'latitude']
+SENSING_LOAD_MERGE = """
+    WITH moved AS (
+        DELETE FROM sensing_log_load WHERE load_id = :load_id
+        RETURNING observation_id, date_time, value, longitude, latitude
+    )
+    INSERT INTO sensing_log (observation_id, date_time, value, geo)
+    SELECT observation_id, date_time, value, ST_MakePoint(longitude, latitude)
+    FROM moved
+    ON CONFLICT ON CONSTRAINT uix_sensing DO NOTHING
+"""
+
+# Rows that are assigned to the field and crop field at their coordinate (see assign_fields)
+FIELD_STAGE_COLUMNS = ['row_id', 'date_time', 'longitude', 'latitude']
+FIELD_STAGE_CREATE = """
+    CREATE TEMPORARY TABLE IF NOT EXISTS field_assign_stage (
+        row_id bigint,
+        date_time timestamp,
+        longitude double precision,
+        latitude double precision
+    ) ON COMMIT DELETE ROWS
+"""
+
+# Field of the farm that contains a row, and the crop field of that field that contains it during
+# its period; field and crop field areas have spatial (GiST) indexes
+FIELD_ASSIGN_QUERY = """
+    SELECT DISTINCT ON (s.row_id) s.row_id, f.id, cf.id
+    FROM field_assign_stage s
+    JOIN field f
+        ON f.farm_id = %(farm_id)s
+        AND ST_Contains(f.area, ST_MakePoint(s.longitude, s.latitude))
+    LEFT JOIN crop_field cf
+        ON cf.field_id = f.id
+        AND ST_Contains(cf.area, ST_MakePoint(s.longitude, s.latitude))
+        AND (cf.period_start IS NULL OR cf.period_start <= s.date_time::date)
+        AND (cf.period_end IS NULL OR s.date_time::date <= cf.period_end)
+    ORDER BY s.row_id, f.id, cf.period_start DESC NULLS LAST
+"""
+
+# IDs of dimension rows (owners, locations, parameters, contexts, units, observations)
+# that uploads have resolved before, in the current dimension generation (see check_dimension_generation)
+dimension_cache = GenerationCache(app.config.get('DIMENSION_CACHE_SIZE', 10000))
+
+# ID of the DimensionGeneration row
+DIMENSION_GENERATION_ID = 1
+
+# Unique columns of the dimension tables that are shared by all farms
+DIMENSION_UNIQUE_COLUMNS = {
+    'parameter_type': ['type'],
+    'unit': ['name'],
+    'observed_context': ['context_type', 'context', 'parameter_id'],
+}
+
+# First key of the advisory locks on the farm dimension rows (the second key is the farm ID)
+DIMENSION_LOCK_ID = 1
+
+# Arrow IPC files may also be uploaded with the Feather (V2) extension
+COLUMNAR_FILE_TYPES = ['parquet', 'arrow', 'feather']
+
+# Compressed CSV files, and zip archives of CSV files that are ingested with the same datamap
+COMPRESSED_FILE_TYPES = ['gz', 'zst']
+ARCHIVE_FILE_TYPES = ['zip']
+
+# Worker processes that parse byte ranges of large CSV files, started on first use
+parse_pool = None
+parse_pool_lock = threading.Lock()
+
+# Media types of the streamed observation log formats
+LOG_STREAM_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+
+MONTH_NUMBERS = dict([(name.lower(), num) for num, name in enumerate(calendar.month_name) if num] +
+                     [(name.lower(), num) for num, name in enumerate(calendar.month_abbr) if num])
+
 
 def get_access_id(status):
     if status is None:
@@ -129,663 +264,2108 @@ def create_crop_field(farm_id, field_id, data):
     return response
 
 
-def store_observation(file, datamap,
+def store_observation(file, plan,
                       default_coordinate, field_dict,
                       equipment_id, default_time,
-                      accessibility):
-    if file.filename == '':
-        return jsonify({'message': 'No file selected for uploading'}), 404
-
-    elif not file or not allowed_file(file.filename):
-        return jsonify({'message': 'Allowed file types are csv'}), 400
+                      accessibility, loader=None, force=False):
+    response, is_ok = check_observation_file(file.filename, loader)
+    if not is_ok:
+        return response
 
     filename = secure_filename(file.filename)
     filetype = get_file_ext(filename)
 
-    # Extract and Load
-    df, msg = extract_data(file, datamap, default_coordinate, default_time)
-
-    if msg[-1] is False:
-        return jsonify({'message': msg[0]}), 400
-
-    response = load_data(df, datamap, field_dict, equipment_id, accessibility, filetype)
+    # Spool the upload to disk so only one chunk of rows is held in memory
+    spooled, digest = spool_file(file)
 
-    del df
-    return response
+    try:
+        fingerprint = get_upload_fingerprint(digest, plan, default_coordinate,
+                                             equipment_id, default_time, accessibility)
 
+        # The same file with the same options was stored before, unless force is set
+        result = None if force else get_fingerprint_result(fingerprint, plan, field_dict)
 
-def extract_data(file, datamap, default_coordinate, default_time, filetype='csv'):
-    if filetype == 'csv':
-        dict_list, msg = extract_datamap(datamap)
+        if result is not None:
+            return jsonify(result), 200
 
-        if msg[-1] is True:
-            col_list = dict_list[0]
-            datetime_dict = dict_list[1]
-            coor_dict = dict_list[2]
+        result, code = ingest_observations(spooled, filetype, plan,
+                                           default_coordinate, field_dict,
+                                           equipment_id, default_time,
+                                           accessibility, loader, fingerprint=fingerprint)
+    finally:
+        spooled.close()
 
-            has_header = datamap.get("has_header", False)
-            has_date = datamap.get("has_date", False)
-            has_time = datamap.get("has_time", False)
-            has_coordinate = datamap.get("has_coordinate", False)
+    return jsonify(result), code
 
-            df = get_dataframe(file, has_header)
 
-            # Keep columns that are only listed in the datamap
-            df = df.loc[:, df.columns.isin(set(col_list))]
+def check_observation_file(filename, loader=None):
+    if not filename:
+        return (jsonify({'message': 'No file selected for uploading'}), 404), False
 
-            # Parse datetime and coordinate columns in the dataframe
-            df, msg = parse_datetime(df, datetime_dict, default_time, has_date, has_time)
-            if msg[-1] is False:
-                return None, msg
+    elif not allowed_file(filename):
+        return (jsonify({'message': 'Allowed file types are {}'
+                        .format(', '.join(get_allowed_file_types()))}), 400), False
 
-            df, msg = parse_coordinate(df, coor_dict, default_coordinate, has_coordinate)
-            if msg[-1] is False:
-                return None, msg
+    elif loader and loader not in SENSING_LOADERS:
+        return (jsonify({'message': 'Loader {} is not supported. Available loaders: {}'
+                        .format(loader, SENSING_LOADERS)}), 400), False
 
-            return df, msg
-    else:
-        msg = ["Filetype {} not supported".format(filetype), False]
+    return None, True
 
-    return None, msg
 
+def ingest_observations(file, filetype, plan,
+                        default_coordinate, field_dict,
+                        equipment_id, default_time,
+                        accessibility, loader=None, progress=None, fingerprint=None):
+    """
+    Extracts and loads an observation file chunk by chunk in one transaction. The dimension
+    rows of the observations are committed before, so concurrent uploads do not wait for it;
+    the dimension rows of a location that is assigned after rows were loaded are committed
+    with the rows. With more than one load worker the columns are stored concurrently in
+    sensing_log_load and moved to sensing_log when the upload is committed, so a failing
+    upload stores no rows either way; their inserted and duplicate rows are counted then.
+    With INGEST_PIPELINE_DEPTH the next chunks are extracted while a chunk is loaded.
+    With assign_fields set in field_dict, every row is stored in the field and crop field
+    at its coordinate and time (see assign_fields).
+    progress is called with the ingest summary after every chunk. The upload fingerprint
+    (or a function that returns it once the file is read) is recorded with the result
+    if all columns are loaded.
+    Returns ({'message': ..., 'summary': ...}, status code)
+    """
+    summary = init_ingest_summary()
 
-def load_data(df, datamap, field, equipment_id, access_str, filetype='csv'):
-    input_farm_id = field['farm_id']
-    input_field_id = field['field_id']
-    input_crop_id = field['crop_field_id']
+    # Dimension rows created by this upload, cached once they are committed
+    pending = {}
+    generation = None
 
-    user_id = None
-    owner_query = Owner.query.filter_by(owned_by_farm_id=input_farm_id).first()
+    # Rows are loaded in the upload transaction (one load worker); a location resolved after
+    # that keeps its dimension rows and the farm lock in the transaction instead of committing
+    session_loaded = False
 
-    if owner_query is None:
-        owner_query = Owner(input_farm_id, user_id)
-        db.session.add(owner_query)
-        db.session.commit()
+    # Observation IDs of the data columns by (field ID, crop field ID)
+    location_observation_ids = {}
 
-    owner_id = owner_query.id
+    # Columns are loaded concurrently on separate connections with more than one load worker;
+    # staged has the load ID and the number of rows they stored of every column
+    load_workers = app.config.get('INGEST_LOAD_WORKERS', 1)
+    executor = None
+    staged = {}
 
-    access_response, is_ok = get_access_id(access_str)
-    if not is_ok:
-        return access_response, 400
+    if load_workers > 1 and db.engine.dialect.name == 'postgresql':
+        executor = ThreadPoolExecutor(max_workers=load_workers)
 
-    if filetype == 'csv':
-        # Get data columns to store
-        col_list = df.loc[:, ~df.columns.isin(['geo', 'date_time'])].columns
+    chunks = extract_data(file, plan, default_coordinate, default_time,
+                          filetype=filetype,
+                          chunk_size=app.config.get('INGEST_CHUNK_SIZE'),
+                          summary=summary)
 
-        dmap_list = datamap.get("maps")
+    pipeline_depth = app.config.get('INGEST_PIPELINE_DEPTH', 0)
+    if pipeline_depth > 0:
+        chunks = pipeline_chunks(chunks, pipeline_depth, getattr(file, 'stop', None))
 
-        for dmap in dmap_list:
-            observation_map = get_dict_value(dmap, 'observation')
-            col_name = str(get_dict_value(dmap, 'column'))
+    try:
+        for df, msg in chunks:
+            if msg[-1] is False:
+                db.session.rollback()
+                return {'message': msg[0], 'summary': summary}, 400
 
-            if col_name not in col_list:
-                continue
+            summary["chunks"] += 1
+            summary["rows"] += len(df.index)
 
-            data_type = get_dict_value(observation_map, 'type')
-            context = get_dict_value(observation_map, 'context')
-            param = get_dict_value(observation_map, 'parameter')
-            unit = get_dict_value(observation_map, 'unit')
-            conditions = get_dict_value(observation_map, 'conditions')
+            if field_dict.get('assign_fields'):
+                locations, msg = assign_fields(df, field_dict, summary)
+                if msg[-1] is False:
+                    db.session.rollback()
+                    return {'message': msg[0], 'summary': summary}, 400
+            else:
+                locations = [(field_dict, df)]
 
-            try:
-                context_type = ObservedContextType(data_type)
-            except ValueError:
-                return jsonify({'message': 'Data type {} in datamap is not supported. '
-                                           'Available data types: {}'.format(data_type,
-                                                                             ObservedContextType.list())}), 400
-
-            param_query, is_created = get_or_create(db.session, ParameterType, type=param)
-
-            if is_created:
-                db.session.commit()
-
-            obs_context_query, is_created = get_or_create(db.session, ObservedContext,
-                                                          context_type=context_type,
-                                                          context=context,
-                                                          parameter_id=param_query.id)
-
-            if is_created:
-                db.session.commit()
-
-            unit_query, is_created = get_or_create(db.session, Unit,
-                                                   type_id=param_query.id,
-                                                   name=unit)
-            if is_created:
-                db.session.commit()
-
-            obs_loc, is_created = get_or_create(db.session, ObservationLocation,
-                                                farm_id=input_farm_id,
-                                                field_id=input_field_id,
-                                                crop_field_id=input_crop_id,
-                                                access_id=access_response,
-                                                owner_id=owner_id)
-            if is_created:
-                db.session.commit()
-
-            obs_query, is_created = get_or_create(db.session, Observation,
-                                                  observed_context_id=obs_context_query.id,
-                                                  eq_id=equipment_id,
-                                                  conditions=conditions,
-                                                  location_id=obs_loc.id,
-                                                  unit_id=unit_query.id)
-
-            if is_created:
-                db.session.commit()
-
-
-
-            # Bulk insert but not checking any duplicate
-            # (may cause UniqueViolation)
-            df_data = df[["date_time", "geo", col_name]]
-            df_data = df_data.rename(columns={col_name: "value"})
-            df_data["observation_id"] = obs_query.id
+            for location, df_location in locations:
+                location_key = (to_int(location['field_id']), to_int(location['crop_field_id']))
+                observation_ids = location_observation_ids.get(location_key)
 
-            try:
-                db.session.bulk_insert_mappings(SensingLog, df_data.to_dict(orient="records"))
-                db.session.commit()
-            except exc.SQLAlchemyError as e:
-                db.session.rollback()
+                if observation_ids is None:
+                    generation = check_dimension_generation()
+                    obs_response, is_ok = resolve_observations(plan, location, equipment_id,
+                                                               accessibility, df.columns, pending)
+                    if not is_ok:
+                        db.session.rollback()
+                        return obs_response[0].get_json(), obs_response[-1]
 
-            del df_data
+                    observation_ids = location_observation_ids[location_key] = obs_response
 
-        return jsonify({'message': 'OK'}), 200
-    else:
-        return jsonify({'message': 'File cannot be loaded'}), 400
+                    # Releases the farm lock and the new dimension rows other uploads may be waiting for.
+                    # A location that first appears after rows were loaded (assigned fields) is only
+                    # flushed, so a failing upload does not leave part of its rows stored
+                    if not session_loaded:
+                        db.session.commit()
+                        dimension_cache.update(pending, generation)
 
+                load_data(df_location, observation_ids, loader, summary, executor, staged)
+                session_loaded = executor is None
 
-def parse_coordinate(df, coor_dict, coordinate, has_coordinate):
-    # If there is no column for longitude and latitude,
-    # use coordinate for all rows in the dataframe
-    created_col_name = "geo"
-    msg = ["OK", True]
+            del df, locations
 
-    if coor_dict and has_coordinate:
-        df[created_col_name] = df.apply(parse_coordinate_row, axis=1,
-                                        coor_dict=coor_dict)
+            if progress:
+                progress(summary)
 
-        col_list = [coor_dict["latitude"], coor_dict["longitude"]]
+        if staged:
+            merge_sensing_log_load(staged, summary)
 
-        df = df.drop(columns=col_list)
-    else:
-        try:
-            long = float(coordinate['longitude'])
-            lat = float(coordinate['latitude'])
-        except ValueError:
-            msg = ["Default longitude and latitude values should be float", False]
-            return None, msg
+        failed_cols = [col for col, col_summary in summary["columns"].items() if col_summary["error"]]
 
-        df[created_col_name] = 'POINT({} {})'.format(long, lat)
+        if failed_cols:
+            message = 'Failed to load column(s) {}'.format(failed_cols)
+        else:
+            message = 'OK'
 
-    return df, msg
+            # Uploads with assigned fields have no field to record the fingerprint for
+            if fingerprint and not field_dict.get('assign_fields'):
+                if callable(fingerprint):
+                    fingerprint = fingerprint()
 
+                add_upload_fingerprint(fingerprint, plan, field_dict, message, summary)
 
-def parse_coordinate_row(row, coor_dict):
-    if "latitude" in coor_dict and "longitude" in coor_dict:
-        lat_col = coor_dict["latitude"]
-        lon_col = coor_dict["longitude"]
+        db.session.commit()
+        dimension_cache.update(pending, generation)
+        staged = None
+    except (exc.SQLAlchemyError, psycopg2.Error) as e:
+        db.session.rollback()
+        return {'message': 'Failed to store observations with error:\n{}'.format(e),
+                'summary': summary}, 400
+    finally:
+        # Waits for the extracting thread before the file is closed
+        chunks.close()
 
-        return 'POINT({} {})'.format(row[lon_col],
-                                     row[lat_col])
+        if executor:
+            executor.shutdown()
 
-    return None
+            # The upload failed, the rows of its load workers are not moved to sensing_log
+            if staged:
+                delete_sensing_log_load(staged)
 
+    return {'message': message, 'summary': summary}, 200
 
-def parse_datetime_string(dtime_str):
-    msg = ["OK", True]
 
-    try:
-        dtime = dtparse.parse(dtime_str)
-        def_date = dtime.strftime("%Y-%m-%d")
-        def_time = dtime.strftime("%H:%M:%S")
-    except ValueError:
-        msg = ["Error in parsing default datetime {}".format(dtime_str), False]
+def assign_fields(df, field_dict, summary=None):
+    """
+    Splits the rows of a dataframe by the field of the farm that contains their coordinate,
+    and the crop field of that field that contains it during its period (if any), with one
+    spatial join against the indexed field and crop field areas.
+    Rows outside of the fields are rejected.
+    Returns ([(location dict, dataframe)], message)
+    """
+    connection = db.session.connection()
 
-    return def_date, def_time, msg
+    if connection.dialect.name != 'postgresql':
+        return None, ["Assigning fields by coordinate needs PostgreSQL", False]
 
+    located = df["longitude"].notna() & df["latitude"].notna()
+    stage = pd.DataFrame({"row_id": df.index[located],
+                          "date_time": df.loc[located, "date_time"].values,
+                          "longitude": df.loc[located, "longitude"].values,
+                          "latitude": df.loc[located, "latitude"].values},
+                         columns=FIELD_STAGE_COLUMNS)
 
-def parse_datetime(df, datetime_dict, default_time, has_date, has_time):
-    created_col_name = "date_time"
-    msg = ["OK", True]
+    buffer = tempfile.SpooledTemporaryFile(max_size=app.config.get('INGEST_COPY_BUFFER_SIZE'),
+                                           mode='w+', newline='',
+                                           dir=app.config.get('INGEST_SPOOL_DIR'))
 
-    if has_date or has_time:
-        col_list = []
+    try:
+        stage.to_csv(buffer, header=False, index=False, date_format='%Y-%m-%d %H:%M:%S.%f')
+        buffer.seek(0)
 
-        # Find date and time columns to be dropped after new datetime column is created
-        if "datetime" in datetime_dict:
-            df[created_col_name] = df.apply(parse_datetime_row, axis=1,
-                                            dtime_dict=datetime_dict,
-                                            def_date=None,
-                                            def_time=None)
+        cursor = connection.connection.cursor()
 
-            date_dict = datetime_dict["datetime"]
-            date_col = date_dict['column']
+        try:
+            cursor.execute(FIELD_STAGE_CREATE)
+            cursor.copy_expert("COPY field_assign_stage ({}) FROM STDIN WITH (FORMAT csv)"
+                               .format(', '.join(FIELD_STAGE_COLUMNS)), buffer)
+            cursor.execute(FIELD_ASSIGN_QUERY, {"farm_id": to_int(field_dict['farm_id'])})
+            assigned = cursor.fetchall()
+            cursor.execute("TRUNCATE field_assign_stage")
+        finally:
+            cursor.close()
+    finally:
+        buffer.close()
+
+    assigned = pd.DataFrame(assigned, columns=["row_id", "field_id", "crop_field_id"]).set_index("row_id")
+    field_ids = assigned["field_id"].reindex(df.index)
+    crop_field_ids = assigned["crop_field_id"].reindex(df.index).fillna(0)
+
+    unassigned = field_ids.isna()
+    df = reject_rows(df, unassigned, "No field of the farm at the coordinate", summary)
+
+    locations = []
+    for (field_id, crop_field_id), df_location in df.groupby([field_ids[~unassigned].astype(int),
+                                                             crop_field_ids[~unassigned].astype(int)]):
+        location = dict(field_dict, field_id=int(field_id), crop_field_id=int(crop_field_id) or None)
+        locations.append((location, df_location))
+
+    return locations, ["OK", True]
+
+
+def pipeline_chunks(chunks, depth, stop=None):
+    """
+    Yields the items of a generator that a producer thread reads ahead into a queue of at most
+    depth items, so the next chunks are extracted while the consumer loads one.
+    Errors of the producer are raised in the consumer. stop is called when the consumer is done,
+    so a producer that waits for more input (see GrowingFileReader) ends without reading it
+    """
+    items = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+    done = object()
 
-            if date_col != created_col_name:
-                col_list.append(date_col)
+    def put(item):
+        # Stops waiting for room in the queue when the consumer is gone
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
 
-        elif "date" in datetime_dict or "time" in datetime_dict:
-            if has_date ^ has_time:
-                def_date, def_time, msg = parse_datetime_string(default_time)
-                if msg[-1] is False:
-                    return None, msg
-            else:
-                def_date = None
-                def_time = None
+        return False
 
-            df[created_col_name] = df.apply(parse_datetime_row, axis=1,
-                                            dtime_dict=datetime_dict,
-                                            def_date=def_date,
-                                            def_time=def_time)
+    def produce():
+        try:
+            for item in chunks:
+                if not put((item, None)):
+                    return
 
-            if "date" in datetime_dict:
-                date_dict = datetime_dict["date"]
-                date_col = date_dict['column']
-                col_list.append(date_col)
+            put((done, None))
+        except Exception as e:
+            put((None, e))
+        finally:
+            chunks.close()
 
-            if "time" in datetime_dict:
-                time_dict = datetime_dict["time"]
-                time_col = time_dict['column']
-                col_list.append(time_col)
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
 
-        elif "year" in datetime_dict or "hour" in datetime_dict:
-            if has_date ^ has_time:
-                def_date, def_time, msg = parse_datetime_string(default_time)
-                if msg[-1] is False:
-                    return None, msg
-            else:
-                def_date = None
-                def_time = None
+    try:
+        while True:
+            item, error = items.get()
 
-            df[created_col_name] = df.apply(parse_datetime_row, axis=1,
-                                            dtime_dict=datetime_dict,
-                                            def_date=def_date,
-                                            def_time=def_time)
+            if error is not None:
+                raise error
 
-            if "year" in datetime_dict:
-                year_col = get_dict_value(datetime_dict, "year", subkey="column")
-                month_col = get_dict_value(datetime_dict, "month", subkey="column")
-                day_col = get_dict_value(datetime_dict, "day", subkey="column")
+            if item is done:
+                return
 
-                col_list.append(year_col)
-                col_list.append(month_col)
-                col_list.append(day_col)
+            yield item
+    finally:
+        stopped.set()
 
-            if "hour" in datetime_dict:
-                hour_col = get_dict_value(datetime_dict, "hour", subkey="column")
-                minute_col = get_dict_value(datetime_dict, "minute", subkey="column")
-                second_col = get_dict_value(datetime_dict, "second", subkey="column")
+        if stop:
+            stop()
 
-                col_list.append(hour_col)
-                col_list.append(minute_col)
-                col_list.append(second_col)
+        producer.join()
 
-        else:
-            msg = ["Error in parsing datetime contexts from datamap", False]
-            return None, msg
 
-        col_list = list(filter(None, col_list))
-        df = df.drop(columns=col_list)
+def get_upload_fingerprint(digest, plan, default_coordinate, equipment_id, default_time, accessibility):
+    """
+    Fingerprint of an upload: the content digest of the file and everything else that
+    decides which rows are stored (datamap version, defaults, equipment and accessibility)
+    """
+    content = json.dumps([digest, plan.version, default_coordinate, to_int(equipment_id),
+                          default_time, accessibility], sort_keys=True)
 
-    else:
-        # Use default date and time
-        def_date, def_time, msg = parse_datetime_string(default_time)
-        if msg[-1] is False:
-            return None, msg
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
 
-        df[created_col_name] = "{} {}".format(def_date, def_time)
 
-    return df, msg
+def get_fingerprint_query(fingerprint, plan, field_dict):
+    return UploadFingerprint.query.filter_by(farm_id=to_int(field_dict['farm_id']),
+                                             field_id=to_int(field_dict['field_id']),
+                                             crop_field_id=to_int(field_dict['crop_field_id']),
+                                             map_id=to_int(plan.map_id),
+                                             fingerprint=fingerprint)
 
 
-def get_dict_value(input_dict, key, subkey=None):
-    val = None
+def get_fingerprint_result(fingerprint, plan, field_dict):
+    """
+    Returns the ingest result of an earlier identical upload, or None
+    """
+    upload = get_fingerprint_query(fingerprint, plan, field_dict) \
+        .order_by(UploadFingerprint.created_at.desc()).first()
 
-    if input_dict is None:
+    if upload is None:
         return None
 
-    if key in input_dict:
-        sub_dict = input_dict[key]
-        if subkey:
-            if subkey in sub_dict:
-                val = sub_dict[subkey]
-        else:
-            val = sub_dict
+    return {'message': upload.message, 'summary': upload.summary, 'duplicate': True,
+            'uploaded_at': upload.created_at.strftime("%Y-%m-%d %H:%M:%S")}
 
-    return val
 
+def add_upload_fingerprint(fingerprint, plan, field_dict, message, summary):
+    # A forced upload replaces the result of the earlier one
+    get_fingerprint_query(fingerprint, plan, field_dict).delete()
 
-def parse_datetime_row(row, dtime_dict, def_date, def_time):
-    dayfirst = True
+    db.session.add(UploadFingerprint(to_int(field_dict['farm_id']), to_int(field_dict['field_id']),
+                                     to_int(field_dict['crop_field_id']), to_int(plan.map_id),
+                                     fingerprint, message, summary))
 
-    if "datetime" in dtime_dict:
-        datetime_col = get_dict_value(dtime_dict, "datetime", subkey="column")
-        dtime_str = row[datetime_col]
 
-    elif "date" in dtime_dict or "time" in dtime_dict:
-        if "date" in dtime_dict:
-            date_col = get_dict_value(dtime_dict, "date", subkey="column")
-            date_param = get_dict_value(dtime_dict, "date", subkey="parameter")
+def delete_upload_fingerprints(farm_id, field_id=None, crop_field_id=None):
+    """
+    Forgets the uploads of deleted observations, so the same files can be uploaded again
+    """
+    query = UploadFingerprint.query.filter(UploadFingerprint.farm_id == farm_id)
 
-            if date_param == "month-day-year":
-                dayfirst = False
+    if field_id:
+        query = query.filter(UploadFingerprint.field_id == field_id)
 
-            date_str = row[date_col]
-        else:
-            date_str = def_date
+    if crop_field_id:
+        query = query.filter(UploadFingerprint.crop_field_id == crop_field_id)
 
-        if "time" in dtime_dict:
-            time_col = get_dict_value(dtime_dict, "time", subkey="column")
-            time_str = row[time_col]
-        else:
-            time_str = def_time
+    query.delete()
 
-        dtime_str = "{} {}".format(date_str, time_str)
 
-    elif "year" in dtime_dict or "hour" in dtime_dict:
-        if "year" in dtime_dict:
-            year_col = get_dict_value(dtime_dict, "year", subkey="column")
-            month_col = get_dict_value(dtime_dict, "month", subkey="column")
-            day_col = get_dict_value(dtime_dict, "day", subkey="column")
+def extract_data(file, plan, default_coordinate, default_time, filetype='csv', chunk_size=None,
+                 summary=None):
+    """
+    Yields (dataframe, message) for every chunk of at most chunk_size rows
+    """
+    if filetype not in get_allowed_file_types():
+        msg = ["Filetype {} not supported".format(filetype), False]
+        yield None, msg
+        return
 
-            year_val = int(row[year_col])
-            month_val = str(row[month_col]).split(".", 1)[0]
-            day_val = int(row[day_col])
+    try:
+        path = get_parallel_parse_path(file, filetype)
 
-            date_str = "{}-{}-{}".format(year_val,
-                                         month_val,
-                                         day_val)
+        if path is None:
+            chunks = (transform_data(df, plan, default_coordinate, default_time, summary)
+                      for df in get_dataframes(file, filetype, plan, chunk_size, summary))
         else:
-            date_str = def_date
-
-        if "hour" in dtime_dict:
-            hour_col = get_dict_value(dtime_dict, "hour", subkey="column")
-            minute_col = get_dict_value(dtime_dict, "minute", subkey="column")
-            second_col = get_dict_value(dtime_dict, "second", subkey="column")
-
-            hour_val = row[hour_col] if hour_col else 0
-            minute_val = row[minute_col] if minute_col else 0
-            sec_val = row[second_col] if second_col else 0
+            chunks = get_parallel_dataframes(path, plan, default_coordinate, default_time, chunk_size, summary)
 
-            time_str = "{}:{}:{}".format(int(hour_val),
-                                         int(minute_val),
-                                         int(sec_val))
-        else:
-            time_str = def_time
+        for df, msg in chunks:
+            yield df, msg
 
-        dtime_str = "{} {}".format(date_str, time_str)
+            if msg[-1] is False:
+                return
+    except FILE_READ_ERRORS as e:
+        msg = ["Failed to read {} file with error:\n{}".format(filetype, e), False]
+        yield None, msg
 
-    try:
-        dtime = dtparse.parse(dtime_str, dayfirst=dayfirst)
-    except ValueError:
-        return None
 
-    return dtime
+def transform_data(df, plan, default_coordinate, default_time, summary=None):
+    # Keep columns that are only listed in the datamap
+    df = df.loc[:, df.columns.isin(set(plan.columns))]
 
+    # Parse datetime and coordinate columns in the dataframe
+    df, msg = parse_datetime(df, plan.datetime, default_time, plan.has_date, plan.has_time)
+    if msg[-1] is False:
+        return None, msg
 
-def extract_datamap(datamap):
-    col_names = []
-    datetime_dict = {}
-    loc_dict = {}
+    df = reject_rows(df, df["date_time"].isna(), "Invalid datetime", summary)
 
-    has_header = datamap.get("has_header", False)
-    has_date = datamap.get("has_date", False)
-    has_time = datamap.get("has_time", False)
-    has_coordinate = datamap.get("has_coordinate", False)
+    df, msg = parse_coordinate(df, plan.coordinate, default_coordinate, plan.has_coordinate)
+    if msg[-1] is False:
+        return None, msg
 
-    msg = ["OK", True]
-    map_list = datamap.get("maps")
+    return df, msg
 
-    for dmap in map_list:
-        col_name = dmap['column']
-        if not has_header:
-            try:
-                if int(col_name) < 1:
-                    msg = ['Datamap column should start from 1', False]
-                    return None, msg
-                col_name = str(col_name)
-            except ValueError:
-                msg = ['Column {} in datamap should be an integer'.format(col_name), False]
-                return None, msg
 
-        col_names.append(col_name)
+def load_data(df, observation_ids, loader=None, summary=None, executor=None, staged=None):
+    """
+    Stores the data columns of a dataframe as sensing logs of their observations.
+    Without an executor every column is stored in a savepoint of the session so a failing
+    column does not undo the others; with an executor the columns are stored concurrently
+    in sensing_log_load, each in its own transaction on its own connection. staged has the
+    load ID and number of stored rows of every column, which merge_sensing_log_load moves
+    to sensing_log and counts
+    """
+    if summary is None:
+        summary = init_ingest_summary()
 
-        if has_date or has_time or has_coordinate:
-            observation_map = dmap['observation']
-            obs_type = observation_map['type']
-            context = observation_map['context']
+    columns = [(col_name, obs_id) for col_name, obs_id in observation_ids.items() if col_name in df.columns]
 
-            if obs_type == 'datetime':
-                param = observation_map['parameter']
+    if executor is None:
+        results = (load_column(df, col_name, obs_id, loader) for col_name, obs_id in columns)
+    else:
+        engine = db.engine
 
-                datetime_dict[context] = {"column": col_name,
-                                          "parameter": param}
-            elif obs_type == 'coordinate':
-                loc_dict[context] = col_name
+        for col_name, obs_id in columns:
+            staged.setdefault(col_name, {"load_id": uuid.uuid4().hex, "rows": 0})
 
-    return [col_names, datetime_dict, loc_dict], msg
+        results = executor.map(lambda col: load_column(df, col[0], col[1], loader, engine,
+                                                       staged[col[0]]["load_id"]), columns)
 
+    for col_name, invalid_rows, nr_rows, inserted, error in results:
+        col_summary = summary["columns"].setdefault(col_name, init_column_summary())
 
-def get_delimiter(csv_string):
-    dialect = csv.Sniffer().sniff(str(csv_string))
-    return dialect.delimiter
+        if len(invalid_rows):
+            col_summary["rejected"] += len(invalid_rows)
+            add_row_errors(summary, invalid_rows, "Invalid value in column {}".format(col_name))
 
+        if error is not None:
+            col_summary["failed"] += nr_rows
+            col_summary["error"] = error
+        elif inserted is None:
+            # Counted when the rows are moved to sensing_log (see merge_sensing_log_load)
+            staged[col_name]["rows"] += nr_rows
+        else:
+            # Rows that are already stored (uix_sensing) are skipped and counted as duplicates
+            col_summary["inserted"] += inserted
+            col_summary["duplicate"] += nr_rows - inserted
 
-def get_dataframe(file, has_header):
-    input_str = file.read()
+    return summary
 
-    delimiter = get_delimiter(input_str)
 
-    input_io = StringIO(input_str.decode('utf-8'))
+def load_column(df, col_name, obs_id, loader=None, engine=None, load_id=None):
+    """
+    Stores one data column in a savepoint of the session, or in sensing_log_load under
+    load_id in a new transaction of the engine.
+    Returns (column, rejected row indexes, number of rows to store, inserted rows or None
+    if they were stored in sensing_log_load, error)
+    """
+    # Values that are not numbers are rejected, the rest of the column is still stored
+    values = pd.to_numeric(df[col_name], errors='coerce')
+    invalid = values.isna()
 
-    if has_header:
-        df = pd.read_csv(input_io, sep=delimiter)
-    else:
-        df = pd.read_csv(input_io, header=None, sep=delimiter)
-        # Make column names from index + 1 (Datamap column starts from 1)
-        df.columns = list(map(lambda x: str(x + 1), df.columns))
+    df_data = df.loc[~invalid, ["date_time", "longitude", "latitude"]] \
+        .assign(value=values[~invalid], observation_id=obs_id)
 
-    return df
+    inserted = 0
+    error = None
 
+    try:
+        if engine is None:
+            savepoint = db.session.begin_nested()
 
-def get_file_ext(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower()
+            try:
+                inserted = store_sensing_log(db.session.connection(), df_data, loader)
+                savepoint.commit()
+            except (exc.SQLAlchemyError, psycopg2.Error):
+                savepoint.rollback()
+                raise
+        else:
+            with engine.begin() as connection:
+                stage_sensing_log(connection, df_data, load_id, loader)
 
+            inserted = None
+    except (exc.SQLAlchemyError, psycopg2.Error) as e:
+        error = str(e)
 
-def allowed_file(filename):
-    allowed_ext = set(['csv'])
-    return get_file_ext(filename) in allowed_ext
+    return col_name, df.index[invalid], len(df_data.index), inserted, error
 
 
-def get_or_create(session, model, **kwargs):
+def resolve_observations(plan, field, equipment_id, access_str, col_list, pending):
     """
-    Creates an object or returns the object if exists
+    Finds or creates the observation of every data column of the plan in col_list with one
+    batched pass per dimension table. New rows are only flushed; their keys are added
+    to pending so they can be cached after they are committed.
+    Returns ({column: observation_id}, True) or (error response, False)
     """
-    instance = session.query(model).filter_by(**kwargs).first()
-    if instance:
-        return instance, False
-    else:
-        instance = model(**kwargs)
-        session.add(instance)
-        return instance, True
+    # Copies, the plan is shared by uploads with the same datamap
+    obs_maps = [dict(omap) for omap in plan.observations if omap["column"] in col_list]
 
+    return resolve_observation_maps(obs_maps, field, equipment_id, access_str, pending)
 
-def get_sensing_log(params, status_list):
-    context_type = params['context_type']
 
-    farm_id = int(params['farm_id'])
-    field_id = int(params['field_id'])
+def resolve_observation_maps(obs_maps, field, equipment_id, access_str, pending):
+    """
+    Finds or creates the observations of a list of observation maps (column, context_type,
+    context, parameter, unit and conditions); the maps are updated with the dimension keys.
+    Returns ({column: observation_id}, True) or (error response, False)
+    """
+    farm_id = to_int(field['farm_id'])
+    field_id = to_int(field['field_id'])
+    crop_field_id = to_int(field['crop_field_id'])
+    equipment_id = to_int(equipment_id)
+
+    # Owners, locations and observations of a farm have no unique constraint that covers
+    # every lookup column, so uploads for the same farm resolve them one at a time
+    lock_farm_dimensions(db.session, farm_id)
+
+    access_key = ('accessibility_status', access_str)
+    access_id = dimension_cache.get(access_key)
+
+    if access_id is None:
+        access_response, is_ok = get_access_id(access_str)
+        if not is_ok:
+            return (access_response, 400), False
+
+        access_id = access_response
+        dimension_cache.set(access_key, access_id)
+
+    owner_ids = get_or_create_ids(db.session, Owner,
+                                  [{"owned_by_farm_id": farm_id, "owned_by_user_id": None}],
+                                  pending)
+    owner_id = list(owner_ids.values())[0]
+
+    loc_ids = get_or_create_ids(db.session, ObservationLocation,
+                                [{"farm_id": farm_id, "field_id": field_id, "crop_field_id": crop_field_id,
+                                  "access_id": access_id, "owner_id": owner_id}],
+                                pending)
+    loc_id = list(loc_ids.values())[0]
+
+    param_ids = get_or_create_ids(db.session, ParameterType,
+                                  [{"type": omap["parameter"]} for omap in obs_maps],
+                                  pending)
+
+    for omap in obs_maps:
+        omap["parameter_id"] = param_ids[get_dimension_key(ParameterType, {"type": omap["parameter"]})]
+        omap["context_key"] = {"context_type": omap["context_type"], "context": omap["context"],
+                               "parameter_id": omap["parameter_id"]}
+        omap["unit_key"] = {"type_id": omap["parameter_id"], "name": omap["unit"]}
+
+    context_ids = get_or_create_ids(db.session, ObservedContext,
+                                    [omap["context_key"] for omap in obs_maps], pending)
+    unit_ids = get_or_create_ids(db.session, Unit,
+                                 [omap["unit_key"] for omap in obs_maps], pending)
+
+    for omap in obs_maps:
+        omap["observation_key"] = {
+            "observed_context_id": context_ids[get_dimension_key(ObservedContext, omap["context_key"])],
+            "eq_id": equipment_id,
+            "conditions": omap["conditions"],
+            "location_id": loc_id,
+            "unit_id": unit_ids[get_dimension_key(Unit, omap["unit_key"])]
+        }
 
-    crop_field_id = None
-    if params.get('crop_field_id'):
-        crop_field_id = params['crop_field_id']
+    obs_ids = get_or_create_ids(db.session, Observation,
+                                [omap["observation_key"] for omap in obs_maps], pending)
 
-    equipment_id = None
-    if params.get('equipment_id'):
-        equipment_id = int(params['equipment_id'])
+    observation_ids = {}
+    for omap in obs_maps:
+        observation_ids[omap["column"]] = obs_ids[get_dimension_key(Observation, omap["observation_key"])]
 
-    # Get allowed accessibility status IDs
-    acc_status = db.session.query(AccessibilityStatus)\
-        .filter(AccessibilityStatus.name.in_(status_list)).all()
-    acc_status_list = [s.id for s in acc_status]
+    return observation_ids, True
 
-    # Query observation data
-    query = db.session.query(ObservedContext, ParameterType, Observation, Unit, ObservationLocation) \
-        .filter(ObservedContext.parameter_id == ParameterType.id,
-                ObservedContext.id == Observation.observed_context_id,
-                Observation.location_id == ObservationLocation.id,
-                Observation.unit_id == Unit.id) \
-        .filter(ObservationLocation.farm_id == farm_id,
-                ObservationLocation.field_id == field_id) \
-        .filter(ObservationLocation.access_id.in_(acc_status_list))
 
-    if context_type:
-        ctype_list = [ObservedContextType(ct) for ct in context_type]
-        query = query.filter(ObservedContext.context_type.in_(ctype_list))
+def lock_farm_dimensions(session, farm_id):
+    # Transaction-level advisory lock, released when the dimension rows are committed
+    if session.get_bind().dialect.name == 'postgresql':
+        session.execute(db.select([func.pg_advisory_xact_lock(DIMENSION_LOCK_ID, farm_id)]))
 
-    if crop_field_id:
-        query = query.filter(ObservationLocation.crop_field_id == crop_field_id)
 
-    if equipment_id:
-        query = query.filter(Observation.eq_id == equipment_id)
+def check_dimension_generation():
+    """
+    Clears the dimension cache if dimension rows were deleted or changed by any process
+    since the cache was filled (see invalidate_dimensions). Call it in the transaction
+    that resolves dimensions; returns the generation of the IDs it resolves
+    """
+    row = db.session.query(DimensionGeneration.generation) \
+        .filter(DimensionGeneration.id == DIMENSION_GENERATION_ID).first()
+    generation = row[0] if row else 0
 
-    sensing = init_observation(farm_id, field_id, crop_field_id)
-    obs_context_type = None
-    idx = 0
-    total_df = None
+    dimension_cache.set_generation(generation)
 
-    for ocontext, paramtype, observation, unit, oloc in query.all():
-        if ocontext.context_type != obs_context_type:
-            # if context is different, store previous df
-            if obs_context_type is not None:
-                sensing["observations"][-1]["log"] = set_sensing_log(total_df)
-                total_df = None
+    return generation
 
-            obs_context_type = ocontext.context_type
 
-            access = AccessibilityStatus.query.get(oloc.access_id)
-            obs_meta, idx = init_observation_meta()
+def invalidate_dimensions():
+    """
+    Increases the dimension generation in the current transaction, so the dimension caches of
+    all processes (web and ingest workers) are cleared once the deletes or changes are committed
+    """
+    table = DimensionGeneration.__table__
+    stmt = pg_insert(table).values(id=DIMENSION_GENERATION_ID, generation=1)
 
-            obs_dict = {
-                "type": ocontext.context_type.value,
-                "accessibility": access.name,
-                "schema": obs_meta,
-                "log": []
-            }
+    db.session.execute(stmt.on_conflict_do_update(index_elements=[table.c.id],
+                                                  set_={'generation': table.c.generation + 1}))
+    dimension_cache.invalidate()
 
-            sensing["observations"].append(obs_dict)
 
-        idx += 1
-        obs_meta = {
-            "column": idx,
-            "object": ocontext.context,
-            "parameter": paramtype.get_param(),
-            "equipment_id": observation.eq_id,
-            "observation_id": observation.id,
-            "conditions": observation.conditions,
-            "unit": unit.name
-        }
-        # obs_dict["meta"].append(obs_meta)
-        sensing["observations"][-1]["schema"].append(obs_meta)
+def get_or_create_ids(session, model, kwargs_list, pending):
+    """
+    Returns {dimension key: id} for a list of column values of a dimension model.
+    Values are looked up in the dimension cache first, then all remaining ones in a
+    single query; the ones that do not exist yet are created together. Rows shared
+    by all farms are inserted with ON CONFLICT DO NOTHING, so a row that a concurrent
+    upload created first is used instead
+    """
+    ids = {}
+    missing = {}
 
-        # start = timer()
+    for kwargs in kwargs_list:
+        key = get_dimension_key(model, kwargs)
 
-        df = pd.read_sql(db.session.query(SensingLog)
-                         .filter(SensingLog.observation_id == observation.id).statement,
-                         db.session.bind)
+        if key in ids or key in missing:
+            continue
 
-        # end = timer()
-        # elapsed_time = end - start
-        # print("elapsed_time pd.read_sql: {}".format(elapsed_time))
+        dim_id = pending.get(key, dimension_cache.get(key))
 
-        if total_df is None:
-            total_df = df
+        if dim_id is None:
+            missing[key] = kwargs
         else:
-            total_df = pd.concat([total_df, df], ignore_index=True)
+            ids[key] = dim_id
 
-    if not sensing["observations"]:
-        return jsonify({'message': 'No observation data found'}), 404
-    else:
-        if total_df is not None:
-            sensing["observations"][-1]["log"] = set_sensing_log(total_df)
+    if not missing:
+        return ids
 
-        json_str = json.dumps(sensing)
-        response = jsonify(json_str), 200
+    filters = [and_(*[getattr(model, col) == val for col, val in kwargs.items()])
+               for kwargs in missing.values()]
+    columns = list(list(missing.values())[0].keys())
 
-    return response
+    for instance in session.query(model).filter(or_(*filters)):
+        key = get_dimension_key(model, dict((col, getattr(instance, col)) for col in columns))
 
+        if key in missing and key not in ids:
+            ids[key] = instance.id
+            pending[key] = instance.id
 
-def set_sensing_log(df):
-    cvt = np.vectorize(convert_point_wkb)
-    geo_series = cvt(df['geo'])
+    unique_columns = DIMENSION_UNIQUE_COLUMNS.get(model.__tablename__)
 
-    df['longitude'] = geo_series[0]
-    df['latitude'] = geo_series[1]
+    if unique_columns and session.get_bind().dialect.name == 'postgresql':
+        upsert_ids(session, model, dict((key, kwargs) for key, kwargs in missing.items() if key not in ids),
+                   unique_columns, ids, pending)
+        return ids
 
-    df = df.drop(['geo'], axis=1)
+    created = {}
+    for key, kwargs in missing.items():
+        if key not in ids:
+            created[key] = model(**kwargs)
 
-    df = pd.pivot_table(df,
-                        values='value',
-                        index=['date_time', 'longitude', 'latitude'],
-                        columns='observation_id').reset_index()
+    if created:
+        session.add_all(created.values())
+        session.flush()
 
-    return df.to_json(orient='values')
+        for key, instance in created.items():
+            ids[key] = instance.id
+            pending[key] = instance.id
 
+    return ids
 
-def to_geo_string(coordinates, geo_type="POLYGON"):
-    val = None
 
-    if coordinates is None:
-        return None
+def upsert_ids(session, model, missing, unique_columns, ids, pending):
+    """
+    Inserts the missing rows of a shared dimension, skipping the ones that conflict with
+    an existing row, and adds the IDs of all of them found by their unique columns
+    """
+    if not missing:
+        return
 
-    if geo_type == "POLYGON":
-        # Prevent geometry non-closed rings error
-        if coordinates[0] != coordinates[-1]:
-            coordinates.append(coordinates[0])
+    session.execute(pg_insert(model.__table__).values(list(missing.values())).on_conflict_do_nothing())
 
-        val = 'POLYGON(('
+    def get_unique_key(values):
+        return get_dimension_key(model, dict((col, values[col]) for col in unique_columns))
 
-        for num, coor in enumerate(coordinates, start=1):
-            point = "{} {}".format(coor['longitude'], coor['latitude'])
+    unique_keys = {}
+    for key, kwargs in missing.items():
+        unique_keys.setdefault(get_unique_key(kwargs), []).append(key)
 
-            if num > 1:
-                val = "{},{}".format(val, point)
-            else:
-                val = "{}{}".format(val, point)
+    filters = [and_(*[getattr(model, col) == kwargs[col] for col in unique_columns])
+               for kwargs in missing.values()]
 
-        val = val + "))"
+    for instance in session.query(model).filter(or_(*filters)):
+        unique_key = get_unique_key(dict((col, getattr(instance, col)) for col in unique_columns))
 
-    elif geo_type == "POINT":
-        val = 'POINT({} {})'.format(coordinates['longitude'],
-                                    coordinates['latitude'])
+        # e.g. a unit name that exists for another parameter type: unit names are unique
+        for key in unique_keys.get(unique_key, []):
+            ids[key] = instance.id
+            pending[key] = instance.id
 
-    # else:
-    #     print("Format {} is not supported!".format(geo_type))
 
-    return val
+def get_dimension_key(model, kwargs):
+    """
+    Hashable cache key of a dimension row, e.g. ('unit', ('name', '%'), ('type_id', 2))
+    """
+    values = []
 
+    for col, val in sorted(kwargs.items()):
+        if isinstance(val, enum.Enum):
+            val = val.value
+        elif isinstance(val, (dict, list)):
+            val = json.dumps(val, sort_keys=True)
 
-def convert_point_wkb(geo_point):
-    if geo_point is None:
-        return None
+        values.append((col, val))
 
-    point = wkb.loads(bytes(geo_point.data))
-    return point.x, point.y
+    return (model.__tablename__,) + tuple(values)
 
 
-def convert_polygon_wkb(area):
-    if area is None:
+def to_int(value):
+    if value is None or value == '':
         return None
 
-    polygon = wkb.loads(bytes(area.data))
-    coor_list = []
+    return int(value)
 
-    for coor in list(list(polygon.exterior.coords[:-1])):
-        coor_dict = {
-            'longitude': coor[0],
-            'latitude': coor[-1]
-        }
-        coor_list.append(coor_dict)
-    return coor_list
+
+def store_sensing_log(connection, df_data, loader=None):
+    """
+    Stores sensing log rows with the selected loader (see SENSING_LOADERS)
+    and returns the number of inserted rows
+    """
+    if loader is None:
+        loader = app.config.get('INGEST_LOADER', 'copy')
+
+    # COPY is only available on PostgreSQL
+    if loader == 'copy' and connection.dialect.name == 'postgresql':
+        return copy_sensing_log(connection, df_data)
+
+    return insert_sensing_log(connection, df_data)
+
+
+def copy_sensing_log(connection, df_data):
+    """
+    Streams sensing log rows with COPY into a temporary staging table and
+    moves them to sensing_log with one INSERT ... SELECT that skips rows already stored
+    """
+    buffer = tempfile.SpooledTemporaryFile(max_size=app.config.get('INGEST_COPY_BUFFER_SIZE'),
+                                           mode='w+', newline='',
+                                           dir=app.config.get('INGEST_SPOOL_DIR'))
+
+    try:
+        df_data[SENSING_STAGE_COLUMNS].to_csv(buffer, header=False, index=False,
+                                              date_format='%Y-%m-%d %H:%M:%S.%f')
+        buffer.seek(0)
+
+        # Raw psycopg2 cursor in the transaction of the connection
+        cursor = connection.connection.cursor()
+
+        try:
+            cursor.execute(SENSING_STAGE_CREATE)
+            cursor.copy_expert("COPY sensing_log_stage ({}) FROM STDIN WITH (FORMAT csv)"
+                               .format(', '.join(SENSING_STAGE_COLUMNS)), buffer)
+            cursor.execute("INSERT INTO sensing_log (observation_id, date_time, value, geo) "
+                           "SELECT observation_id, date_time, value, ST_MakePoint(longitude, latitude) "
+                           "FROM sensing_log_stage "
+                           "ON CONFLICT ON CONSTRAINT uix_sensing DO NOTHING")
+            inserted = cursor.rowcount
+            cursor.execute("TRUNCATE sensing_log_stage")
+        finally:
+            cursor.close()
+    finally:
+        buffer.close()
+
+    return inserted
+
+
+def insert_sensing_log(connection, df_data):
+    """
+    Inserts sensing log rows; the point geometry is made from the longitude and latitude values
+    """
+    if connection.dialect.name == 'postgresql':
+        statement = pg_insert(SensingLog.__table__).on_conflict_do_nothing(constraint='uix_sensing')
+    else:
+        statement = SensingLog.__table__.insert()
+
+    statement = statement.values(geo=func.ST_MakePoint(bindparam('longitude', type_=db.Float),
+                                        bindparam('latitude', type_=db.Float)))
+
+    # Missing values are stored as NULL
+    df_data = df_data.astype(object).where(pd.notnull(df_data), None)
+    result = connection.execute(statement, df_data.to_dict(orient="records"))
+
+    return result.rowcount
+
+
+def stage_sensing_log(connection, df_data, load_id, loader=None):
+    """
+    Stores sensing log rows in sensing_log_load under load_id with the selected loader,
+    until merge_sensing_log_load moves them to sensing_log
+    """
+    if loader is None:
+        loader = app.config.get('INGEST_LOADER', 'copy')
+
+    df_data = df_data.assign(load_id=load_id)
+
+    if loader != 'copy':
+        # Missing values are stored as NULL
+        df_data = df_data[SENSING_LOAD_COLUMNS]
+        df_data = df_data.astype(object).where(pd.notnull(df_data), None)
+        connection.execute(SensingLogLoad.__table__.insert(), df_data.to_dict(orient="records"))
+        return
+
+    buffer = tempfile.SpooledTemporaryFile(max_size=app.config.get('INGEST_COPY_BUFFER_SIZE'),
+                                           mode='w+', newline='',
+                                           dir=app.config.get('INGEST_SPOOL_DIR'))
+
+    try:
+        df_data[SENSING_LOAD_COLUMNS].to_csv(buffer, header=False, index=False,
+                                             date_format='%Y-%m-%d %H:%M:%S.%f')
+        buffer.seek(0)
+
+        cursor = connection.connection.cursor()
+
+        try:
+            cursor.copy_expert("COPY sensing_log_load ({}) FROM STDIN WITH (FORMAT csv)"
+                               .format(', '.join(SENSING_LOAD_COLUMNS)), buffer)
+        finally:
+            cursor.close()
+    finally:
+        buffer.close()
+
+
+def merge_sensing_log_load(staged, summary):
+    """
+    Moves the rows that load workers stored in sensing_log_load to sensing_log in the transaction
+    of the session, and counts the inserted and duplicate rows of every column.
+    Rows of uploads that were stopped before they could be moved or deleted are deleted
+    after INGEST_LOAD_EXPIRY seconds
+    """
+    for col_name, stage in staged.items():
+        result = db.session.execute(db.text(SENSING_LOAD_MERGE), {"load_id": stage["load_id"]})
+
+        col_summary = summary["columns"][col_name]
+        col_summary["inserted"] += result.rowcount
+        col_summary["duplicate"] += stage["rows"] - result.rowcount
+
+    expiry = timedelta(seconds=app.config.get('INGEST_LOAD_EXPIRY', 24 * 3600))
+    SensingLogLoad.query.filter(SensingLogLoad.created_at < func.now() - expiry) \
+        .delete(synchronize_session=False)
+
+
+def delete_sensing_log_load(staged):
+    """
+    Deletes the rows that load workers stored in sensing_log_load for a failed upload
+    """
+    load_ids = [stage["load_id"] for stage in staged.values()]
+
+    try:
+        SensingLogLoad.query.filter(SensingLogLoad.load_id.in_(load_ids)).delete(synchronize_session=False)
+        db.session.commit()
+    except exc.SQLAlchemyError:
+        # Deleted with the expired rows of the next upload instead
+        db.session.rollback()
+
+
+def parse_coordinate(df, coor_dict, coordinate, has_coordinate):
+    # If there is no column for longitude and latitude,
+    # use coordinate for all rows in the dataframe.
+    # The loader builds the point geometries from these float columns in the database
+    msg = ["OK", True]
+
+    if coor_dict and has_coordinate:
+        lat_col = coor_dict.get("latitude")
+        lon_col = coor_dict.get("longitude")
+
+        if not lat_col or not lon_col:
+            msg = ["Datamap should have both longitude and latitude columns", False]
+            return None, msg
+
+        # Values that are not numbers are stored without a location
+        df["longitude"] = pd.to_numeric(df[lon_col], errors='coerce')
+        df["latitude"] = pd.to_numeric(df[lat_col], errors='coerce')
+
+        col_list = [col for col in [lat_col, lon_col] if col not in ["longitude", "latitude"]]
+
+        df = df.drop(columns=col_list)
+    else:
+        try:
+            long = float(coordinate['longitude'])
+            lat = float(coordinate['latitude'])
+        except (TypeError, ValueError):
+            msg = ["Default longitude and latitude values should be float", False]
+            return None, msg
+
+        df["longitude"] = long
+        df["latitude"] = lat
+
+    return df, msg
+
+
+def parse_datetime_string(dtime_str):
+    msg = ["OK", True]
+    def_date = None
+    def_time = None
+
+    try:
+        dtime = dtparse.parse(dtime_str)
+        def_date = dtime.strftime("%Y-%m-%d")
+        def_time = dtime.strftime("%H:%M:%S")
+    except (ValueError, TypeError, OverflowError):
+        msg = ["Error in parsing default datetime {}".format(dtime_str), False]
+
+    return def_date, def_time, msg
+
+
+def parse_datetime(df, datetime_dict, default_time, has_date, has_time):
+    created_col_name = "date_time"
+    msg = ["OK", True]
+
+    if has_date or has_time:
+        col_list = []
+
+        if "datetime" in datetime_dict:
+            date_col = get_dict_value(datetime_dict, "datetime", subkey="column")
+
+            df[created_col_name] = to_datetime_series(df[date_col],
+                                                      get_dict_value(datetime_dict, "datetime", subkey="format"),
+                                                      get_dict_value(datetime_dict, "datetime", subkey="dayfirst"))
+
+            if date_col != created_col_name:
+                col_list.append(date_col)
+
+        elif "date" in datetime_dict or "time" in datetime_dict:
+            def_date, def_time, msg = get_default_date_time(default_time,
+                                                            "date" in datetime_dict,
+                                                            "time" in datetime_dict)
+            if msg[-1] is False:
+                return None, msg
+
+            if "date" in datetime_dict:
+                date_col = get_dict_value(datetime_dict, "date", subkey="column")
+                date_str = df[date_col].astype(str)
+                date_format = get_dict_value(datetime_dict, "date", subkey="format")
+                col_list.append(date_col)
+            else:
+                date_str = def_date
+                date_format = "%Y-%m-%d"
+
+            if "time" in datetime_dict:
+                time_col = get_dict_value(datetime_dict, "time", subkey="column")
+                time_str = df[time_col].astype(str)
+                time_format = get_dict_value(datetime_dict, "time", subkey="format")
+                col_list.append(time_col)
+            else:
+                time_str = def_time
+                time_format = "%H:%M:%S"
+
+            dtime_format = None
+            if date_format and time_format:
+                dtime_format = "{} {}".format(date_format, time_format)
+
+            dayfirst = get_dict_value(datetime_dict, "date", subkey="dayfirst")
+
+            df[created_col_name] = to_datetime_series(date_str + " " + time_str,
+                                                      dtime_format,
+                                                      dayfirst is not False)
+
+        elif "year" in datetime_dict or "hour" in datetime_dict:
+            def_date, def_time, msg = get_default_date_time(default_time,
+                                                            "year" in datetime_dict,
+                                                            "hour" in datetime_dict)
+            if msg[-1] is False:
+                return None, msg
+
+            parts = {}
+
+            if "year" in datetime_dict:
+                for unit in ["year", "month", "day"]:
+                    unit_col = get_dict_value(datetime_dict, unit, subkey="column")
+                    parts[unit] = to_numeric_series(df[unit_col], unit)
+                    col_list.append(unit_col)
+            else:
+                def_dtime = pd.Timestamp(def_date)
+                parts["year"] = def_dtime.year
+                parts["month"] = def_dtime.month
+                parts["day"] = def_dtime.day
+
+            if "hour" in datetime_dict:
+                for unit in ["hour", "minute", "second"]:
+                    unit_col = get_dict_value(datetime_dict, unit, subkey="column")
+                    if unit_col:
+                        parts[unit] = to_numeric_series(df[unit_col], unit)
+                        col_list.append(unit_col)
+                    else:
+                        parts[unit] = 0
+            else:
+                def_dtime = pd.Timestamp(def_time)
+                parts["hour"] = def_dtime.hour
+                parts["minute"] = def_dtime.minute
+                parts["second"] = def_dtime.second
+
+            parts_df = pd.DataFrame(parts, index=df.index)
+            df[created_col_name] = pd.to_datetime(parts_df, errors='coerce')
+
+        else:
+            msg = ["Error in parsing datetime contexts from datamap", False]
+            return None, msg
+
+        col_list = list(filter(None, col_list))
+        df = df.drop(columns=col_list)
+
+    else:
+        # Use default date and time
+        def_date, def_time, msg = parse_datetime_string(default_time)
+        if msg[-1] is False:
+            return None, msg
+
+        df[created_col_name] = "{} {}".format(def_date, def_time)
+
+    return df, msg
+
+
+def reject_rows(df, invalid, reason, summary=None):
+    """
+    Drops the rows flagged in the invalid mask and reports them in the ingest summary
+    """
+    if not invalid.any():
+        return df
+
+    if summary is not None:
+        rows = df.index[invalid]
+        summary["rejected_rows"] += len(rows)
+        add_row_errors(summary, rows, reason)
+
+    return df.loc[~invalid]
+
+
+def add_row_errors(summary, rows, reason):
+    # Row numbers start from 1 at the first data row of the file
+    max_errors = app.config.get('INGEST_MAX_REPORTED_ERRORS', 100)
+
+    for row in rows[:max(max_errors - len(summary["errors"]), 0)]:
+        summary["errors"].append({"row": int(row) + 1, "reason": reason})
+
+
+def get_default_date_time(default_time, has_date, has_time):
+    """
+    Returns the default date and time strings if the datamap maps only one of them to a column.
+    The missing part is taken from the default datetime, without one the file is rejected
+    """
+    if has_date and has_time:
+        return None, None, ["OK", True]
+
+    if not default_time:
+        missing = "time" if has_date else "date"
+        return None, None, ["Datamap has no {} column and no default datetime is given".format(missing), False]
+
+    return parse_datetime_string(default_time)
+
+
+def is_dayfirst(dtime_param):
+    return not (dtime_param and str(dtime_param).startswith("month-day-year"))
+
+
+def get_datetime_format(dtime_param):
+    """
+    Translates a datamap datetime parameter (e.g. 'YYYY-MM-DD hh:mm:ss' or
+    'day-month-year') to a strptime format, or None if it is not a known pattern
+    """
+    if not dtime_param:
+        return None
+
+    dtime_format = DATETIME_FORMAT_PATTERN.sub(lambda m: DATETIME_FORMAT_TOKENS[m.group(0)],
+                                               str(dtime_param))
+
+    # Any letter left outside a directive means the parameter is only a description
+    if re.search('[A-Za-z]', re.sub('%[A-Za-z]', '', dtime_format)):
+        return None
+
+    return dtime_format
+
+
+def to_datetime_series(series, dtime_format=None, dayfirst=True):
+    """
+    Parses a column of datetime strings at once; unparseable values become NaT
+    """
+    if dtime_format:
+        dtime = pd.to_datetime(series, format=dtime_format, errors='coerce')
+
+        # A format that matches nothing was only a description of the column
+        if dtime.notna().any():
+            return dtime
+
+    return pd.to_datetime(series, errors='coerce', dayfirst=dayfirst,
+                          infer_datetime_format=True)
+
+
+def to_numeric_series(series, unit):
+    values = pd.to_numeric(series, errors='coerce')
+
+    if unit == "month" and values.isna().any():
+        # Month names or abbreviations, e.g. 'Mar' or 'March'
+        names = series.astype(str).str.strip().str.lower().map(MONTH_NUMBERS)
+        values = values.fillna(names)
+
+    # Whole units only, e.g. a month read as 3.0
+    return np.floor(values)
+
+
+def get_dict_value(input_dict, key, subkey=None):
+    val = None
+
+    if input_dict is None:
+        return None
+
+    if key in input_dict:
+        sub_dict = input_dict[key]
+        if subkey:
+            if subkey in sub_dict:
+                val = sub_dict[subkey]
+        else:
+            val = sub_dict
+
+    return val
+
+
+def get_delimiter(csv_string):
+    dialect = csv.Sniffer().sniff(str(csv_string))
+    return dialect.delimiter
+
+
+def read_sample(file, size=None):
+    """
+    Reads the first complete lines (up to size bytes) of a file and rewinds it
+    """
+    if size is None:
+        size = app.config.get('INGEST_SNIFF_BYTES', 64 * 1024)
+
+    sample = file.read(size)
+    file.seek(0)
+
+    # Do not let a cut-off last line confuse the sniffer
+    if len(sample) == size and b'\n' in sample:
+        sample = sample[:sample.rindex(b'\n')]
+
+    return sample.decode('utf-8', errors='ignore')
+
+
+def spool_file(file):
+    """
+    Copies an uploaded file to a temporary file on disk and returns (file rewound, content digest).
+    The file has a path so columnar files can be memory-mapped
+    """
+    spooled = tempfile.NamedTemporaryFile(dir=app.config.get('INGEST_SPOOL_DIR'))
+    digest = save_file(file, spooled)
+    spooled.seek(0)
+
+    return spooled, digest
+
+
+def save_file(file, dst):
+    """
+    Copies an uploaded file to dst and returns the SHA-256 digest of its content
+    """
+    sha256 = hashlib.sha256()
+
+    for block in iter(partial(file.stream.read, 1024 * 1024), b''):
+        sha256.update(block)
+        dst.write(block)
+
+    return sha256.hexdigest()
+
+
+def hash_file(path):
+    sha256 = hashlib.sha256()
+
+    with open(path, 'rb') as file:
+        for block in iter(partial(file.read, 1024 * 1024), b''):
+            sha256.update(block)
+
+    return sha256.hexdigest()
+
+
+def get_dataframes(file, filetype, plan, chunk_size=None, summary=None):
+    """
+    Yields the dataframes of an upload of any allowed file type. Rows of the CSV files
+    in an archive are numbered on from the previous file; the summary lists where each file starts
+    """
+    if filetype in COLUMNAR_FILE_TYPES:
+        for df in get_columnar_dataframe(file, filetype, plan.columns, plan.has_header, chunk_size):
+            yield df
+
+        return
+
+    start = 0
+
+    # Added before the first chunk, the summary may be read by the loading thread (see pipeline_chunks)
+    files = summary.setdefault("files", []) if filetype in ARCHIVE_FILE_TYPES and summary is not None else None
+
+    for name, csv_file in get_csv_files(file, filetype):
+        first_row = start
+
+        for df in get_dataframe(csv_file, plan, chunk_size, start):
+            start += len(df.index)
+            yield df
+
+        if name is not None and files is not None:
+            files.append({"name": name, "first_row": first_row + 1, "rows": start - first_row})
+
+
+def get_csv_files(file, filetype):
+    """
+    Yields (name in the archive or None, file) of the CSV files in an upload.
+    Compressed files are decompressed while they are read
+    """
+    if filetype in ARCHIVE_FILE_TYPES:
+        archive = zipfile.ZipFile(file)
+        members = [info for info in archive.infolist()
+                   if get_file_ext(info.filename) == 'csv' and not info.filename.startswith('__MACOSX/')]
+
+        if not members:
+            raise zipfile.BadZipFile('Archive has no csv files')
+
+        for info in members:
+            with StreamReader(partial(archive.open, info)) as csv_file:
+                yield info.filename, csv_file
+
+    elif filetype in COMPRESSED_FILE_TYPES:
+        with StreamReader(partial(open_decompressed, file, filetype)) as csv_file:
+            yield None, csv_file
+
+    else:
+        yield None, file
+
+
+def open_decompressed(file, filetype):
+    file.seek(0)
+
+    if filetype == 'gz':
+        return gzip.GzipFile(fileobj=file, mode='rb')
+
+    return zstd.ZstdDecompressor().stream_reader(file, closefd=False)
+
+
+class StreamReader(io.RawIOBase):
+    """
+    Reads a stream that can only be read forward, such as a decompressed file,
+    as a file. Seeking back to the start opens the stream again
+    """
+
+    def __init__(self, open_stream):
+        super(StreamReader, self).__init__()
+        self.open_stream = open_stream
+        self.stream = None
+        self.position = 0
+        self.seek(0)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if offset != 0 or whence != io.SEEK_SET:
+            raise io.UnsupportedOperation('Stream can only be rewound to the start')
+
+        if self.stream is not None:
+            self.stream.close()
+
+        self.stream = self.open_stream()
+        self.position = 0
+
+        return 0
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = b''.join(iter(partial(self.stream.read, 1024 * 1024), b''))
+        else:
+            data = self.stream.read(size)
+
+        self.position += len(data)
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+
+        super(StreamReader, self).close()
+
+
+def get_dataframe(file, plan, chunk_size=None, start=0):
+    """
+    Yields dataframes of at most chunk_size rows (the whole file if chunk_size is not set).
+    Only the columns of the plan are parsed, with the dtypes of the plan.
+    Rows are numbered from start
+    """
+    sample = read_sample(file)
+    delimiter = get_delimiter(sample)
+    options = get_csv_options(plan, sample, delimiter)
+
+    reader = read_csv_chunks(file, options, chunk_size)
+    offset = 0
+
+    while True:
+        try:
+            df = next(reader)
+        except StopIteration:
+            return
+        except ValueError:
+            if all(dtype == 'str' for dtype in options['dtype'].values()):
+                raise
+
+            # A value column has a value that is not a number. Read the rest of the file
+            # without number dtypes; invalid values are rejected when the column is loaded
+            options['dtype'] = dict((col, dtype) for col, dtype in options['dtype'].items() if dtype == 'str')
+
+            file.seek(0)
+            reader = skip_csv_rows(read_csv_chunks(file, options, chunk_size), offset)
+            continue
+
+        # Keep counting rows across chunks for the rows reported in the summary
+        df.index = pd.RangeIndex(start + offset, start + offset + len(df.index))
+        offset += len(df.index)
+
+        yield df
+
+
+def skip_csv_rows(reader, rows):
+    """
+    Yields the dataframes of a reader without their first rows. Unlike the skiprows option
+    of read_csv, rows are counted as parsed: a quoted value may span lines and blank lines are skipped
+    """
+    for df in reader:
+        if rows >= len(df.index):
+            rows -= len(df.index)
+            continue
+
+        yield df.iloc[rows:]
+        rows = 0
+
+
+def get_csv_options(plan, sample, delimiter):
+    """
+    Returns the read_csv options that parse only the datamap columns of a plan
+    """
+    col_set = set(plan.columns)
+
+    if plan.has_header:
+        return {"sep": delimiter, "header": 0,
+                "usecols": lambda col: col in col_set,
+                "dtype": dict(plan.dtypes)}
+
+    # Name the columns from index + 1 (Datamap column starts from 1)
+    first_row = next(csv.reader(sample.splitlines()[:1], delimiter=delimiter), [])
+    names = [str(idx + 1) for idx in range(len(first_row))]
+
+    return {"sep": delimiter, "header": None, "names": names,
+            "usecols": [col for col in names if col in col_set],
+            "dtype": dict((col, dtype) for col, dtype in plan.dtypes.items() if col in names)}
+
+
+def read_csv_chunks(file, options, chunk_size=None):
+    if chunk_size:
+        for df in pd.read_csv(file, encoding='utf-8', chunksize=chunk_size, **options):
+            yield df
+    else:
+        yield pd.read_csv(file, encoding='utf-8', **options)
+
+
+def get_parallel_parse_path(file, filetype):
+    """
+    Returns the path of an uploaded CSV file that is large enough to be parsed
+    in byte ranges by the parse workers (INGEST_PARSE_WORKERS > 1), or None
+    """
+    path = getattr(file, 'name', None)
+
+    if (app.config.get('INGEST_PARSE_WORKERS', 1) < 2 or
+            filetype != 'csv' or
+            not isinstance(path, str) or
+            not os.path.isfile(path)):
+        return None
+
+    # Worker processes of ingest jobs cannot start processes of their own
+    if multiprocessing.current_process().daemon:
+        return None
+
+    if os.path.getsize(path) < 2 * app.config.get('INGEST_PARSE_RANGE_SIZE', 64 * 1024 * 1024):
+        return None
+
+    return path
+
+
+def get_parse_pool():
+    global parse_pool
+
+    with parse_pool_lock:
+        if parse_pool is None:
+            parse_pool = multiprocessing.get_context('spawn').Pool(
+                processes=app.config.get('INGEST_PARSE_WORKERS'))
+
+    return parse_pool
+
+
+def get_parallel_dataframes(path, plan, default_coordinate, default_time, chunk_size=None, summary=None):
+    """
+    Yields (dataframe, message) for every chunk of a CSV file that is split on line boundaries
+    into byte ranges, which the parse workers parse and transform at the same time.
+    Ranges are yielded in file order; at most two ranges per worker are parsed ahead.
+    Quoted values should not contain line breaks
+    """
+    with open(path, 'rb') as file:
+        sample = read_sample(file)
+        options, data_start = get_range_options(plan, sample, get_delimiter(sample), file)
+
+    ranges = get_byte_ranges(path, data_start, app.config.get('INGEST_PARSE_RANGE_SIZE', 64 * 1024 * 1024))
+    pool = get_parse_pool()
+    results = deque()
+
+    def submit():
+        byte_range = next(ranges, None)
+        if byte_range is not None:
+            results.append(pool.apply_async(parse_csv_range, (path, byte_range[0], byte_range[1], plan,
+                                                              options, default_coordinate, default_time)))
+
+    for _ in range(2 * app.config.get('INGEST_PARSE_WORKERS')):
+        submit()
+
+    offset = 0
+
+    while results:
+        df, nr_rows, range_summary, msg = results.popleft().get()
+        submit()
+
+        if msg[-1] is False:
+            yield None, msg
+            return
+
+        # Rows of a range are numbered from 0 by its worker
+        df.index = df.index + offset
+
+        if summary is not None:
+            summary["rejected_rows"] += range_summary["rejected_rows"]
+
+            for error in range_summary["errors"]:
+                add_row_errors(summary, [error["row"] - 1 + offset], error["reason"])
+
+        offset += nr_rows
+
+        if not chunk_size:
+            yield df, msg
+            continue
+
+        for pos in range(0, max(len(df.index), 1), chunk_size):
+            yield df.iloc[pos:pos + chunk_size], msg
+
+
+def get_range_options(plan, sample, delimiter, file):
+    """
+    Returns (read_csv options for byte ranges without the header line, offset of the first data row)
+    """
+    first_row = next(csv.reader(sample.splitlines()[:1], delimiter=delimiter), [])
+
+    if not plan.has_header:
+        return get_csv_options(plan, sample, delimiter), 0
+
+    file.seek(0)
+    file.readline()
+    data_start = file.tell()
+
+    col_set = set(plan.columns)
+
+    return {"sep": delimiter, "header": None, "names": first_row,
+            "usecols": [col for col in first_row if col in col_set],
+            "dtype": dict((col, dtype) for col, dtype in plan.dtypes.items() if col in first_row)}, data_start
+
+
+def get_byte_ranges(path, start, range_size):
+    """
+    Yields (start, end) byte ranges of about range_size bytes that end after a line break
+    """
+    size = os.path.getsize(path)
+
+    with open(path, 'rb') as file:
+        while start < size:
+            end = min(start + range_size, size)
+
+            if end < size:
+                file.seek(end)
+                file.readline()
+                end = file.tell()
+
+            yield start, end
+            start = end
+
+
+def parse_csv_range(path, start, end, plan, options, default_coordinate, default_time):
+    """
+    Parses and transforms the rows in a byte range of a CSV file in a parse worker.
+    Returns (dataframe with rows numbered from 0, number of parsed rows, summary, message)
+    """
+    summary = init_ingest_summary()
+
+    with open(path, 'rb') as file:
+        file.seek(start)
+        data = file.read(end - start)
+
+    try:
+        df = pd.read_csv(io.BytesIO(data), encoding='utf-8', **options)
+    except ValueError:
+        # A value column has a value that is not a number (see get_dataframe)
+        options = dict(options, dtype=dict((col, dtype) for col, dtype in options['dtype'].items()
+                                           if dtype == 'str'))
+        df = pd.read_csv(io.BytesIO(data), encoding='utf-8', **options)
+
+    nr_rows = len(df.index)
+    df, msg = transform_data(df, plan, default_coordinate, default_time, summary)
+
+    return df, nr_rows, summary, msg
+
+
+def get_columnar_dataframe(file, filetype, col_list, has_header, chunk_size=None):
+    """
+    Yields dataframes of at most chunk_size rows from a Parquet or Arrow IPC file.
+    Only the datamap columns in col_list are read; row groups and record batches
+    are sliced and merged into chunks without copying
+    """
+    source = get_arrow_source(file)
+
+    if filetype == 'parquet':
+        parquet_file = pq.ParquetFile(source)
+        columns = get_columnar_columns(parquet_file.schema.to_arrow_schema().names, col_list, has_header)
+        names = [name for name, col_name in columns]
+
+        tables = (parquet_file.read_row_group(i, columns=names)
+                  for i in range(parquet_file.num_row_groups))
+    else:
+        try:
+            reader = pa.ipc.open_file(source)
+            batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+        except pa.ArrowInvalid:
+            # Arrow IPC stream format, which has no file footer
+            source.seek(0)
+            reader = pa.ipc.open_stream(source)
+            batches = iter(reader)
+
+        columns = get_columnar_columns(reader.schema.names, col_list, has_header)
+        indexes = [reader.schema.get_field_index(name) for name, col_name in columns]
+
+        tables = (pa.Table.from_arrays([batch.column(i) for i in indexes],
+                                       names=[name for name, col_name in columns])
+                  for batch in batches)
+
+    # Keep counting rows across chunks, like the CSV reader, for the rows reported in the summary
+    start = 0
+
+    for table in get_table_chunks(tables, chunk_size):
+        df = table.to_pandas()
+        df.columns = [col_name for name, col_name in columns]
+        df.index = pd.RangeIndex(start, start + len(df.index))
+        start += len(df.index)
+
+        yield df
+
+
+def get_arrow_source(file):
+    # Spooled files on disk are memory-mapped so Arrow buffers point into the page cache
+    path = getattr(file, 'name', None)
+
+    if isinstance(path, str) and os.path.isfile(path):
+        return pa.memory_map(path)
+
+    return pa.PythonFile(file, mode='r')
+
+
+def get_columnar_columns(names, col_list, has_header):
+    """
+    Returns (file column name, datamap column name) of the datamap columns in a columnar file.
+    Without a header the datamap columns are positions starting from 1
+    """
+    col_set = set(col_list)
+
+    if has_header:
+        return [(name, name) for name in names if name in col_set]
+
+    return [(name, str(idx + 1)) for idx, name in enumerate(names) if str(idx + 1) in col_set]
+
+
+def get_table_chunks(tables, chunk_size=None):
+    """
+    Merges and slices Arrow tables into tables of chunk_size rows (one table if chunk_size is not set)
+    """
+    buffered = []
+    nr_rows = 0
+
+    for table in tables:
+        buffered.append(table)
+        nr_rows += table.num_rows
+
+        if not chunk_size or nr_rows < chunk_size:
+            continue
+
+        table = pa.concat_tables(buffered)
+        offset = 0
+
+        while table.num_rows - offset >= chunk_size:
+            yield table.slice(offset, chunk_size)
+            offset += chunk_size
+
+        buffered = [table.slice(offset)]
+        nr_rows = table.num_rows - offset
+
+    if nr_rows:
+        yield pa.concat_tables(buffered)
+
+
+def is_true(value):
+    return str(value).lower() in ['1', 'true', 'yes']
+
+
+def get_file_ext(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower()
+
+
+def get_allowed_file_types():
+    file_types = ['csv'] + COMPRESSED_FILE_TYPES + ARCHIVE_FILE_TYPES
+
+    if pa is not None:
+        file_types += COLUMNAR_FILE_TYPES
+
+    return file_types
+
+
+def allowed_file(filename):
+    allowed_ext = set(get_allowed_file_types())
+    ext = get_file_ext(filename)
+
+    # Compressed files are CSV files, e.g. data.csv.gz
+    if ext in COMPRESSED_FILE_TYPES:
+        inner_ext = get_file_ext(filename.rsplit('.', 1)[0])
+        if inner_ext and inner_ext != 'csv':
+            return False
+
+    return ext in allowed_ext
+
+
+def get_or_create(session, model, **kwargs):
+    """
+    Creates an object or returns the object if exists
+    """
+    instance = session.query(model).filter_by(**kwargs).first()
+    if instance:
+        return instance, False
+    else:
+        instance = model(**kwargs)
+        session.add(instance)
+        return instance, True
+
+
+def get_sensing_log(params, status_list, log_format=None):
+    """
+    Returns the observations of a field with their logs as a JSON string (legacy), or streamed
+    while they are read as one of LOG_STREAM_FORMATS
+    """
+    sensing, log_ids = get_sensing_schema(params, status_list)
+
+    if not sensing["observations"]:
+        return jsonify({'message': 'No observation data found'}), 404
+
+    # Time range, page size and the key of the last row of the previous page (see get_log_page)
+    log_filter = {
+        "start": params.get('start'),
+        "end": params.get('end'),
+        "after": params.get('after'),
+        "limit": params.get('limit')
+    }
+
+    if log_filter["limit"]:
+        # Every context type is read up to the same date_time, so a page does not scan the rest of the history
+        log_filter["bound"] = get_log_bound(log_ids, log_filter)
+
+    if log_format:
+        return get_sensing_log_stream(sensing, log_ids, log_filter, log_format)
+
+    logs, last_key = get_log_page([get_observation_log(ids, log_filter) for ids in log_ids],
+                                  log_filter["limit"])
+
+    for obs_dict, df in zip(sensing["observations"], logs):
+        obs_dict["log"] = set_sensing_log(df)
+
+    if log_filter["limit"]:
+        sensing["next_cursor"] = encode_log_cursor(last_key) if last_key else None
+
+    json_str = json.dumps(sensing)
+    response = jsonify(json_str), 200
+
+    return response
+
+
+def get_sensing_schema(params, status_list):
+    """
+    Reads the observations of a field that match params, grouped by context type.
+    Returns (sensing without logs, observation IDs of every context type)
+    """
+    context_type = params['context_type']
+
+    farm_id = int(params['farm_id'])
+    field_id = int(params['field_id'])
+
+    crop_field_id = None
+    if params.get('crop_field_id'):
+        crop_field_id = params['crop_field_id']
+
+    equipment_id = None
+    if params.get('equipment_id'):
+        equipment_id = int(params['equipment_id'])
+
+    # Get allowed accessibility status IDs and their names
+    acc_status = db.session.query(AccessibilityStatus)\
+        .filter(AccessibilityStatus.name.in_(status_list)).all()
+    acc_status_list = [s.id for s in acc_status]
+    acc_status_names = dict((s.id, s.name) for s in acc_status)
+
+    # Query observation data, grouped by context type
+    query = db.session.query(ObservedContext, ParameterType, Observation, Unit, ObservationLocation) \
+        .filter(ObservedContext.parameter_id == ParameterType.id,
+                ObservedContext.id == Observation.observed_context_id,
+                Observation.location_id == ObservationLocation.id,
+                Observation.unit_id == Unit.id) \
+        .filter(ObservationLocation.farm_id == farm_id,
+                ObservationLocation.field_id == field_id) \
+        .filter(ObservationLocation.access_id.in_(acc_status_list)) \
+        .order_by(ObservedContext.context_type, Observation.id)
+
+    if context_type:
+        ctype_list = [ObservedContextType(ct) for ct in context_type]
+        query = query.filter(ObservedContext.context_type.in_(ctype_list))
+
+    if crop_field_id:
+        query = query.filter(ObservationLocation.crop_field_id == crop_field_id)
+
+    if equipment_id:
+        query = query.filter(Observation.eq_id == equipment_id)
+
+    sensing = init_observation(farm_id, field_id, crop_field_id)
+    obs_dict = None
+    obs_ids = []
+    log_ids = []
+    idx = 0
+
+    for ocontext, paramtype, observation, unit, oloc in query.all():
+        if obs_dict is None or ocontext.context_type.value != obs_dict["type"]:
+            obs_ids = []
+            log_ids.append(obs_ids)
+
+            obs_meta, idx = init_observation_meta()
+
+            obs_dict = {
+                "type": ocontext.context_type.value,
+                "accessibility": acc_status_names.get(oloc.access_id),
+                "schema": obs_meta,
+                "log": []
+            }
+
+            sensing["observations"].append(obs_dict)
+
+        idx += 1
+        obs_meta = {
+            "column": idx,
+            "object": ocontext.context,
+            "parameter": paramtype.get_param(),
+            "equipment_id": observation.eq_id,
+            "observation_id": observation.id,
+            "conditions": observation.conditions,
+            "unit": unit.name
+        }
+        obs_dict["schema"].append(obs_meta)
+        obs_ids.append(observation.id)
+
+    return sensing, log_ids
+
+
+def get_sensing_log_stream(sensing, log_ids, log_filter, log_format):
+    """
+    Streams the logs from a server-side cursor while they are read. A page of a limit
+    ends at the same key for every context type; its cursor is sent in the X-Next-Cursor header
+    """
+    headers = {}
+
+    if log_filter["limit"]:
+        last_key = get_log_page_key(log_ids, log_filter)
+
+        # The page is read up to its last key, instead of limit rows per context type
+        log_filter = dict(log_filter, until=last_key, limit=None)
+        sensing["next_cursor"] = encode_log_cursor(last_key) if last_key else None
+        headers['X-Next-Cursor'] = sensing["next_cursor"] or ''
+
+    # Streamed schemas only describe the observations; the date_time, longitude and
+    # latitude placeholders of init_observation_meta are the fixed first columns of a row
+    for obs_dict in sensing["observations"]:
+        obs_dict["schema"] = [obs_meta for obs_meta in obs_dict["schema"] if obs_meta["observation_id"] is not None]
+
+    if log_format == 'csv':
+        content = get_csv_log(sensing, log_ids, log_filter)
+    else:
+        content = get_ndjson_log(sensing, log_ids, log_filter)
+
+    # The request context keeps the database session open while the response is sent
+    return Response(stream_with_context(content), mimetype=LOG_STREAM_FORMATS[log_format],
+                    headers=headers), 200
+
+
+def get_ndjson_log(sensing, log_ids, log_filter):
+    """
+    Yields NDJSON lines: the farm info (and next_cursor), then for every context type
+    an object with its schema followed by its log rows as arrays of date_time (epoch
+    milliseconds), longitude, latitude and the values in the order of the schema
+    """
+    yield json.dumps(dict((key, value) for key, value in sensing.items() if key != "observations")) + "\n"
+
+    for obs_dict, obs_ids in zip(sensing["observations"], log_ids):
+        yield json.dumps(dict((key, value) for key, value in obs_dict.items() if key != "log")) + "\n"
+
+        for rows in read_observation_log(obs_ids, log_filter):
+            yield "".join(json.dumps([get_epoch_millis(row[0])] + list(row[1:])) + "\n" for row in rows)
+
+
+def get_csv_log(sensing, log_ids, log_filter):
+    """
+    Yields CSV lines: a header with one column per observation of all context types,
+    then the log rows of every context type with values in their own columns
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    schemas = [obs_dict["schema"] for obs_dict in sensing["observations"]]
+    writer.writerow(['date_time', 'longitude', 'latitude'] +
+                    ["{}/{}/{} ({}) #{}".format(obs_dict["type"], obs_meta["object"], obs_meta["parameter"],
+                                                obs_meta["unit"], obs_meta["observation_id"])
+                     for obs_dict in sensing["observations"] for obs_meta in obs_dict["schema"]])
+
+    before = 0
+    after = sum(len(schema) for schema in schemas)
+
+    for schema, obs_ids in zip(schemas, log_ids):
+        after -= len(schema)
+
+        for rows in read_observation_log(obs_ids, log_filter):
+            writer.writerows([row[0].isoformat(), row[1], row[2]] + [None] * before + list(row[3:]) +
+                             [None] * after for row in rows)
+            yield get_buffer_text(buffer)
+
+        before += len(schema)
+
+    yield get_buffer_text(buffer)
+
+
+def get_buffer_text(buffer):
+    text = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+
+    return text
+
+
+def get_epoch_millis(date_time):
+    # Same date time values as the legacy log (DataFrame.to_json)
+    return calendar.timegm(date_time.timetuple()) * 1000 + date_time.microsecond // 1000
+
+
+def read_observation_log(observation_ids, log_filter=None):
+    """
+    Yields the log rows of get_observation_query in batches of LOG_STREAM_BATCH_SIZE rows,
+    read from a server-side cursor so they are not all held in memory
+    """
+    batch_size = app.config.get('LOG_STREAM_BATCH_SIZE', 1000)
+    query = get_observation_query(observation_ids, log_filter)
+
+    result = db.session.connection().execution_options(stream_results=True).execute(query.statement)
+
+    try:
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+
+            yield rows
+    finally:
+        result.close()
+
+
+def get_log_bound(log_ids, log_filter):
+    """
+    Returns the last date_time a page of limit rows can reach: the smallest limit-th distinct
+    date_time after the cursor of the context types. Date times are read in order from
+    ix_sensing_log_date_time, so at most limit of them are visited per context type.
+    None if no context type has limit more date times
+    """
+    limit = log_filter["limit"]
+    bounds = []
+
+    for obs_ids in log_ids:
+        query = db.session.query(SensingLog.date_time) \
+            .filter(SensingLog.observation_id.in_(obs_ids),
+                    SensingLog.geo.isnot(None))
+        query = filter_log_time(query, log_filter)
+
+        # Every date time after the one of the cursor has at least one row after the cursor
+        if log_filter.get("after"):
+            query = query.filter(SensingLog.date_time > log_filter["after"][0])
+
+        row = query.distinct().order_by(SensingLog.date_time).offset(limit - 1).limit(1).first()
+
+        if row is not None:
+            bounds.append(row[0])
+
+    return min(bounds) if bounds else None
+
+
+def filter_log_time(query, log_filter):
+    # The start is included, the end is not
+    if log_filter.get("start"):
+        query = query.filter(SensingLog.date_time >= log_filter["start"])
+
+    if log_filter.get("end"):
+        query = query.filter(SensingLog.date_time < log_filter["end"])
+
+    return query
+
+
+def get_log_page_key(log_ids, log_filter):
+    """
+    Returns the smallest key of the last rows of the context types that have a full page
+    of limit rows, or None if none of them has one
+    """
+    limit = log_filter["limit"]
+    keys = []
+
+    for obs_ids in log_ids:
+        row = get_observation_query(obs_ids, dict(log_filter, limit=None)).offset(limit - 1).limit(1).first()
+
+        if row is not None:
+            keys.append((row[0], float(row[1]), float(row[2])))
+
+    return min(keys) if keys else None
+
+
+def get_observation_log(observation_ids, log_filter=None):
+    """
+    Reads the sensing logs of the observations of a context type, see get_observation_query
+    """
+    query = get_observation_query(observation_ids, log_filter)
+
+    return pd.read_sql(query.statement, db.session.bind)
+
+
+def get_observation_query(observation_ids, log_filter=None):
+    """
+    Query of the sensing logs of the observations of a context type, pivoted in the
+    database: one row per date_time and location with the (mean) value of every
+    observation, in the order of observation_ids. Points are decoded to longitude and
+    latitude by PostGIS. log_filter limits the rows to a time range and a page
+    (after the cursor key, up to the bound of get_log_bound)
+    """
+    longitude = func.ST_X(SensingLog.geo)
+    latitude = func.ST_Y(SensingLog.geo)
+
+    values = [func.avg(SensingLog.value).filter(SensingLog.observation_id == obs_id).label(str(obs_id))
+              for obs_id in observation_ids]
+
+    query = db.session.query(SensingLog.date_time, longitude.label('longitude'), latitude.label('latitude'),
+                             *values) \
+        .filter(SensingLog.observation_id.in_(observation_ids),
+                SensingLog.geo.isnot(None))
+
+    if log_filter:
+        query = filter_log_time(query, log_filter)
+
+        # The date_time conditions limit the index scan, the row comparison is only a filter
+        if log_filter.get("after"):
+            query = query.filter(SensingLog.date_time >= log_filter["after"][0],
+                                 tuple_(SensingLog.date_time, longitude, latitude) > tuple_(*log_filter["after"]))
+
+        if log_filter.get("bound"):
+            query = query.filter(SensingLog.date_time <= log_filter["bound"])
+
+        if log_filter.get("until"):
+            query = query.filter(tuple_(SensingLog.date_time, longitude, latitude) <= tuple_(*log_filter["until"]))
+
+    query = query.group_by(SensingLog.date_time, longitude, latitude) \
+        .order_by(SensingLog.date_time, longitude, latitude)
+
+    if log_filter and log_filter.get("limit"):
+        query = query.limit(log_filter["limit"])
+
+    return query
+
+
+def get_log_page(logs, limit=None):
+    """
+    Cuts the logs of several context types to one page: rows up to the smallest last key
+    (date_time, longitude, latitude) of the logs that have limit rows, so the next page
+    can start after that key for every context type.
+    Returns (logs, last key or None if there are no more rows)
+    """
+    full_logs = [df for df in logs if limit and len(df.index) >= limit]
+
+    if not full_logs:
+        return logs, None
+
+    last_key = min(get_log_key(df.iloc[-1]) for df in full_logs)
+
+    return [df[is_log_key_until(df, last_key)] for df in logs], last_key
+
+
+def get_log_key(row):
+    return pd.Timestamp(row["date_time"]).to_pydatetime(), float(row["longitude"]), float(row["latitude"])
+
+
+def is_log_key_until(df, key):
+    date_time, longitude, latitude = key
+
+    return (df["date_time"] < date_time) | \
+           ((df["date_time"] == date_time) &
+            ((df["longitude"] < longitude) | ((df["longitude"] == longitude) & (df["latitude"] <= latitude))))
+
+
+def encode_log_cursor(key):
+    """
+    Opaque cursor of a log key: URL-safe base64 of the key as JSON
+    """
+    date_time, longitude, latitude = key
+    content = json.dumps([date_time.isoformat(), longitude, latitude])
+
+    return base64.urlsafe_b64encode(content.encode('utf-8')).decode('ascii')
+
+
+def decode_log_cursor(cursor):
+    """
+    Returns (log key, message) of a cursor made by encode_log_cursor
+    """
+    try:
+        date_time, longitude, latitude = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        key = dtparse.parse(date_time), float(longitude), float(latitude)
+    except (TypeError, ValueError, UnicodeError):
+        return None, ["Invalid cursor {}".format(cursor), False]
+
+    return key, ["OK", True]
+
+
+def set_sensing_log(df):
+    return df.to_json(orient='values')
+
+
+def to_geo_string(coordinates, geo_type="POLYGON"):
+    val = None
+
+    if coordinates is None:
+        return None
+
+    if geo_type == "POLYGON":
+        # Prevent geometry non-closed rings error
+        if coordinates[0] != coordinates[-1]:
+            coordinates.append(coordinates[0])
+
+        val = 'POLYGON(('
+
+        for num, coor in enumerate(coordinates, start=1):
+            point = "{} {}".format(coor['longitude'], coor['latitude'])
+
+            if num > 1:
+                val = "{},{}".format(val, point)
+            else:
+                val = "{}{}".format(val, point)
+
+        val = val + "))"
+
+    elif geo_type == "POINT":
+        val = 'POINT({} {})'.format(coordinates['longitude'],
+                                    coordinates['latitude'])
+
+    # else:
+    #     print("Format {} is not supported!".format(geo_type))
+
+    return val
+
+
+def convert_polygon_wkb(area):
+    if area is None:
+        return None
+
+    polygon = wkb.loads(bytes(area.data))
+    coor_list = []
+
+    for coor in list(list(polygon.exterior.coords[:-1])):
+        coor_dict = {
+            'longitude': coor[0],
+            'latitude': coor[-1]
+        }
+        coor_list.append(coor_dict)
+    return coor_list
 
 
 def get_observation_types():
@@ -803,6 +2383,26 @@ def init_observation(fm_id, fl_id, cf_id):
     }
 
 
+def init_ingest_summary():
+    return {
+        "chunks": 0,
+        "rows": 0,
+        "rejected_rows": 0,
+        "columns": {},
+        "errors": [],
+    }
+
+
+def init_column_summary():
+    return {
+        "inserted": 0,
+        "duplicate": 0,
+        "rejected": 0,
+        "failed": 0,
+        "error": None,
+    }
+
+
 def init_observation_meta():
     meta = []
 
@@ -22,3 +22,82 @@ class Config(object):
 
     # silence the warning that signals the application every time a change is about to be made in the database
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # uploaded observation files are spooled to disk and parsed in chunks of rows
+    # (0 parses the whole file at once)
+    INGEST_CHUNK_SIZE = int(os.environ.get('INGEST_CHUNK_SIZE') or 50000)
+    INGEST_SNIFF_BYTES = int(os.environ.get('INGEST_SNIFF_BYTES') or 64 * 1024)
+    INGEST_SPOOL_DIR = os.environ.get('INGEST_SPOOL_DIR')
+    INGEST_MAX_REPORTED_ERRORS = int(os.environ.get('INGEST_MAX_REPORTED_ERRORS') or 100)
+
+    # sensing log rows are loaded with PostgreSQL COPY ('copy') or INSERT statements ('insert');
+    # COPY buffers larger than INGEST_COPY_BUFFER_SIZE bytes are spooled to disk
+    INGEST_LOADER = os.environ.get('INGEST_LOADER') or 'copy'
+    INGEST_COPY_BUFFER_SIZE = int(os.environ.get('INGEST_COPY_BUFFER_SIZE') or 16 * 1024 * 1024)
+
+    # dtype of datamap value columns when files are parsed ('float64' or 'float32')
+    INGEST_VALUE_DTYPE = os.environ.get('INGEST_VALUE_DTYPE') or 'float64'
+
+    # number of threads that load the columns of an upload concurrently, each on its own
+    # database connection (1 loads the columns one after another in the upload transaction);
+    # keep it below the connection pool size
+    INGEST_LOAD_WORKERS = int(os.environ.get('INGEST_LOAD_WORKERS') or 1)
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': int(os.environ.get('SQLALCHEMY_POOL_SIZE') or 10),
+    }
+
+    # the load workers store their columns in a staging table that is moved to sensing_log when the
+    # upload is committed; rows of uploads that were stopped are deleted after INGEST_LOAD_EXPIRY seconds
+    INGEST_LOAD_EXPIRY = int(os.environ.get('INGEST_LOAD_EXPIRY') or 24 * 3600)
+
+    # CSV files of at least two INGEST_PARSE_RANGE_SIZE byte ranges are parsed by INGEST_PARSE_WORKERS
+    # worker processes, one range at a time each (1 parses them in the upload request)
+    INGEST_PARSE_WORKERS = int(os.environ.get('INGEST_PARSE_WORKERS') or 1)
+    INGEST_PARSE_RANGE_SIZE = int(os.environ.get('INGEST_PARSE_RANGE_SIZE') or 64 * 1024 * 1024)
+
+    # number of chunks that are extracted ahead in a separate thread while a chunk is loaded
+    # into the database (0 extracts and loads them one after another)
+    INGEST_PIPELINE_DEPTH = int(os.environ.get('INGEST_PIPELINE_DEPTH') or 2)
+
+    # uploads with async=true are ingested by INGEST_WORKERS local worker processes;
+    # at most INGEST_JOB_QUEUE_SIZE more jobs wait, further uploads get 503 with Retry-After
+    INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS') or 2)
+    INGEST_JOB_QUEUE_SIZE = int(os.environ.get('INGEST_JOB_QUEUE_SIZE') or 8)
+    INGEST_RETRY_AFTER = int(os.environ.get('INGEST_RETRY_AFTER') or 30)
+
+    # a worker process is replaced after INGEST_WORKER_MAX_TASKS jobs (0 keeps it); queued and
+    # running jobs are updated every INGEST_JOB_HEARTBEAT seconds, jobs that were not updated for
+    # INGEST_JOB_TIMEOUT seconds (killed worker, restarted service) are failed. Byte ranges that
+    # are written to resumable uploads are reserved the same way
+    INGEST_WORKER_MAX_TASKS = int(os.environ.get('INGEST_WORKER_MAX_TASKS') or 20)
+    INGEST_JOB_HEARTBEAT = int(os.environ.get('INGEST_JOB_HEARTBEAT') or 30)
+    INGEST_JOB_TIMEOUT = int(os.environ.get('INGEST_JOB_TIMEOUT') or 300)
+
+    # jobs that ingest resumable uploads while they are received (eager=true) check for new
+    # bytes every INGEST_UPLOAD_POLL_INTERVAL seconds and fail after INGEST_UPLOAD_TIMEOUT idle seconds
+    INGEST_UPLOAD_POLL_INTERVAL = float(os.environ.get('INGEST_UPLOAD_POLL_INTERVAL') or 1)
+    INGEST_UPLOAD_TIMEOUT = int(os.environ.get('INGEST_UPLOAD_TIMEOUT') or 3600)
+
+    # at most INGEST_MAX_EAGER_UPLOADS of the INGEST_WORKERS run eager jobs, each for a whole upload;
+    # further eager uploads are ingested when they are finalized
+    INGEST_MAX_EAGER_UPLOADS = int(os.environ.get('INGEST_MAX_EAGER_UPLOADS') or 1)
+
+    # upload sessions that were not used for INGEST_UPLOAD_EXPIRY seconds are deleted with their file
+    INGEST_UPLOAD_EXPIRY = int(os.environ.get('INGEST_UPLOAD_EXPIRY') or 24 * 3600)
+
+    # readings pushed to /observations/stream are stored per INGEST_STREAM_BATCH_SIZE readings,
+    # or INGEST_STREAM_FLUSH_INTERVAL seconds after the first reading of a batch was received
+    INGEST_STREAM_BATCH_SIZE = int(os.environ.get('INGEST_STREAM_BATCH_SIZE') or 1000)
+    INGEST_STREAM_FLUSH_INTERVAL = float(os.environ.get('INGEST_STREAM_FLUSH_INTERVAL') or 1)
+
+    # observation logs downloaded with format=ndjson or format=csv are read from a server-side
+    # cursor in batches of LOG_STREAM_BATCH_SIZE rows
+    LOG_STREAM_BATCH_SIZE = int(os.environ.get('LOG_STREAM_BATCH_SIZE') or 1000)
+
+    # maximum number of resolved dimension IDs kept in memory
+    DIMENSION_CACHE_SIZE = int(os.environ.get('DIMENSION_CACHE_SIZE') or 10000)
+
+    # compiled datamap ingest plans kept in memory; a datamap is fetched again from the
+    # mapping service INGEST_PLAN_TTL seconds after the last fetch (0 fetches it on every upload)
+    INGEST_PLAN_CACHE_SIZE = int(os.environ.get('INGEST_PLAN_CACHE_SIZE') or 256)
+    INGEST_PLAN_TTL = int(os.environ.get('INGEST_PLAN_TTL') or 60)
@@ -150,24 +150,27 @@ class PerformanceTest(object):
         map_id = store_datamap(map_url, farm_id, self.user_header, payload)
         return map_id
 
-    def upload_data(self, data_nr, farm_id, field_id, crop_field_id, map_id):
+    def upload_data(self, data_nr, farm_id, field_id, crop_field_id, map_id, loader=None):
         csv_name = "{}datamap_test_{}.csv".format(self.folder_name, data_nr)
 
         f = open(csv_name, 'rb')
-        mp_encoder = MultipartEncoder(
-            fields={
-                'farm_id': str(farm_id),
-                'field_id': str(field_id),
-                'crop_field_id': str(crop_field_id),
-                'equipment_id': None,
-                'map_id': str(map_id),
-                'accessibility': "public",
-
-                # plain file object, no filename or mime type produces a
-                # Content-Disposition header with just the part name
-                'file': (csv_name, f.read(), 'text/plain'),
-            }
-        )
+        fields = {
+            'farm_id': str(farm_id),
+            'field_id': str(field_id),
+            'crop_field_id': str(crop_field_id),
+            'equipment_id': None,
+            'map_id': str(map_id),
+            'accessibility': "public",
+
+            # plain file object, no filename or mime type produces a
+            # Content-Disposition header with just the part name
+            'file': (csv_name, f.read(), 'text/plain'),
+        }
+
+        if loader:
+            fields['loader'] = loader
+
+        mp_encoder = MultipartEncoder(fields=fields)
 
         now = datetime.now()
         dt_string = now.strftime("%Y-%m-%d %H:%M:%S")
@@ -331,6 +334,48 @@ class PerformanceTest(object):
             for item in time_list:
                 f.write("%s\n" % item)
 
+    def count_sensing_rows(self, data_nr):
+        # Number of sensing log rows an upload of the test file stores
+        csv_name = "{}datamap_test_{}.csv".format(self.folder_name, data_nr)
+        map_filename = '{}map.json'.format(self.folder_name)
+
+        with open(map_filename, 'r') as fp:
+            map_payload = json.load(fp)
+
+        with open(csv_name, 'r') as f:
+            nr_rows = sum(1 for line in f)
+
+        if map_payload["has_header"]:
+            nr_rows -= 1
+
+        nr_cols = len([dmap for dmap in map_payload["maps"]
+                       if dmap["observation"]["type"] not in ["datetime", "coordinate"]])
+
+        return nr_rows * nr_cols
+
+    def loader_test(self, farm_id, field_id, cfield_id, map_id):
+        print("loader test")
+        data_nr = self.total_cfield
+        nr_sensing_rows = self.count_sensing_rows(data_nr)
+
+        self.user_header, self.user_id = admin_login(auth_url)
+
+        rate_list = []
+        for loader in ["insert", "copy"]:
+            elapsed_time = self.upload_data(data_nr, farm_id, field_id, cfield_id, map_id, loader=loader)
+            rows_per_sec = nr_sensing_rows / elapsed_time
+            rate_list.append((loader, rows_per_sec))
+            print("{} loader: {:.0f} rows/sec".format(loader, rows_per_sec))
+
+            self.delete_data(farm_id, field_id, cfield_id)
+
+        # Save rows per second of each loader
+        filename = '{}loader_rows_per_sec.txt'.format(self.folder_name)
+
+        with open(filename, 'w') as f:
+            for loader, rows_per_sec in rate_list:
+                f.write("%s %s\n" % (loader, rows_per_sec))
+
     def download_test(self, farm_id, field_id, crop_field_id):
         time_list = []
 
@@ -362,6 +407,7 @@ if __name__ == '__main__':
     cfield_id = 65
     map_id = 69
     # pt.upload_test(farm_id, field_id, cfield_id, map_id)
+    # pt.loader_test(farm_id, field_id, cfield_id, map_id)
 
     pt.download_test(farm_id, field_id, cfield_id)
 
@@ -1,15 +1,30 @@
 import unittest
+import csv
+import io
 import json
 import requests
 import dateutil.parser as dtparse
 # import string
 # import random
 from requests_toolbelt.multipart.encoder import MultipartEncoder
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import time
+import gzip
+import zipfile
+import zstandard as zstd
 # import pandas as pd
 # import numpy as np
 from .test_utils import *
 
+# Parquet and Arrow test files are written with pyarrow
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
 sens_url = 'http://127.0.0.1:5002/api'
 auth_url = 'http://127.0.0.1:5003/api'
 map_url = 'http://127.0.0.1:5001/api'
@@ -1084,6 +1099,680 @@ class TestEndpoints(unittest.TestCase):
                                    headers=self.admin_header)
         self.assertEqual(response.status_code, 204)
 
+    def test_upload_observation_async(self):
+        field_id = self.create_upload_field("Test async field")
+        csv_name, map_id = self.create_upload_datamap(sample_data=100)
+
+        with open(csv_name, 'rb') as f:
+            response = self.post_observation_file(csv_name, f.read(), field_id=field_id, map_id=map_id,
+                                                  **{'async': "true"})
+        self.assertEqual(response.status_code, 202)
+        job_id = response.json()["job_id"]
+
+        # Poll the job until a worker has finished it
+        job = None
+        for _ in range(60):
+            response = requests.get('{}/observations/jobs/{}'.format(sens_url, job_id),
+                                    headers=self.admin_header)
+            self.assertEqual(response.status_code, 200)
+
+            job = response.json()
+            if job["status"] in ["finished", "failed"]:
+                break
+            time.sleep(1)
+
+        self.assertEqual(job["status"], "finished")
+        self.assertEqual(job["rows"], 100)
+
+        response = requests.get('{}/observations/jobs/{}'.format(sens_url, "unknown"),
+                                headers=self.admin_header)
+        self.assertEqual(response.status_code, 404)
+
+        self.delete_upload_datamap(map_id)
+
+    def test_upload_observation_resumable(self):
+        farm_id = self.farm_infos[0]["farm_id"]
+        field_id = self.create_upload_field("Test resumable field")
+        csv_name, map_id = self.create_upload_datamap(sample_data=100)
+
+        with open(csv_name, 'rb') as f:
+            content = f.read()
+
+        response = requests.post("{}/observations/uploads".format(sens_url),
+                                 data={
+                                     'farm_id': str(farm_id),
+                                     'field_id': str(field_id),
+                                     'map_id': str(map_id),
+                                     'accessibility': "public",
+                                     'filename': csv_name,
+                                     'size': str(len(content)),
+                                 },
+                                 headers=self.admin_header)
+        self.assertEqual(response.status_code, 201)
+        upload_id = response.json()["upload_id"]
+        upload_url = '{}/observations/uploads/{}'.format(sens_url, upload_id)
+
+        # Send the file in two byte ranges
+        half = len(content) // 2
+        headers = dict(self.admin_header)
+        headers['Content-Range'] = 'bytes 0-{}/{}'.format(half - 1, len(content))
+
+        response = requests.put(upload_url, data=content[:half], headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["offset"], half)
+
+        response = requests.get(upload_url, headers=self.admin_header)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["offset"], half)
+
+        # A range that does not continue at the offset is rejected
+        headers['Content-Range'] = 'bytes 0-{}/{}'.format(half - 1, len(content))
+        response = requests.put(upload_url, data=content[:half], headers=headers)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["offset"], half)
+
+        headers['Content-Range'] = 'bytes {}-{}/{}'.format(half, len(content) - 1, len(content))
+        response = requests.put(upload_url, data=content[half:], headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["offset"], len(content))
+
+        response = requests.post('{}/finalize'.format(upload_url), headers=self.admin_header)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["summary"]["rows"], 100)
+
+        response = requests.put(upload_url, data=content[:half], headers=headers)
+        self.assertEqual(response.status_code, 409)
+
+        self.delete_upload_datamap(map_id)
+
+    def test_upload_observation_duplicate(self):
+        field_id = self.create_upload_field("Test duplicate field")
+        csv_name, map_id = self.create_upload_datamap()
+
+        # An empty value in file row 3 and a value that is not a number in file row 5
+        df = pd.read_csv(csv_name)
+        df["test_0"] = df["test_0"].astype(object)
+        df["test_1"] = df["test_1"].astype(object)
+        df.loc[2, "test_0"] = ""
+        df.loc[4, "test_1"] = "abc"
+        content = df.to_csv(index=False).encode('utf-8')
+
+        results = []
+        for force in ["false", "false", "true"]:
+            response = self.post_observation_file(csv_name, content, field_id=field_id, map_id=map_id,
+                                                  force=force)
+            self.assertEqual(response.status_code, 200)
+            results.append(response.json())
+
+        # The identical upload returns the first result, a forced upload is loaded again
+        self.assertNotIn("duplicate", results[0])
+        self.assertTrue(results[1]["duplicate"])
+        self.assertEqual(results[1]["summary"], results[0]["summary"])
+        self.assertNotIn("duplicate", results[2])
+
+        # The forced upload stores no row twice
+        expected = [{"test_0": (9, 0, 1), "test_1": (9, 0, 1), "test_2": (10, 0, 0)},
+                    {"test_0": (0, 9, 1), "test_1": (0, 9, 1), "test_2": (0, 10, 0)}]
+
+        for result, counts in zip([results[0], results[2]], expected):
+            summary = result["summary"]
+            self.assertEqual(summary["rows"], 10)
+
+            for col_name, (inserted, duplicate, rejected) in counts.items():
+                col_summary = summary["columns"][col_name]
+                self.assertEqual(col_summary["inserted"], inserted)
+                self.assertEqual(col_summary["duplicate"], duplicate)
+                self.assertEqual(col_summary["rejected"], rejected)
+                self.assertEqual(col_summary["failed"], 0)
+
+            self.assertCountEqual(summary["errors"],
+                                  [{"row": 3, "reason": "Invalid value in column test_0"},
+                                   {"row": 5, "reason": "Invalid value in column test_1"}])
+
+        self.delete_upload_datamap(map_id)
+
+    def test_upload_observation_failure(self):
+        field_id = self.create_upload_field("Test failure field")
+
+        # More rows than INGEST_CHUNK_SIZE, so the first chunk is loaded before the end is read
+        csv_name, map_id = self.create_upload_datamap(sample_data=60000)
+
+        with open(csv_name, 'rb') as f:
+            content = gzip.compress(f.read())
+
+        # The compressed file ends before its last rows
+        response = self.post_observation_file(csv_name + '.gz', content[:-1000],
+                                              field_id=field_id, map_id=map_id)
+        self.assertEqual(response.status_code, 400)
+        self.assertGreater(response.json()["summary"]["rows"], 0)
+
+        # None of the rows of the failed upload are stored, with one or more load workers
+        params = {'farm_id': self.farm_infos[0]["farm_id"], 'field_id': field_id, 'format': "csv"}
+        response = requests.get('{}/observations'.format(sens_url),
+                                params=params, headers=self.admin_header)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(list(csv.reader(io.StringIO(response.text)))), 1)
+
+        self.delete_upload_datamap(map_id)
+
+    def test_upload_observation_datetime(self):
+        # The parsed datetimes of two rows, from the supported kinds of datetime columns
+        cases = [("datetime", {"Datetime": ("datetime", "YYYY-MM-DD hh:mm:ss")},
+                  {"Datetime": ["2021-03-04 05:06:07", "2021-12-31 23:59:59"]}, None,
+                  ["2021-03-04T05:06:07", "2021-12-31T23:59:59"]),
+                 ("month-day-year", {"Date": ("date", "month-day-year"), "Time": ("time", "hh:mm:ss")},
+                  {"Date": ["03-04-2021", "12-31-2021"], "Time": ["05:06:07", "23:59:59"]}, None,
+                  ["2021-03-04T05:06:07", "2021-12-31T23:59:59"]),
+                 ("date only", {"Date": ("date", "YYYY-MM-DD")},
+                  {"Date": ["2021-03-04", "2021-12-31"]}, "2000-01-01 05:06:07",
+                  ["2021-03-04T05:06:07", "2021-12-31T05:06:07"]),
+                 ("date parts", {"Year": ("year", None), "Month": ("month", None), "Day": ("day", None),
+                                 "Hour": ("hour", None), "Minute": ("minute", None)},
+                  {"Year": [2021, 2021], "Month": ["Mar", "12"], "Day": [4, 31], "Hour": [5, 23], "Minute": [6, 59]},
+                  None, ["2021-03-04T05:06:00", "2021-12-31T23:59:00"])]
+
+        for name, datetime_maps, columns, default_time, expected in cases:
+            with self.subTest(datetime=name):
+                params = {'datetime': default_time} if default_time else None
+                response, date_times = self.upload_datetime_file("Test {} field".format(name),
+                                                                 datetime_maps, columns, params)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.json()["summary"]["rejected_rows"], 0)
+                self.assertEqual(sorted(date_times), expected)
+
+    def test_upload_observation_invalid_datetime(self):
+        response, date_times = self.upload_datetime_file(
+            "Test invalid datetime field",
+            {"Datetime": ("datetime", "YYYY-MM-DD hh:mm:ss")},
+            {"Datetime": ["2021-03-04 05:06:07", "not a date", "2021-12-31 23:59:59"]})
+        self.assertEqual(response.status_code, 200)
+
+        # Rows are numbered from 1 at the first data row of the file
+        summary = response.json()["summary"]
+        self.assertEqual(summary["rejected_rows"], 1)
+        self.assertEqual(summary["errors"], [{"row": 2, "reason": "Invalid datetime"}])
+        self.assertEqual(sorted(date_times), ["2021-03-04T05:06:07", "2021-12-31T23:59:59"])
+
+    def test_upload_observation_missing_datetime(self):
+        # Without a default datetime the part of the datetime without a column is missing
+        cases = [("time", {"Date": ("date", "YYYY-MM-DD")}, {"Date": ["2021-03-04"]}),
+                 ("date", {"Time": ("time", "hh:mm:ss")}, {"Time": ["05:06:07"]})]
+
+        for missing, datetime_maps, columns in cases:
+            with self.subTest(missing=missing):
+                response, date_times = self.upload_datetime_file("Test missing {} field".format(missing),
+                                                                 datetime_maps, columns)
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.json()["message"],
+                                 "Datamap has no {} column and no default datetime is given".format(missing))
+                self.assertEqual(date_times, [])
+
+    def upload_datetime_file(self, field_name, datetime_maps, columns, params=None):
+        """
+        Uploads a csv file with datetime, coordinate and value columns to a new field.
+        datetime_maps has the (context, parameter) of every datetime column and columns their values.
+        Returns the response and the date_time values stored in the field
+        """
+        rows = len(next(iter(columns.values())))
+
+        df = pd.DataFrame(columns)
+        df["latitude"] = [1.5] * rows
+        df["longitude"] = [2.5] * rows
+        df["value"] = np.arange(rows, dtype=float)
+
+        map_list = [{"column": col,
+                     "observation": {"type": "datetime", "context": context, "parameter": param,
+                                     "description": random_string(5), "unit": None, "conditions": None}}
+                    for col, (context, param) in datetime_maps.items()]
+        map_list += [create_map("latitude", "latitude"), create_map("longitude", "longitude"),
+                     create_map("value", "data")]
+
+        contexts = [context for context, param in datetime_maps.values()]
+        map_payload = {
+            "name": random_string(),
+            "description": random_string(),
+            "has_header": True,
+            "has_coordinate": True,
+            "has_date": any(context in ["datetime", "date", "year"] for context in contexts),
+            "has_time": any(context in ["datetime", "time", "hour"] for context in contexts),
+            "model_id": None,
+            "maps": map_list,
+            "accessibility": "public",
+        }
+
+        map_id = store_datamap(map_url, self.farm_infos[0]["farm_id"], self.admin_header, map_payload)
+        self.assertIsNotNone(map_id)
+
+        field_id = self.create_upload_field(field_name)
+        response = self.post_observation_file("datetime.csv", df.to_csv(index=False).encode('utf-8'),
+                                              params=params, field_id=field_id, map_id=map_id)
+
+        self.delete_upload_datamap(map_id)
+
+        params = {'farm_id': self.farm_infos[0]["farm_id"], 'field_id': field_id, 'format': "csv"}
+        log_response = requests.get('{}/observations'.format(sens_url),
+                                    params=params, headers=self.admin_header)
+        self.assertEqual(log_response.status_code, 200)
+
+        return response, [row[0] for row in list(csv.reader(io.StringIO(log_response.text)))[1:]]
+
+    def create_upload_field(self, field_name, coordinates=None):
+        """
+        Creates a field in the first farm and returns its ID
+        """
+        farm_id = self.farm_infos[0]["farm_id"]
+
+        field_payload = {
+            'field_name': field_name,
+            'coordinates': coordinates or [{"latitude": x, "longitude": 2 * x} for x in range(4)],
+            'size_in_hectare': 2.5,
+            'soil_type_id': 1,
+            'accessibility': "public"
+        }
+
+        response = requests.post('{}/farms/{}/fields'.format(sens_url, farm_id),
+                                 json=field_payload, headers=self.admin_header)
+        self.assertEqual(response.status_code, 201)
+
+        return response.json()["field_id"]
+
+    def create_upload_datamap(self, sample_data=10):
+        """
+        Writes a dummy csv file with datetime, coordinate and 3 value columns and stores
+        its datamap for the first farm. Returns (csv file name, map ID)
+        """
+        csv_name, map_payload = create_dummy_csv(has_header=True,
+                                                 has_coordinate=True,
+                                                 has_date=True,
+                                                 has_time=True,
+                                                 sample_data=sample_data,
+                                                 test_col=3)
+
+        map_id = store_datamap(map_url, self.farm_infos[0]["farm_id"], self.admin_header, map_payload)
+        self.assertIsNotNone(map_id)
+
+        return csv_name, map_id
+
+    def delete_upload_datamap(self, map_id):
+        response = requests.delete('{}/datamaps/{}'.format(map_url, map_id),
+                                   headers=self.admin_header)
+        self.assertEqual(response.status_code, 204)
+
+    def post_observation_file(self, filename, content, params=None, **fields):
+        """
+        Uploads an observation file to the first farm as public observations.
+        params are the query parameters, e.g. datetime, and fields the other form fields,
+        e.g. field_id, map_id or force
+        """
+        form = {
+            'farm_id': str(self.farm_infos[0]["farm_id"]),
+            'accessibility': "public"
+        }
+
+        for name, value in fields.items():
+            form[name] = str(value)
+
+        form['file'] = (filename, content, 'text/plain')
+        mp_encoder = MultipartEncoder(fields=form)
+
+        headers = dict(self.admin_header)
+        headers['Content-Type'] = mp_encoder.content_type
+
+        return requests.post("{}/observations/upload".format(sens_url),
+                             params=params, data=mp_encoder, headers=headers)
+
+    def get_upload_file_types(self):
+        """
+        Returns the file types the server accepts, listed in the response to a file of another type
+        """
+        csv_name, map_id = self.create_upload_datamap()
+
+        response = self.post_observation_file("file_types.unknown", b"", map_id=map_id, assign_fields="true")
+        self.assertEqual(response.status_code, 400)
+
+        self.delete_upload_datamap(map_id)
+
+        return response.json()["message"].split("Allowed file types are ", 1)[1].split(", ")
+
+    def upload_observation_copy(self, field_name, convert):
+        """
+        Uploads the dummy csv file and a converted copy of it to their own fields, returns both summaries
+        """
+        csv_name, map_id = self.create_upload_datamap()
+
+        with open(csv_name, 'rb') as f:
+            content = f.read()
+
+        # convert returns the (name, content) of the copy
+        uploads = [(csv_name, content), convert(csv_name, content)]
+
+        summaries = []
+        for num, (filename, data) in enumerate(uploads):
+            field_id = self.create_upload_field("{} {}".format(field_name, num))
+
+            response = self.post_observation_file(filename, data, field_id=field_id, map_id=map_id)
+            self.assertEqual(response.status_code, 200)
+            summaries.append(response.json()["summary"])
+
+        self.delete_upload_datamap(map_id)
+
+        return summaries
+
+    def check_observation_copy(self, summaries):
+        plain, copy = summaries
+
+        self.assertGreater(plain["rows"], 0)
+        self.assertEqual(copy["rows"], plain["rows"])
+        self.assertEqual(copy["rejected_rows"], plain["rejected_rows"])
+
+        for column, col_summary in plain["columns"].items():
+            self.assertEqual(copy["columns"][column]["inserted"], col_summary["inserted"])
+
+    def test_upload_observation_gzip(self):
+        summaries = self.upload_observation_copy(
+            "Test gzip field", lambda name, content: (name + '.gz', gzip.compress(content)))
+        self.check_observation_copy(summaries)
+
+    def test_upload_observation_zstd(self):
+        summaries = self.upload_observation_copy(
+            "Test zstd field", lambda name, content: (name + '.zst', zstd.ZstdCompressor().compress(content)))
+        self.check_observation_copy(summaries)
+
+    def test_upload_observation_zip(self):
+        def to_zip(name, content):
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+                archive.writestr(name.rsplit('/', 1)[-1], content)
+
+            return name.rsplit('.', 1)[0] + '.zip', buffer.getvalue()
+
+        summaries = self.upload_observation_copy("Test zip field", to_zip)
+        self.check_observation_copy(summaries)
+        self.assertEqual(summaries[1]["files"][0]["rows"], summaries[0]["rows"])
+
+    def test_upload_observation_columnar(self):
+        # The server only accepts Parquet and Arrow files if it has pyarrow
+        if "parquet" not in self.get_upload_file_types():
+            self.skipTest("The server does not accept Parquet and Arrow files")
+
+        if pa is None:
+            self.skipTest("pyarrow is not installed, Parquet and Arrow files cannot be written")
+
+        def to_table(content):
+            return pa.Table.from_pandas(pd.read_csv(io.BytesIO(content)), preserve_index=False)
+
+        def to_parquet(name, content):
+            buffer = io.BytesIO()
+            pq.write_table(to_table(content), buffer)
+            return name.rsplit('.', 1)[0] + '.parquet', buffer.getvalue()
+
+        def to_arrow(new_writer):
+            def convert(name, content):
+                table = to_table(content)
+                sink = pa.BufferOutputStream()
+                with new_writer(sink, table.schema) as writer:
+                    writer.write_table(table)
+
+                return name.rsplit('.', 1)[0] + '.arrow', sink.getvalue().to_pybytes()
+
+            return convert
+
+        converters = [("parquet", to_parquet),
+                      ("arrow file", to_arrow(pa.ipc.new_file)),
+                      ("arrow stream", to_arrow(pa.ipc.new_stream))]
+
+        for file_format, convert in converters:
+            with self.subTest(file_format=file_format):
+                summaries = self.upload_observation_copy("Test {} field".format(file_format), convert)
+                self.check_observation_copy(summaries)
+
+    def test_upload_observation_assign_fields(self):
+        # Covers the coordinates of the dummy csv files
+        self.create_upload_field("Test assign field",
+                                 [{"latitude": lat, "longitude": lon}
+                                  for lat, lon in [(0, 0), (0, 14), (14, 14), (14, 0)]])
+        csv_name, map_id = self.create_upload_datamap()
+
+        with open(csv_name, 'rb') as f:
+            response = self.post_observation_file(csv_name, f.read(), map_id=map_id, assign_fields="true")
+        self.assertEqual(response.status_code, 200)
+
+        summary = response.json()["summary"]
+        self.assertEqual(summary["rejected_rows"], 0)
+
+        self.delete_upload_datamap(map_id)
+
+    def test_upload_observation_concurrent(self):
+        field_id = self.create_upload_field("Test concurrent field")
+
+        # Files with the same columns and different values, so they are not duplicates
+        contents = []
+        for i in range(8):
+            csv_name, map_payload = create_dummy_csv(has_header=True,
+                                                     has_coordinate=True,
+                                                     has_date=True,
+                                                     has_time=True,
+                                                     sample_data=10,
+                                                     test_col=3)
+            with open(csv_name, 'rb') as f:
+                contents.append(f.read())
+
+        map_id = store_datamap(map_url, self.farm_infos[0]["farm_id"], self.admin_header, map_payload)
+        self.assertIsNotNone(map_id)
+
+        def upload(content):
+            return self.post_observation_file(csv_name, content, field_id=field_id, map_id=map_id)
+
+        # All uploads create the same parameter types, units and observations at the same time
+        with ThreadPoolExecutor(max_workers=len(contents)) as executor:
+            responses = list(executor.map(upload, contents))
+
+        for response in responses:
+            self.assertEqual(response.status_code, 200)
+
+            for column in response.json()["summary"]["columns"].values():
+                self.assertFalse(column["error"])
+
+        self.delete_upload_datamap(map_id)
+
+    def test_bulk_observations(self):
+        farm_id = self.farm_infos[0]["farm_id"]
+        field_id = self.create_upload_field("Test bulk field")
+
+        start = int(time.time())
+        observations = [
+            {
+                "type": "environment",
+                "context": "air",
+                "parameter": "temperature",
+                "unit": "C",
+                "date_time": [start + i for i in range(10)],
+                "value": [20.0 + i for i in range(10)],
+                "longitude": [5.48 + i * 0.001 for i in range(10)],
+                "latitude": [51.44 + i * 0.001 for i in range(10)]
+            },
+            {
+                "type": "environment",
+                "context": "air",
+                "parameter": "humidity",
+                "unit": "%",
+                "date_time": [datetime.utcfromtimestamp(start + i).isoformat() for i in range(10)],
+                "value": [60.0] * 9 + ["invalid"]
+            }
+        ]
+
+        payload = {
+            'farm_id': farm_id,
+            'field_id': field_id,
+            'accessibility': "public",
+            'longitude': 5.48,
+            'latitude': 51.44,
+            'observations': observations
+        }
+
+        response = requests.post("{}/observations/bulk".format(sens_url),
+                                 json=payload, headers=self.admin_header)
+        self.assertEqual(response.status_code, 200)
+
+        summary = response.json()["summary"]
+        self.assertEqual(summary["rows"], 20)
+        self.assertEqual(summary["inserted"], 19)
+        self.assertEqual(summary["observations"]["1"]["rejected"], 1)
+
+        # The same readings as NDJSON are already stored
+        params = {
+            'farm_id': farm_id,
+            'field_id': field_id,
+            'accessibility': "public",
+            'longitude': 5.48,
+            'latitude': 51.44
+        }
+
+        headers = dict(self.admin_header)
+        headers['Content-Type'] = "application/x-ndjson"
+
+        response = requests.post("{}/observations/bulk".format(sens_url),
+                                 data="\n".join(json.dumps(obs) for obs in observations),
+                                 params=params, headers=headers)
+        self.assertEqual(response.status_code, 200)
+
+        summary = response.json()["summary"]
+        self.assertEqual(summary["inserted"], 0)
+        self.assertEqual(summary["duplicate"], 19)
+
+    def test_stream_observations(self):
+        farm_id = self.farm_infos[0]["farm_id"]
+        field_id = self.create_upload_field("Test stream field")
+
+        params = {
+            'farm_id': farm_id,
+            'field_id': field_id,
+            'accessibility': "public",
+            'longitude': 5.48,
+            'latitude': 51.44
+        }
+
+        start = int(time.time())
+
+        # Every parameter has its own values, so a value under the wrong column is noticed
+        base_values = {"temperature": 20.0, "humidity": 50.0, "chlorophyll": 80.0}
+
+        def readings():
+            for i in range(20):
+                for parameter in ["temperature", "humidity"]:
+                    reading = {
+                        "type": "environment",
+                        "context": "air",
+                        "parameter": parameter,
+                        "unit": "C" if parameter == "temperature" else "%",
+                        "date_time": start + i,
+                        "value": base_values[parameter] + i
+                    }
+                    yield (json.dumps(reading) + "\n").encode('utf-8')
+
+            for i in range(10):
+                reading = {
+                    "type": "crop",
+                    "context": "leaf",
+                    "parameter": "chlorophyll",
+                    "unit": "SPAD",
+                    "date_time": start + i,
+                    "value": base_values["chlorophyll"] + i
+                }
+                yield (json.dumps(reading) + "\n").encode('utf-8')
+
+        headers = dict(self.admin_header)
+        headers['Content-Type'] = "application/x-ndjson"
+
+        # A generator body is sent with Transfer-Encoding: chunked
+        response = requests.post("{}/observations/stream".format(sens_url),
+                                 data=readings(), params=params, headers=headers)
+        self.assertEqual(response.status_code, 200)
+
+        res = response.json()
+        self.assertEqual(res["lines"], 50)
+        self.assertEqual(res["summary"]["inserted"], 50)
+        self.assertEqual(len(res["summary"]["observations"]), 3)
+
+        # Read the readings back in pages of a time range
+        params = {
+            'type': "environment",
+            'farm_id': farm_id,
+            'field_id': field_id,
+            'start': datetime.utcfromtimestamp(start + 5).isoformat(),
+            'end': datetime.utcfromtimestamp(start + 15).isoformat(),
+            'limit': 4
+        }
+
+        rows = []
+        while True:
+            response = requests.get('{}/observations'.format(sens_url),
+                                    params=params, headers=self.admin_header)
+            self.assertEqual(response.status_code, 200)
+
+            sensing = json.loads(response.json())
+            page = json.loads(sensing["observations"][0]["log"])
+            self.assertLessEqual(len(page), 4)
+            rows += page
+
+            if sensing["next_cursor"] is None:
+                break
+
+            params['cursor'] = sensing["next_cursor"]
+
+        # The pages follow each other without overlap or gap
+        self.assertEqual([row[0] // 1000 - start for row in rows], list(range(5, 15)))
+        self.assertEqual(len(rows[0]), 5)
+
+        params['cursor'] = "invalid"
+        response = requests.get('{}/observations'.format(sens_url),
+                                params=params, headers=self.admin_header)
+        self.assertEqual(response.status_code, 400)
+
+        # Stream the readings as NDJSON: farm info, schema, then one line per row
+        params = {'type': "environment", 'farm_id': farm_id, 'field_id': field_id, 'format': "ndjson"}
+        response = requests.get('{}/observations'.format(sens_url),
+                                params=params, headers=self.admin_header, stream=True)
+        self.assertEqual(response.status_code, 200)
+
+        lines = [json.loads(line) for line in response.iter_lines() if line]
+        self.assertEqual(lines[0]["farm_info"]["field_id"], field_id)
+        self.assertEqual(lines[1]["type"], "environment")
+        self.assertEqual([obs["parameter"] for obs in lines[1]["schema"]], ["temperature", "humidity"])
+        self.assertEqual(len(lines[2:]), 20)
+
+        # Rows are date_time (epoch milliseconds), longitude, latitude and the values in schema order
+        for row in lines[2:]:
+            seconds = row[0] // 1000 - start
+            self.assertEqual(len(row), 5)
+            for obs in lines[1]["schema"]:
+                self.assertEqual(row[obs["column"]], base_values[obs["parameter"]] + seconds)
+
+        # Stream both context types as CSV: every value is under the column of its observation
+        params = {'farm_id': farm_id, 'field_id': field_id, 'format': "csv"}
+        response = requests.get('{}/observations'.format(sens_url),
+                                params=params, headers=self.admin_header)
+        self.assertEqual(response.status_code, 200)
+
+        reader = csv.reader(io.StringIO(response.text))
+        header = next(reader)
+        rows = list(reader)
+
+        self.assertEqual(header[:3], ['date_time', 'longitude', 'latitude'])
+        self.assertEqual([column.split('/')[0] for column in header[3:]], ["environment", "environment", "crop"])
+        self.assertEqual(len(rows), 30)
+
+        for row in rows:
+            self.assertEqual(len(row), len(header))
+            seconds = (dtparse.parse(row[0]) - datetime.utcfromtimestamp(start)).total_seconds()
+
+            values = dict((column.split('/')[2].split(' ')[0], float(value))
+                          for column, value in zip(header[3:], row[3:]) if value)
+            self.assertIn(len(values), [1, 2])
+
+            for parameter, value in values.items():
+                self.assertEqual(value, base_values[parameter] + seconds)
+
     # def test_get_observation(self):
     #     # Get farm ID
     #     # farm_info = self.farm_infos[0]